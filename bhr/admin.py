@@ -1,12 +1,18 @@
 from django.contrib import admin
 
 # Register your models here.
-from bhr.models import WhitelistEntry, SourceBlacklistEntry, Block, BlockEntry
+from bhr.models import WhitelistEntry, SourceBlacklistEntry, Block, CHANGE_UNBLOCK, invalidate_dupe_cache, record_block_changes
+from bhr.models import block_change_atomic, outer_atomic_blocks_allowed
 from bhr.forms import BlockForm, AddSourceBlacklistForm
 
 
 def force_unblock(modeladmin, request, queryset):
-    queryset.update(forced_unblock=True)
+    with block_change_atomic():
+        blocks = list(queryset.values_list('id', 'cidr'))
+        ids = [id for id, cidr in blocks]
+        invalidate_dupe_cache(cidr for id, cidr in blocks)
+        Block.objects.filter(id__in=ids).update(forced_unblock=True)
+        record_block_changes([(id, CHANGE_UNBLOCK) for id in ids])
 
 
 force_unblock.short_description = "Force Unblock"
@@ -23,9 +29,7 @@ class BlockStatusListFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == "current":
-            return queryset.filter(
-                id__in=BlockEntry.objects.distinct('block_id').filter(removed__isnull=True).values_list('block_id',
-                                                                                                        flat=True))
+            return queryset.filter(active_entries__gt=0)
 
 
 class AutoWho(admin.ModelAdmin):
@@ -43,6 +47,11 @@ class BlockAdmin(AutoWho):
 
     form = BlockForm
 
+    def save_model(self, request, obj, form, change):
+        # The change form saves inside an atomic block of its own, and commits right after
+        with outer_atomic_blocks_allowed(1):
+            super(BlockAdmin, self).save_model(request, obj, form, change)
+
 
 class WhitelistAdmin(AutoWho):
     date_hierarchy = 'added'
@@ -3,7 +3,7 @@ from django.views.generic import View, FormView, TemplateView
 from django.urls import reverse
 from django.shortcuts import render, redirect
 
-from bhr.models import Block, BHRDB, filter_local_networks
+from bhr.models import Block, BHRDB, SearchTimeoutError, filter_local_networks
 from bhr.forms import AddBlockForm, QueryBlockForm, UnblockForm
 
 from django.db.models import Q
@@ -42,8 +42,16 @@ class QueryView(View):
             return render(self.request, "bhr/query.html", {"form": form})
 
         query = form.cleaned_data['query']
-        blocks = BHRDB().get_history(query).prefetch_related("blockentry_set")
-        return render(self.request, self.result_template_name, {"query": query, "form": form, "blocks": blocks})
+        try:
+            page = max(1, int(self.request.GET.get('page', 1)))
+        except ValueError:
+            page = 1
+        context = {"query": query, "form": form, "page": page}
+        try:
+            context['blocks'], context['has_next'] = BHRDB().get_history_page(query, page)
+        except SearchTimeoutError:
+            context['error'] = "The search took too long, try a longer or more specific query."
+        return render(self.request, self.result_template_name, context)
 
 
 class QueryViewLimited(QueryView):
@@ -54,7 +62,7 @@ class UnblockView(View):
     def post(self, request):
         query = self.request.POST.get("query")
         block_ids = self.request.POST.getlist("block_id")
-        blocks = Block.objects.filter(id__in=block_ids).all()
+        blocks = Block.objects.filter(id__in=block_ids).select_related('who').prefetch_related('blockentry_set')
         block_str = " ".join(block_ids)
         form = UnblockForm(initial={"block_ids": block_str, "query": query})
         return render(self.request, "bhr/unblock.html", {"form": form, "blocks": blocks})
@@ -68,7 +76,7 @@ class DoUnblockView(FormView):
         context = super(DoUnblockView, self).get_context_data(**kwargs)
 
         block_ids = self.request.POST.get("block_ids").split()
-        blocks = Block.objects.filter(id__in=block_ids).all()
+        blocks = Block.objects.filter(id__in=block_ids).select_related('who').prefetch_related('blockentry_set')
         context["blocks"] = blocks
         return context
 
@@ -78,9 +86,7 @@ class DoUnblockView(FormView):
         why = form.cleaned_data['why']
 
         block_ids = map(int, block_ids)
-        blocks = Block.objects.filter(id__in=block_ids).all()
-        for b in blocks:
-            b.unblock_now(self.request.user, why)
+        BHRDB().unblock_now_multi(block_ids, self.request.user, why)
 
         if query and query != "list":
             return redirect(reverse("query") + "?query=" + query)
@@ -0,0 +1,152 @@
+"""Pre-rendered copies of the block list exports.
+
+manage.py export_blocks writes every export in EXPORTS to BHR['export_dir']
+whenever the block set version changes, as plain and gzip files, and touches
+their metadata files every time it checks the version.  The views serve those
+files instead of querying the blocks unless the last check is older than
+BHR['export_max_age'] seconds, which means the exporter is behind or stopped.
+"""
+import glob
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from bhr.models import BHRDB
+from bhr.util import iter_csv
+
+
+class Export(object):
+    def __init__(self, name, fields, headers, content_type="text/csv"):
+        self.name = name
+        self.fields = fields
+        self.headers = headers
+        self.content_type = content_type
+
+    def rows(self, queryset=None):
+        if queryset is None:
+            queryset = BHRDB().expected()
+        return queryset.values_list(*self.fields)
+
+
+EXPORTS = {e.name: e for e in [
+    Export('publist.csv', ('cidr', 'added', 'unblock_at'), ["cidr", "added", "unblock_at"]),
+    Export('list.csv', ('cidr', 'who__username', 'source', 'why', 'added', 'unblock_at'),
+           ["cidr", "who", "source", "why", "added", "unblock_at"]),
+]}
+
+
+class ExportFile(object):
+    """A rendered export as described by its metadata file"""
+
+    def __init__(self, export, directory, meta):
+        self.export = export
+        self.version = meta['version']
+        self.last_modified = parse_datetime(meta['last_modified']) if meta['last_modified'] else None
+        self.path = os.path.join(directory, meta['file'])
+
+    def open(self, gzipped=False):
+        """Open the plain or gzip file, returns None if it was cleaned up in the meantime"""
+        try:
+            return open(self.path + ('.gz' if gzipped else ''), 'rb')
+        except FileNotFoundError:
+            return None
+
+
+def get_export_dir():
+    return settings.BHR.get('export_dir')
+
+
+def get_export_max_age():
+    """Seconds after the last check by the exporter that the files are no longer served"""
+    return settings.BHR.get('export_max_age', 300)
+
+
+def _meta_path(directory, name):
+    return os.path.join(directory, name + '.json')
+
+
+def get_export_file(name, directory=None, max_age=None):
+    """Get the current ExportFile for export name.
+
+    Returns None if there is none, or if the exporter has not checked it
+    within max_age seconds (default BHR['export_max_age']).
+    """
+    directory = directory or get_export_dir()
+    if not directory:
+        return None
+    if max_age is None:
+        max_age = get_export_max_age()
+    try:
+        with open(_meta_path(directory, name)) as f:
+            meta = json.load(f)
+            checked = os.fstat(f.fileno()).st_mtime
+    except (FileNotFoundError, ValueError):
+        return None
+    if time.time() - checked > max_age:
+        return None
+    return ExportFile(EXPORTS[name], directory, meta)
+
+
+def _replace(directory, name, write):
+    """Write a file through write(f) and move it into place as name"""
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + name)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(directory, name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_export(export, directory, version, last_modified):
+    data_name = "%s-%s" % (export.name, version)
+
+    def write_data(f):
+        with gzip.open(os.path.join(directory, data_name + '.gz.tmp'), 'wb') as gz:
+            for chunk in iter_csv(export.rows(), export.headers):
+                chunk = chunk.encode('utf-8')
+                f.write(chunk)
+                gz.write(chunk)
+
+    _replace(directory, data_name, write_data)
+    os.replace(os.path.join(directory, data_name + '.gz.tmp'), os.path.join(directory, data_name + '.gz'))
+
+    meta = dict(version=version, file=data_name,
+                last_modified=last_modified.isoformat() if last_modified else None)
+    previous = get_export_file(export.name, directory, max_age=float('inf'))
+    _replace(directory, export.name + '.json', lambda f: f.write(json.dumps(meta).encode()))
+
+    # Keep the previous version around for requests that are still reading it
+    keep = {data_name, data_name + '.gz'}
+    if previous:
+        keep |= {os.path.basename(previous.path), os.path.basename(previous.path) + '.gz'}
+    for path in glob.glob(os.path.join(directory, glob.escape(export.name) + '-*')):
+        if os.path.basename(path) not in keep:
+            os.unlink(path)
+
+
+def write_exports(directory=None, force=False):
+    """Render every export whose file is older than the block set version.
+
+    The exports that are current are marked as checked.  Returns the names of
+    the exports that were written.
+    """
+    directory = directory or get_export_dir()
+    # Read the version first, data committed after this only makes the files newer than their version
+    version, last_modified = BHRDB().get_block_set_version()
+    written = []
+    for name, export in sorted(EXPORTS.items()):
+        current = get_export_file(name, directory, max_age=float('inf'))
+        if force or current is None or current.version != version:
+            write_export(export, directory, version, last_modified)
+            written.append(name)
+        else:
+            os.utime(_meta_path(directory, name))
+    return written
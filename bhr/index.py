@@ -0,0 +1,194 @@
+"""In-memory indexes over sets of networks.
+
+These are plain data structures with no knowledge of the models, the code in
+bhr.models decides when they need to be rebuilt.
+"""
+from array import array
+from bisect import bisect_right
+
+from bhr.util import to_network
+
+# trie node layout: [zero child, one child, rank stored here, lowest rank in subtree]
+ZERO, ONE, RANK, SUBTREE_RANK = range(4)
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class PrefixTrie(object):
+    """Binary trie of the networks of a single address family.
+
+    Every network is stored with a rank, lookups return the lowest rank of
+    any overlapping network so that the answer does not depend on the order
+    in which networks were added.
+    """
+
+    def __init__(self, max_prefixlen):
+        self.max_prefixlen = max_prefixlen
+        self.root = [None, None, None, None]
+
+    def add(self, address, prefixlen, rank):
+        node = self.root
+        node[SUBTREE_RANK] = _min(node[SUBTREE_RANK], rank)
+        for depth in range(prefixlen):
+            bit = (address >> (self.max_prefixlen - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None, None]
+            node = node[bit]
+            node[SUBTREE_RANK] = _min(node[SUBTREE_RANK], rank)
+        node[RANK] = _min(node[RANK], rank)
+
+    def find_overlap(self, address, prefixlen):
+        """Return the lowest rank of a network that contains or is contained by address/prefixlen"""
+        best = None
+        node = self.root
+        for depth in range(prefixlen):
+            best = _min(best, node[RANK])
+            node = node[(address >> (self.max_prefixlen - 1 - depth)) & 1]
+            if node is None:
+                return best
+        return _min(best, node[SUBTREE_RANK])
+
+
+class NetworkIndex(object):
+    """Overlap index over networks of both address families.
+
+    add() the networks along with the object that should be returned for
+    them, find_overlap() then returns the object of the first added network
+    that overlaps the query, in O(prefix length).
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.values = []
+        self.tries = {
+            4: PrefixTrie(32),
+            6: PrefixTrie(128),
+        }
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, network, value):
+        network = to_network(network)
+        rank = len(self.values)
+        self.values.append(value)
+        self.tries[network.version].add(int(network.network_address), network.prefixlen, rank)
+
+    def find_overlap(self, network):
+        network = to_network(network)
+        rank = self.tries[network.version].find_overlap(int(network.network_address), network.prefixlen)
+        if rank is None:
+            return None
+        return self.values[rank]
+
+
+class _Segments(object):
+    """The networks of one address family flattened into disjoint segments.
+
+    Segment i covers starts[i]..ends[i] and points at nodes[i], the most
+    specific network covering it.  Networks are numbered in sorted order,
+    parents[n] is the network directly enclosing network n, or -1.
+    """
+
+    def __init__(self, max_prefixlen):
+        self.max_prefixlen = max_prefixlen
+        # v6 addresses do not fit in a machine word
+        self.typecode = 'Q' if max_prefixlen <= 32 else None
+        # (start << 8 | prefixlen) sorts enclosing networks first
+        self.sort_keys = self._array()
+        self.unsorted_keys = array('q')
+
+    def _array(self):
+        return array(self.typecode) if self.typecode else []
+
+    def add(self, start, prefixlen, key):
+        self.sort_keys.append(start << 8 | prefixlen)
+        self.unsorted_keys.append(key)
+
+    def build(self):
+        self.starts = self._array()
+        self.ends = self._array()
+        self.nodes = array('q')
+        self.keys = array('q')
+        self.parents = array('q')
+
+        sort_keys = self.sort_keys
+        stack = []  # (end, node) of the networks enclosing the current position
+        position = 0
+        for node, i in enumerate(sorted(range(len(sort_keys)), key=sort_keys.__getitem__)):
+            start, prefixlen = sort_keys[i] >> 8, sort_keys[i] & 0xff
+            end = start | ((1 << (self.max_prefixlen - prefixlen)) - 1)
+            while stack and stack[-1][0] < start:
+                position = self._pop(stack, position)
+            if stack and position < start:
+                self._segment(position, start - 1, stack[-1][1])
+            self.keys.append(self.unsorted_keys[i])
+            self.parents.append(stack[-1][1] if stack else -1)
+            stack.append((end, node))
+            position = start
+        while stack:
+            position = self._pop(stack, position)
+        del self.sort_keys, self.unsorted_keys
+
+    def _segment(self, start, end, node):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.nodes.append(node)
+
+    def _pop(self, stack, position):
+        end, node = stack.pop()
+        if position <= end:
+            self._segment(position, end, node)
+        return max(position, end + 1)
+
+    def find_covering(self, address):
+        i = bisect_right(self.starts, address) - 1
+        if i < 0 or address > self.ends[i]:
+            return []
+        keys = []
+        node = self.nodes[i]
+        while node != -1:
+            keys.append(self.keys[node])
+            node = self.parents[node]
+        return keys
+
+
+class IntervalIndex(object):
+    """Covering index over networks that are either nested or disjoint, as CIDRs are.
+
+    Built once from (version, start address, prefixlen, integer key) tuples
+    into sorted arrays, which keeps it compact enough for millions of
+    networks.  find_covering() returns the keys of every network containing
+    an address, most specific first, with a binary search.
+    """
+
+    def __init__(self, ranges=()):
+        self.families = {
+            4: _Segments(32),
+            6: _Segments(128),
+        }
+        self.size = 0
+        for version, start, prefixlen, key in ranges:
+            self.families[version].add(start, prefixlen, key)
+            self.size += 1
+        for family in self.families.values():
+            family.build()
+
+    @classmethod
+    def from_networks(cls, networks):
+        """Build an index from (network, integer key) pairs"""
+        networks = ((to_network(network), key) for network, key in networks)
+        return cls((n.version, int(n.network_address), n.prefixlen, key) for n, key in networks)
+
+    def __len__(self):
+        return self.size
+
+    def find_covering(self, address):
+        """Get the keys of the networks containing the ipaddress address"""
+        return self.families[address.version].find_covering(int(address))
@@ -0,0 +1,583 @@
+import csv
+import datetime
+import io
+import ipaddress
+import logging
+import multiprocessing
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from django_pglocks import advisory_lock
+
+from bhr.util import iter_csv
+from bhr.models import BHRDB, Block, BlockEntry, DupeCache, ExpectedBlockIndex, WhitelistEntry, is_whitelisted, scan_whitelist
+from bhr.models import outer_atomic_blocks_allowed
+from bhr.serializers import FastBlockSerializer, FastBlockQueueSerializer
+
+
+def random_network(rng, family=4):
+    if family == 4:
+        prefixlen = rng.randint(24, 32)
+        address = rng.getrandbits(32)
+        return ipaddress.ip_network((address, prefixlen), strict=False)
+    prefixlen = rng.randint(48, 128)
+    address = rng.getrandbits(128)
+    return ipaddress.ip_network((address, prefixlen), strict=False)
+
+
+def random_networks(rng, count, v6_ratio=0.1):
+    return [random_network(rng, 6 if rng.random() < v6_ratio else 4) for _ in range(count)]
+
+
+def timed(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - start
+
+
+def bench_whitelist(cmd, user, rng, options):
+    size = options['size'] or 10000
+    queries = random_networks(rng, options['queries'] or 1000)
+    WhitelistEntry.objects.bulk_create(
+        WhitelistEntry(cidr=str(n), who=user, why='benchmark') for n in random_networks(rng, size))
+
+    is_whitelisted(queries[0])  # build the index outside of the timing
+    for name, fn in ('scan', scan_whitelist), ('index', is_whitelisted):
+        elapsed = timed(fn, queries)
+        cmd.report(name, entries=size, lookups=len(queries), seconds=elapsed,
+                   lookups_per_sec=len(queries) / elapsed)
+
+
+def bench_mblock(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 50000
+    loop_size = min(size, options['queries'] or 1000)
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    requests = [dict(cidr=str(ipaddress.ip_address(first + i)), source='benchmark', why='benchmark', duration=300)
+                for i in range(size + loop_size)]
+
+    start = time.perf_counter()
+    for r in requests[size:]:
+        db.add_block(who=user, **r)
+    elapsed = time.perf_counter() - start
+    cmd.report('loop', blocks=loop_size, seconds=elapsed, blocks_per_sec=loop_size / elapsed)
+
+    for name in 'new', 'dupe':
+        start = time.perf_counter()
+        db.add_block_multi(user, requests[:size])
+        elapsed = time.perf_counter() - start
+        cmd.report('batch-%s' % name, blocks=size, seconds=elapsed, blocks_per_sec=size / elapsed)
+
+
+def bench_preflight(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 10000
+    loop_size = min(size, options['queries'] or 1000)
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    cidrs = [str(ipaddress.ip_address(first + i)) for i in range(size)]
+    # half of the candidates are already blocked, a tenth are whitelisted
+    db.add_block_multi(user, [dict(cidr=cidr, source='benchmark', why='benchmark', duration=3600)
+                              for cidr in cidrs[::2]])
+    WhitelistEntry.objects.bulk_create(
+        WhitelistEntry(cidr=cidr, who=user, why='benchmark') for cidr in cidrs[1::20])
+
+    start = time.perf_counter()
+    for cidr in cidrs[:loop_size:2]:
+        db.add_block(cidr, user, 'benchmark', 'benchmark', duration=60)
+    elapsed = time.perf_counter() - start
+    cmd.report('dupe-loop', blocks=loop_size // 2, seconds=elapsed, blocks_per_sec=loop_size // 2 / elapsed)
+
+    start = time.perf_counter()
+    verdicts = db.preflight_blocks('benchmark', cidrs, duration=60)
+    elapsed = time.perf_counter() - start
+    statuses = {}
+    for verdict in verdicts:
+        statuses[verdict['status']] = statuses.get(verdict['status'], 0) + 1
+    cmd.report('preflight', blocks=size, seconds=elapsed, blocks_per_sec=size / elapsed, **statuses)
+
+
+def bench_dedupe(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 100000
+    queries = options['queries'] or 10000
+    networks = [n for n in random_networks(rng, size, v6_ratio=0) if n.prefixlen < 32]
+    for i in range(0, len(networks), 10000):
+        Block.objects.bulk_create(
+            Block(cidr=str(n), who=user, source='wide', why='benchmark', skip_whitelist=True)
+            for n in networks[i:i + 10000])
+    with connection.cursor() as c:
+        c.execute("ANALYZE bhr_block")
+    # a scanning wave, every address is inside a block
+    requests = []
+    for n in rng.sample(networks, queries):
+        ip = ipaddress.ip_address(int(n.network_address) + rng.randrange(n.num_addresses))
+        requests.append(dict(cidr=str(ip), source='scanner', why='benchmark', duration=300, skip_whitelist=True))
+
+    for mode in None, 'dupe', 'record':
+        sid = transaction.savepoint()
+        with override_settings(BHR=dict(settings.BHR, covering_dedupe={'scanner': mode})):
+            start = time.perf_counter()
+            db.add_block_multi(user, requests)
+            elapsed = time.perf_counter() - start
+        queued = Block.expected.filter(source='scanner').count()
+        transaction.savepoint_rollback(sid)
+        cmd.report(mode or 'off', blocks=len(networks), requests=queries, seconds=elapsed,
+                   requests_per_sec=queries / elapsed, queued=queued)
+
+
+def bench_dupe_cache(cmd, user, rng, options):
+    db = BHRDB()
+    queries = options['queries'] or 10000
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    # 90% of the requests resubmit one of the addresses seen so far without extending it
+    requests = []
+    seen = []
+    for i in range(queries):
+        if seen and rng.random() < 0.9:
+            requests.append(dict(cidr=rng.choice(seen), extend=False))
+        else:
+            seen.append(str(ipaddress.ip_address(first + len(seen))))
+            requests.append(dict(cidr=seen[-1]))
+
+    caches = {'dupes': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark',
+                        'OPTIONS': {'MAX_ENTRIES': queries}}}
+    for name, alias in ('off', None), ('locmem', 'dupes'):
+        sid = transaction.savepoint()
+        with override_settings(CACHES=dict(settings.CACHES, **caches), BHR=dict(settings.BHR, dupe_cache=alias)):
+            start = time.perf_counter()
+            for r in requests:
+                db.add_block(who=user, source='benchmark', why='benchmark', duration=300, **r)
+            elapsed = time.perf_counter() - start
+            stats = DupeCache().stats() if alias else {}
+        transaction.savepoint_rollback(sid)
+        cmd.report(name, requests=queries, seconds=elapsed, requests_per_sec=queries / elapsed, **stats)
+
+
+def bench_autoscale(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 200000
+    queries = options['queries'] or 1000
+    # persistent offenders, every cidr has size / queries blocks in its history
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    cidrs = [str(ipaddress.ip_address(first + i)) for i in range(queries)]
+    now = timezone.now()
+    for i in range(0, size, 10000):
+        Block.objects.bulk_create(
+            Block(cidr=cidrs[n % queries], who=user, source='benchmark', why='benchmark', skip_whitelist=True,
+                  added=now - datetime.timedelta(hours=n), unblock_at=now - datetime.timedelta(hours=n - 1))
+            for n in range(i, min(size, i + 10000)))
+    with connection.cursor() as c:
+        c.execute("ANALYZE bhr_block")
+        c.execute("ANALYZE bhr_offendersummary")
+
+    def history(cidrs):
+        return {b.cidr: b for b in Block.objects.filter(cidr__in=cidrs).order_by('cidr', '-added').distinct('cidr')}
+
+    for name, fn in ('history', history), ('summary', db.get_last_blocks):
+        start = time.perf_counter()
+        for cidr in cidrs:
+            fn([cidr])
+        elapsed = time.perf_counter() - start
+        cmd.report(name, blocks=size, lookups=queries, seconds=elapsed, lookups_per_sec=queries / elapsed)
+        start = time.perf_counter()
+        fn(cidrs)
+        elapsed = time.perf_counter() - start
+        cmd.report(name + '-batch', blocks=size, lookups=queries, seconds=elapsed)
+
+    start = time.perf_counter()
+    db.add_block_multi(user, [dict(cidr=cidr, source='benchmark', why='benchmark', duration=300, autoscale=True,
+                                   skip_whitelist=True) for cidr in cidrs])
+    elapsed = time.perf_counter() - start
+    cmd.report('mblock-autoscale', blocks=queries, seconds=elapsed, blocks_per_sec=queries / elapsed)
+
+
+def bench_ack(cmd, user, rng, options):
+    db = BHRDB()
+    sizes = [options['size']] if options['size'] else [200, 2000, 20000]
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    blocks = db.add_block_multi(user, [dict(cidr=str(ipaddress.ip_address(first + i)), source='benchmark',
+                                            why='benchmark', duration=300) for i in range(max(sizes))])
+    block_ids = [b.id for b in blocks]
+
+    for size in sizes:
+        ident = 'benchmark-%d' % size
+        start = time.perf_counter()
+        db.set_blocked_multi(ident, block_ids[:size])
+        elapsed = time.perf_counter() - start
+        cmd.report('set_blocked_multi', ids=size, seconds=elapsed, ids_per_sec=size / elapsed)
+
+        entry_ids = list(BlockEntry.objects.filter(ident=ident).values_list('id', flat=True))
+        start = time.perf_counter()
+        db.set_unblocked_multi(entry_ids)
+        elapsed = time.perf_counter() - start
+        cmd.report('set_unblocked_multi', ids=size, seconds=elapsed, ids_per_sec=size / elapsed)
+
+
+def bench_stats(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 100000
+    queries = options['queries'] or 100
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    Block.objects.bulk_create(
+        Block(cidr=str(ipaddress.ip_address(first + i)), who=user, source='benchmark-%d' % (i % 20), why='benchmark')
+        for i in range(size))
+
+    for name, fn in ('count', lambda: (db.count_stats(), db.count_source_stats())), \
+                    ('counters', lambda: (db.stats(), db.source_stats())):
+        start = time.perf_counter()
+        for i in range(queries):
+            fn()
+        elapsed = time.perf_counter() - start
+        cmd.report(name, blocks=size, calls=queries, seconds=elapsed, ms_per_call=1000 * elapsed / queries)
+
+
+def bench_serializers(cmd, user, rng, options):
+    size = options['size'] or 20000
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    Block.objects.bulk_create(
+        Block(cidr=str(ipaddress.ip_address(first + i)), who=user, source='benchmark', why='benchmark')
+        for i in range(size))
+    context = {'request': RequestFactory().get('/bhr/api/current_blocks/', HTTP_HOST='localhost')}
+    queryset = Block.objects.filter(who=user).order_by('id')
+
+    for fast_serializer_class in FastBlockSerializer, FastBlockQueueSerializer:
+        name = fast_serializer_class.serializer_class.__name__
+        for mode, serialize in (
+                ('drf', lambda: fast_serializer_class.serializer_class(
+                    queryset.select_related('who'), many=True, context=context).data),
+                ('fast', lambda: fast_serializer_class(context).data(queryset))):
+            start = time.perf_counter()
+            serialize()
+            elapsed = time.perf_counter() - start
+            cmd.report('%s-%s' % (name, mode), rows=size, seconds=elapsed, rows_per_sec=size / elapsed)
+
+
+def bench_search(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 1000000
+    queries = options['queries'] or 10
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    words = ['ssh', 'scan', 'brute force', 'port 22', 'port 443', 'malware', 'c2', 'phishing', 'spam', 'dos']
+    for i in range(0, size, 10000):
+        Block.objects.bulk_create(
+            Block(cidr=str(ipaddress.ip_address(first + n)), who=user, source='benchmark-%d' % (n % 20),
+                  why='%s %s from host-%d' % (rng.choice(words), rng.choice(words), rng.randrange(size)))
+            for n in range(i, min(i + 10000, size)))
+    with connection.cursor() as c:
+        c.execute("ANALYZE bhr_block")
+
+    for term in 'host-%d' % rng.randrange(size), 'brute force':
+        for name, fn in ('contains', lambda: list(Block.objects.filter(why__contains=term).order_by('-added'))), \
+                        ('page', lambda: db.get_history_page(term, timeout=60)):
+            start = time.perf_counter()
+            for i in range(queries):
+                fn()
+            elapsed = time.perf_counter() - start
+            cmd.report('%s-%s' % (name, term.replace(' ', '_')), blocks=size, calls=queries, seconds=elapsed,
+                       ms_per_call=1000 * elapsed / queries)
+
+
+def bench_covering(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 1000000
+    queries = options['queries'] or 10000
+    networks = random_networks(rng, size)
+    for i in range(0, size, 10000):
+        Block.objects.bulk_create(
+            Block(cidr=str(n), who=user, source='benchmark', why='benchmark', skip_whitelist=True)
+            for n in networks[i:i + 10000])
+    with connection.cursor() as c:
+        c.execute("ANALYZE bhr_block")
+    # half of the lookups hit a block
+    ips = [ipaddress.ip_address(int(n.network_address) + rng.randrange(n.num_addresses))
+           for n in rng.sample(networks, queries // 2)]
+    ips += [random_network(rng, 6 if rng.random() < 0.1 else 4).network_address for _ in range(queries - len(ips))]
+
+    for name in 'gist', 'scan':
+        if name == 'scan':
+            with connection.cursor() as c:
+                c.execute("DROP INDEX bhr_block_cidr_gist")
+            ips = ips[:max(1, queries // 1000)]
+        elapsed = timed(db.covering_blocks, ips)
+        cmd.report(name, blocks=size, lookups=len(ips), seconds=elapsed, ms_per_lookup=1000 * elapsed / len(ips))
+
+
+def bench_lookup(cmd, user, rng, options):
+    db = BHRDB()
+    size = options['size'] or 1000000
+    queries = options['queries'] or 100000
+    networks = random_networks(rng, size)
+    for i in range(0, size, 10000):
+        Block.objects.bulk_create(
+            Block(cidr=str(n), who=user, source='benchmark-%d' % (i % 20), why='benchmark', skip_whitelist=True)
+            for n in networks[i:i + 10000])
+    with connection.cursor() as c:
+        c.execute("ANALYZE bhr_block")
+    # half of the lookups hit a block
+    ips = [ipaddress.ip_address(int(n.network_address) + rng.randrange(n.num_addresses))
+           for n in rng.sample(networks, queries // 2)]
+    ips += [random_network(rng, 6 if rng.random() < 0.1 else 4).network_address for _ in range(queries - len(ips))]
+
+    rss = _rss_kb('VmRSS')
+    start = time.perf_counter()
+    index = ExpectedBlockIndex()
+    elapsed = time.perf_counter() - start
+    cmd.report('build', blocks=size, seconds=elapsed, rss_mb=(_rss_kb('VmRSS') - rss) / 1024)
+
+    elapsed = timed(index.lookup, ips)
+    cmd.report('index', blocks=size, lookups=len(ips), seconds=elapsed, lookups_per_sec=len(ips) / elapsed)
+
+    sample = ips[:max(1, queries // 100)]
+    elapsed = timed(db.covering_blocks, sample)
+    cmd.report('sql', blocks=size, lookups=len(sample), seconds=elapsed, lookups_per_sec=len(sample) / elapsed)
+
+    db.add_block_multi(user, [dict(cidr=str(n), source='benchmark', why='benchmark', duration=300)
+                              for n in random_networks(rng, 1000, v6_ratio=0)])
+    start = time.perf_counter()
+    index.refresh()
+    elapsed = time.perf_counter() - start
+    cmd.report('refresh', changes=1000, seconds=elapsed)
+    elapsed = timed(index.lookup, ips)
+    cmd.report('index-after-refresh', blocks=size, lookups=len(ips), seconds=elapsed,
+               lookups_per_sec=len(ips) / elapsed)
+
+
+def _buffered_csv(rows, headers):
+    # how respond_csv built the response before it streamed
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(headers)
+    for row in rows:
+        writer.writerow(row)
+    yield f.getvalue()
+
+
+def _rss_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def _csv_worker(args):
+    mode, results = args
+    # reset the peak rss of this process to the current rss
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    base = _rss_kb('VmRSS')
+    render = iter_csv if mode == 'streaming' else _buffered_csv
+    rows = BHRDB().expected().values_list('cidr', 'added', 'unblock_at')
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    try:
+        for chunk in render(rows, ["cidr", "added", "unblock_at"]):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+        results.put((time.perf_counter() - start, first_byte, size, _rss_kb('VmHWM') - base))
+    finally:
+        connection.close()
+
+
+def bench_csv(cmd, user, rng, options):
+    sizes = [options['size']] if options['size'] else [100000, 1000000]
+    first = int(ipaddress.ip_address('10.0.0.0'))
+    created = 0
+    ctx = multiprocessing.get_context('fork')
+    for size in sizes:
+        for i in range(created, size, 10000):
+            Block.objects.bulk_create(
+                Block(cidr=str(ipaddress.ip_address(first + n)), who=user, source='benchmark', why='benchmark')
+                for n in range(i, min(i + 10000, size)))
+        created = size
+
+        for mode in 'buffered', 'streaming':
+            connections.close_all()
+            results = ctx.Queue()
+            worker = ctx.Process(target=_csv_worker, args=((mode, results),))
+            worker.start()
+            elapsed, first_byte, length, peak_kb = results.get()
+            worker.join()
+            cmd.report(mode, rows=size, seconds=elapsed, rows_per_sec=size / elapsed,
+                       first_byte_seconds=first_byte, mbytes=length / 1e6, peak_rss_mb=peak_kb / 1024)
+
+
+# Benchmarks that need their writes to be visible to other processes
+bench_csv.commits = True
+
+
+def _add_blocks_worker(args):
+    worker, count, global_lock = args
+    db = BHRDB()
+    user = User.objects.get(username='bhr-benchmark')
+    first = int(ipaddress.ip_address('10.0.0.0')) + worker * count
+    try:
+        for i in range(count):
+            cidr = str(ipaddress.ip_address(first + i))
+            if global_lock:
+                # how add_block serialized writers before per cidr locks
+                with advisory_lock("add_block"):
+                    db.add_block(cidr, user, 'benchmark', 'benchmark', duration=300)
+            else:
+                db.add_block(cidr, user, 'benchmark', 'benchmark', duration=300)
+    finally:
+        connection.close()
+
+
+def bench_add_block_concurrency(cmd, user, rng, options):
+    count = options['queries'] or 500
+    for mode in 'global', 'per-cidr':
+        for workers in 1, 2, 4, 8:
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                start = time.perf_counter()
+                pool.map(_add_blocks_worker, [(w, count, mode == 'global') for w in range(workers)])
+                elapsed = time.perf_counter() - start
+            delete_blocks(user)
+            cmd.report(mode, workers=workers, blocks=workers * count, seconds=elapsed,
+                       blocks_per_sec=workers * count / elapsed)
+
+
+bench_add_block_concurrency.commits = True
+
+
+def _mblock_worker(args):
+    count, global_lock, started, results = args
+    db = BHRDB()
+    user = User.objects.get(username='bhr-benchmark')
+    first = int(ipaddress.ip_address('10.1.0.0'))
+    blocks = [dict(cidr=str(ipaddress.ip_address(first + i)), source='benchmark', why='benchmark', duration=300)
+              for i in range(count)]
+    try:
+        start = time.perf_counter()
+        if global_lock:
+            with advisory_lock("add_block"):
+                started.set()
+                db.add_block_multi(user, blocks)
+        else:
+            started.set()
+            db.add_block_multi(user, blocks)
+        results.put(('mblock', time.perf_counter() - start))
+    finally:
+        connection.close()
+
+
+def _single_blocks_worker(args):
+    count, global_lock, started, results = args
+    db = BHRDB()
+    user = User.objects.get(username='bhr-benchmark')
+    first = int(ipaddress.ip_address('10.2.0.0'))
+    latencies = []
+    started.wait()
+    try:
+        for i in range(count):
+            cidr = str(ipaddress.ip_address(first + i))
+            start = time.perf_counter()
+            if global_lock:
+                with advisory_lock("add_block"):
+                    db.add_block(cidr, user, 'benchmark', 'benchmark', duration=300)
+            else:
+                db.add_block(cidr, user, 'benchmark', 'benchmark', duration=300)
+            latencies.append(time.perf_counter() - start)
+        results.put(('singles', sorted(latencies)))
+    finally:
+        connection.close()
+
+
+def bench_mblock_stall(cmd, user, rng, options):
+    """Latency of single blocks of other cidrs while a large mblock runs"""
+    size = options['size'] or 5000
+    count = options['queries'] or 50
+    ctx = multiprocessing.get_context('fork')
+    for mode in 'global', 'per-cidr':
+        connections.close_all()
+        started, results = ctx.Event(), ctx.Queue()
+        args = (mode == 'global', started, results)
+        workers = [ctx.Process(target=_mblock_worker, args=((size,) + args,)),
+                   ctx.Process(target=_single_blocks_worker, args=((count,) + args,))]
+        for worker in workers:
+            worker.start()
+        found = dict(results.get() for worker in workers)
+        for worker in workers:
+            worker.join()
+        delete_blocks(user)
+        latencies = found['singles']
+        cmd.report(mode, mblock_size=size, mblock_seconds=found['mblock'], singles=count,
+                   single_p50_seconds=latencies[len(latencies) // 2], single_max_seconds=latencies[-1])
+
+
+bench_mblock_stall.commits = True
+
+
+def delete_blocks(user):
+    """Delete the blocks a committing benchmark created, entries first since they protect their blocks"""
+    BlockEntry.objects.filter(block__who=user).delete()
+    Block.objects.filter(who=user).delete()
+
+
+BENCHMARKS = {
+    'whitelist': bench_whitelist,
+    'mblock': bench_mblock,
+    'preflight': bench_preflight,
+    'dedupe': bench_dedupe,
+    'dupe_cache': bench_dupe_cache,
+    'autoscale': bench_autoscale,
+    'ack': bench_ack,
+    'stats': bench_stats,
+    'csv': bench_csv,
+    'serializers': bench_serializers,
+    'search': bench_search,
+    'covering': bench_covering,
+    'lookup': bench_lookup,
+    'add_block_concurrency': bench_add_block_concurrency,
+    'mblock_stall': bench_mblock_stall,
+}
+
+
+class Command(BaseCommand):
+    help = ('Run a BHR micro benchmark against the configured database. Never run this against a live site: '
+            'benchmarks hold the block change lock for their whole run, and some commit blocks that backends '
+            'polling the queues would enforce.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+        parser.add_argument('--size', type=int, help='number of rows to create')
+        parser.add_argument('--queries', type=int, help='number of operations to time')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--i-know-this-is-not-production', action='store_true',
+                            help='confirm that the configured database is not used by a live site')
+
+    def report(self, name, **results):
+        fields = " ".join("%s=%s" % (k, round(v, 4) if isinstance(v, float) else v) for k, v in results.items())
+        self.stdout.write("%s %s" % (name, fields))
+
+    def handle(self, *args, **options):
+        if not options['i_know_this_is_not_production']:
+            raise CommandError("Benchmarks write to the configured database (%s) and stall or disturb a live site, "
+                               "pass --i-know-this-is-not-production to run them anyway"
+                               % connection.settings_dict['NAME'])
+        # per block log lines would dominate the timings
+        logging.getLogger('bhr').setLevel(logging.WARNING)
+        rng = random.Random(options['seed'])
+        benchmark = BENCHMARKS[options['benchmark']]
+        if getattr(benchmark, 'commits', False):
+            user, created = User.objects.get_or_create(username='bhr-benchmark')
+            try:
+                benchmark(self, user, rng, options)
+            finally:
+                delete_blocks(user)
+                user.delete()
+            return
+
+        with outer_atomic_blocks_allowed(1), transaction.atomic():
+            user, created = User.objects.get_or_create(username='bhr-benchmark')
+            benchmark(self, user, rng, options)
+            transaction.set_rollback(True)
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bhr.exports import get_export_dir, get_export_max_age, write_exports
+from bhr.models import BlockChangeListener
+
+
+class Command(BaseCommand):
+    help = 'Write the block list exports to BHR export_dir and keep them up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='directory to write to, defaults to the export_dir setting')
+        parser.add_argument('--once', action='store_true', help='write the exports once and exit')
+        parser.add_argument('--force', action='store_true', help='write the exports even if they are current')
+        parser.add_argument('--min-interval', type=float, default=10.0,
+                            help='never regenerate more often than every MIN_INTERVAL seconds')
+        parser.add_argument('--max-interval', type=float, default=60.0,
+                            help='check for expired blocks at least every MAX_INTERVAL seconds, '
+                                 'keep it below BHR export_max_age')
+
+    def write(self, directory, force=False):
+        for name in write_exports(directory, force=force):
+            self.stdout.write("wrote %s" % name)
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or get_export_dir()
+        if not directory:
+            raise CommandError("Set BHR['export_dir'] or pass --dir")
+
+        if options['once']:
+            self.write(directory, options['force'])
+            return
+
+        if options['max_interval'] >= get_export_max_age():
+            self.stderr.write("--max-interval is not below BHR['export_max_age'], "
+                              "the exports will not be served while the blocks do not change")
+
+        with BlockChangeListener() as listener:
+            self.write(directory, options['force'])
+            while True:
+                last = time.monotonic()
+                # Expiring blocks change the version without a notification
+                listener.wait(options['max_interval'])
+                # A flood of blocks is coalesced into one write per min_interval
+                time.sleep(max(0, last + options['min_interval'] - time.monotonic()))
+                listener.drain()
+                self.write(directory)
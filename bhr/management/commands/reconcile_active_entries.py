@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from bhr.models import BHRDB
+
+
+class Command(BaseCommand):
+    help = 'Repair Block.active_entries counts that do not match the block entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report the blocks that are off')
+
+    def handle(self, *args, **options):
+        drift = BHRDB().reconcile_active_entries(fix=not options['dry_run'])
+        for id, stored, actual in drift:
+            self.stdout.write("block %s active_entries=%s actual=%s" % (id, stored, actual))
+        self.stdout.write("%d blocks %s" % (len(drift), "off" if options['dry_run'] else "repaired"))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bhr.models import BHRDB
+
+
+class Command(BaseCommand):
+    help = 'Fold block changes and expired blocks into the stat counters, run it every minute or so'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help='keep running and sweep every INTERVAL seconds')
+        parser.add_argument('--rebuild', action='store_true', help='recompute the counters from the blocks')
+        parser.add_argument('--verify', action='store_true', help='compare the counters to the blocks')
+
+    def handle(self, *args, **options):
+        db = BHRDB()
+        if options['rebuild']:
+            self.stdout.write("rebuilt %d counters" % db.rebuild_stats())
+        if options['verify']:
+            diffs = db.verify_stats()
+            for name, counted, actual in diffs:
+                self.stdout.write("%s counter=%s actual=%s" % (name, counted, actual))
+            if diffs:
+                raise CommandError("%d stats do not match, run with --rebuild to fix them" % len(diffs))
+            self.stdout.write("stats ok")
+            return
+
+        while True:
+            db.sweep_stats()
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.27 on 2026-10-17 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0013_blockentry_fast_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeVersion',
+            fields=[
+                ('name', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='date updated')),
+            ],
+        ),
+        migrations.RunSQL('CREATE SEQUENCE bhr_changeversion_seq', 'DROP SEQUENCE bhr_changeversion_seq'),
+        migrations.RunSQL('''CREATE FUNCTION bhr_bump_whitelist_version() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO bhr_changeversion (name, version, updated)
+                VALUES ('whitelist', nextval('bhr_changeversion_seq'), now())
+                ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version, updated = EXCLUDED.updated;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql''', 'DROP FUNCTION bhr_bump_whitelist_version()'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_whitelistentry_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bhr_whitelistentry
+            FOR EACH STATEMENT EXECUTE PROCEDURE bhr_bump_whitelist_version()''',
+                          'DROP TRIGGER bhr_whitelistentry_version ON bhr_whitelistentry'),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.27 on 2026-10-17 07:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0014_changeversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('A', 'Added'), ('E', 'Extended'), ('U', 'Unblocked')], max_length=1)),
+                ('added', models.DateTimeField(auto_now_add=True, verbose_name='date added')),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bhr.Block')),
+            ],
+        ),
+        # Existing expected blocks are logged as added, so a client starting
+        # from cursor 0 sees everything that is still pending.
+        migrations.RunSQL('''INSERT INTO bhr_blockchange (block_id, kind, added)
+            SELECT id, 'A', added FROM bhr_block
+            WHERE (unblock_at IS NULL OR unblock_at > now()) AND forced_unblock = false
+            ORDER BY added''', migrations.RunSQL.noop),
+    ]
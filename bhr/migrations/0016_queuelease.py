@@ -0,0 +1,27 @@
+# Generated by Django 2.2.27 on 2026-10-17 07:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0015_blockchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ident', models.CharField(max_length=50, verbose_name='blocker ident')),
+                ('kind', models.CharField(choices=[('B', 'Block'), ('U', 'Unblock')], max_length=1)),
+                ('expires', models.DateTimeField(verbose_name='lease expires')),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bhr.Block')),
+            ],
+            options={
+                'unique_together': {('ident', 'block', 'kind')},
+            },
+        ),
+    ]
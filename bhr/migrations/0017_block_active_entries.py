@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0016_queuelease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='active_entries',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL('''UPDATE bhr_block b SET active_entries = c.active
+            FROM (SELECT block_id, count(*) AS active FROM bhr_blockentry
+                  WHERE removed IS NULL GROUP BY block_id) c
+            WHERE b.id = c.block_id''', migrations.RunSQL.noop),
+        migrations.RunSQL('create index bhr_block_current on bhr_block (unblock_at) where active_entries > 0',
+                          'drop index bhr_block_current'),
+        migrations.RunSQL('create index bhr_block_pending on bhr_block (unblock_at) where active_entries = 0 and forced_unblock is false',
+                          'drop index bhr_block_pending'),
+    ]
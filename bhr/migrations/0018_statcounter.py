@@ -0,0 +1,104 @@
+from django.db import migrations, models
+
+# The block counts a single block contributes to at a given time, the
+# definitions match the current, expected, pending and pending_removal managers.
+BLOCK_METRICS_FUNCTION = '''
+CREATE FUNCTION bhr_block_metrics(active_entries integer, unblock_at timestamptz, forced_unblock boolean,
+                                  at timestamptz) RETURNS SETOF varchar AS $$
+    SELECT v.metric FROM (VALUES
+        ('expected', NOT (forced_unblock OR coalesce(unblock_at <= at, false))),
+        ('current', active_entries > 0),
+        ('block_pending', NOT (forced_unblock OR coalesce(unblock_at <= at, false)) AND active_entries = 0),
+        ('unblock_pending', active_entries > 0 AND coalesce(unblock_at <= at, false))
+    ) AS v(metric, hit) WHERE v.hit
+$$ LANGUAGE sql IMMUTABLE'''
+
+# Applies the change in the contribution of the modified blocks to the
+# counters, evaluated at swept_until.  The shared advisory lock keeps
+# sweep_stats from moving swept_until until the transaction commits.
+STATS_TRIGGER_FUNCTION = '''
+CREATE FUNCTION bhr_block_stats() RETURNS trigger AS $$
+    DECLARE
+        at timestamptz;
+    BEGIN
+        PERFORM pg_advisory_xact_lock_shared(4343890, -1);
+        SELECT swept_until INTO at FROM bhr_statsweep WHERE name = 'blocks';
+        IF NOT FOUND THEN
+            at := now();
+            INSERT INTO bhr_statsweep (name, swept_until) VALUES ('blocks', at) ON CONFLICT DO NOTHING;
+        END IF;
+
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bhr_statcounter (metric, source, value)
+            SELECT m.metric, b.source, count(*) FROM new_rows b,
+                bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2 ORDER BY 1, 2
+            ON CONFLICT (metric, source) DO UPDATE SET value = bhr_statcounter.value + EXCLUDED.value;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO bhr_statcounter (metric, source, value)
+            SELECT m.metric, b.source, sum(b.sign) FROM (
+                SELECT source, active_entries, unblock_at, forced_unblock, 1 AS sign FROM new_rows
+                UNION ALL
+                SELECT source, active_entries, unblock_at, forced_unblock, -1 AS sign FROM old_rows
+            ) b, bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2 HAVING sum(b.sign) <> 0 ORDER BY 1, 2
+            ON CONFLICT (metric, source) DO UPDATE SET value = bhr_statcounter.value + EXCLUDED.value;
+        ELSE
+            INSERT INTO bhr_statcounter (metric, source, value)
+            SELECT m.metric, b.source, -count(*) FROM old_rows b,
+                bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2 ORDER BY 1, 2
+            ON CONFLICT (metric, source) DO UPDATE SET value = bhr_statcounter.value + EXCLUDED.value;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql'''
+
+BACKFILL = '''
+INSERT INTO bhr_statsweep (name, swept_until) VALUES ('blocks', now());
+INSERT INTO bhr_statcounter (metric, source, value)
+SELECT m.metric, b.source, count(*) FROM bhr_block b,
+    bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, now()) AS m(metric)
+GROUP BY 1, 2'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0017_block_active_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=20)),
+                ('source', models.CharField(max_length=30)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('metric', 'source')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StatSweep',
+            fields=[
+                ('name', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('swept_until', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunSQL(BLOCK_METRICS_FUNCTION,
+                          'DROP FUNCTION bhr_block_metrics(integer, timestamptz, boolean, timestamptz)'),
+        migrations.RunSQL(STATS_TRIGGER_FUNCTION, 'DROP FUNCTION bhr_block_stats()'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_stats_insert AFTER INSERT ON bhr_block
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_stats()''',
+                          'DROP TRIGGER bhr_block_stats_insert ON bhr_block'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_stats_update AFTER UPDATE ON bhr_block
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_stats()''',
+                          'DROP TRIGGER bhr_block_stats_update ON bhr_block'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_stats_delete AFTER DELETE ON bhr_block
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_stats()''',
+                          'DROP TRIGGER bhr_block_stats_delete ON bhr_block'),
+        migrations.RunSQL(BACKFILL, 'DELETE FROM bhr_statcounter; DELETE FROM bhr_statsweep'),
+    ]
@@ -0,0 +1,28 @@
+import warnings
+
+from django.db import migrations
+
+
+def create_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as c:
+        c.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if c.fetchone() is None:
+            warnings.warn("The pg_trgm extension is not available, history searches will scan every block. "
+                          "Install the postgresql contrib modules, then migrate bhr back to 0018 and forward again.")
+            return
+        c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        c.execute("CREATE INDEX IF NOT EXISTS bhr_block_why_trgm ON bhr_block USING gin (why gin_trgm_ops)")
+        c.execute("CREATE INDEX IF NOT EXISTS bhr_block_source_trgm ON bhr_block USING gin (source gin_trgm_ops)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0018_statcounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, migrations.RunPython.noop),
+        migrations.RunSQL(migrations.RunSQL.noop,
+                          'DROP INDEX IF EXISTS bhr_block_why_trgm; DROP INDEX IF EXISTS bhr_block_source_trgm'),
+    ]
@@ -0,0 +1,13 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0019_block_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL('create index bhr_block_cidr_gist on bhr_block using gist (cidr inet_ops)',
+                          'drop index bhr_block_cidr_gist'),
+    ]
@@ -0,0 +1,84 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import netfields.fields
+
+# Rebuilds the summaries of the given cidrs from their blocks
+RECOMPUTE_FUNCTION = '''
+CREATE FUNCTION bhr_offenders_recompute(cidrs cidr[]) RETURNS void AS $$
+    DELETE FROM bhr_offendersummary WHERE cidr = ANY(cidrs);
+    INSERT INTO bhr_offendersummary (cidr, last_block_id, added, unblock_at, block_count)
+    SELECT DISTINCT ON (cidr) cidr, id, added, unblock_at, count(*) OVER (PARTITION BY cidr)
+    FROM bhr_block WHERE cidr = ANY(cidrs)
+    ORDER BY cidr, added DESC, id DESC;
+$$ LANGUAGE sql'''
+
+# New blocks are counted and become the last block of their cidr.  Updates
+# only copy unblock_at from the last block, extends and unblocks change it,
+# blocks that moved to another cidr or time are recomputed like deletes.
+OFFENDERS_TRIGGER_FUNCTION = '''
+CREATE FUNCTION bhr_block_offenders() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bhr_offendersummary AS s (cidr, last_block_id, added, unblock_at, block_count)
+            SELECT DISTINCT ON (cidr) cidr, id, added, unblock_at, count(*) OVER (PARTITION BY cidr)
+            FROM new_rows ORDER BY cidr, added DESC, id DESC
+            ON CONFLICT (cidr) DO UPDATE SET
+                block_count = s.block_count + EXCLUDED.block_count,
+                last_block_id = CASE WHEN (EXCLUDED.added, EXCLUDED.last_block_id) > (s.added, s.last_block_id)
+                                     THEN EXCLUDED.last_block_id ELSE s.last_block_id END,
+                unblock_at = CASE WHEN (EXCLUDED.added, EXCLUDED.last_block_id) > (s.added, s.last_block_id)
+                                  THEN EXCLUDED.unblock_at ELSE s.unblock_at END,
+                added = greatest(EXCLUDED.added, s.added);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM bhr_offenders_recompute(ARRAY(
+                SELECT c.cidr FROM new_rows n JOIN old_rows o ON o.id = n.id,
+                    LATERAL (VALUES (n.cidr), (o.cidr)) AS c(cidr)
+                WHERE n.cidr <> o.cidr OR n.added <> o.added));
+            UPDATE bhr_offendersummary s SET unblock_at = n.unblock_at
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE s.last_block_id = n.id AND n.unblock_at IS DISTINCT FROM o.unblock_at;
+        ELSE
+            PERFORM bhr_offenders_recompute(ARRAY(SELECT DISTINCT cidr FROM old_rows));
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql'''
+
+BACKFILL = '''
+INSERT INTO bhr_offendersummary (cidr, last_block_id, added, unblock_at, block_count)
+SELECT DISTINCT ON (cidr) cidr, id, added, unblock_at, count(*) OVER (PARTITION BY cidr)
+FROM bhr_block ORDER BY cidr, added DESC, id DESC'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0020_block_cidr_gist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OffenderSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cidr', netfields.fields.CidrAddressField(max_length=43, unique=True)),
+                ('added', models.DateTimeField()),
+                ('unblock_at', models.DateTimeField(null=True)),
+                ('block_count', models.PositiveIntegerField(default=0)),
+                ('last_block', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING,
+                                                 related_name='+', to='bhr.Block')),
+            ],
+        ),
+        migrations.RunSQL(RECOMPUTE_FUNCTION, 'DROP FUNCTION bhr_offenders_recompute(cidr[])'),
+        migrations.RunSQL(OFFENDERS_TRIGGER_FUNCTION, 'DROP FUNCTION bhr_block_offenders()'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_offenders_insert AFTER INSERT ON bhr_block
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_offenders()''',
+                          'DROP TRIGGER bhr_block_offenders_insert ON bhr_block'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_offenders_update AFTER UPDATE ON bhr_block
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_offenders()''',
+                          'DROP TRIGGER bhr_block_offenders_update ON bhr_block'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_block_offenders_delete AFTER DELETE ON bhr_block
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_block_offenders()''',
+                          'DROP TRIGGER bhr_block_offenders_delete ON bhr_block'),
+        migrations.RunSQL(BACKFILL, 'DELETE FROM bhr_offendersummary'),
+    ]
@@ -0,0 +1,66 @@
+from django.db import migrations
+
+# Applies the change in the number of entries that are not removed to their
+# blocks, however the entries are written.  The blocks are locked in id order
+# so that concurrent acks for overlapping blocks can not deadlock.
+COUNT_FUNCTION = '''
+CREATE FUNCTION bhr_block_count_entries(added integer[], removed integer[]) RETURNS void AS $$
+    WITH delta AS (
+        SELECT block_id, sum(d) AS d FROM (
+            SELECT unnest(added) AS block_id, 1 AS d
+            UNION ALL
+            SELECT unnest(removed), -1
+        ) c GROUP BY block_id HAVING sum(d) <> 0
+    ), locked AS (
+        SELECT b.id FROM bhr_block b JOIN delta ON delta.block_id = b.id ORDER BY b.id FOR UPDATE OF b
+    )
+    UPDATE bhr_block b SET active_entries = b.active_entries + delta.d
+    FROM delta JOIN locked ON locked.id = delta.block_id
+    WHERE b.id = delta.block_id
+$$ LANGUAGE sql'''
+
+ACTIVE_ENTRIES_TRIGGER_FUNCTION = '''
+CREATE FUNCTION bhr_blockentry_active() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM bhr_block_count_entries(ARRAY(SELECT block_id FROM new_rows WHERE removed IS NULL),
+                                            ARRAY[]::integer[]);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM bhr_block_count_entries(ARRAY(SELECT block_id FROM new_rows WHERE removed IS NULL),
+                                            ARRAY(SELECT block_id FROM old_rows WHERE removed IS NULL));
+        ELSE
+            PERFORM bhr_block_count_entries(ARRAY[]::integer[],
+                                            ARRAY(SELECT block_id FROM old_rows WHERE removed IS NULL));
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql'''
+
+RECONCILE = '''
+UPDATE bhr_block b SET active_entries = coalesce(c.active, 0)
+FROM bhr_block b2 LEFT JOIN (SELECT block_id, count(*) AS active FROM bhr_blockentry
+                             WHERE removed IS NULL GROUP BY block_id) c ON c.block_id = b2.id
+WHERE b2.id = b.id AND b.active_entries <> coalesce(c.active, 0)'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0021_offendersummary'),
+    ]
+
+    operations = [
+        migrations.RunSQL(COUNT_FUNCTION, 'DROP FUNCTION bhr_block_count_entries(integer[], integer[])'),
+        migrations.RunSQL(ACTIVE_ENTRIES_TRIGGER_FUNCTION, 'DROP FUNCTION bhr_blockentry_active()'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_blockentry_active_insert AFTER INSERT ON bhr_blockentry
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_blockentry_active()''',
+                          'DROP TRIGGER bhr_blockentry_active_insert ON bhr_blockentry'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_blockentry_active_update AFTER UPDATE ON bhr_blockentry
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_blockentry_active()''',
+                          'DROP TRIGGER bhr_blockentry_active_update ON bhr_blockentry'),
+        migrations.RunSQL('''CREATE TRIGGER bhr_blockentry_active_delete AFTER DELETE ON bhr_blockentry
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE bhr_blockentry_active()''',
+                          'DROP TRIGGER bhr_blockentry_active_delete ON bhr_blockentry'),
+        # Counts that drifted while they were kept by the application
+        migrations.RunSQL(RECONCILE, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,80 @@
+from importlib import import_module
+
+from django.db import migrations, models
+
+# Like 0018_statcounter, but the changes are added to a row of the writing
+# transaction instead of the shared counters.  Two transactions updating the
+# counters of the same sources in a different order deadlocked, and busy
+# sources serialized their writers.  sweep_stats folds the rows in.
+STATS_TRIGGER_FUNCTION = '''
+CREATE OR REPLACE FUNCTION bhr_block_stats() RETURNS trigger AS $$
+    DECLARE
+        at timestamptz;
+    BEGIN
+        PERFORM pg_advisory_xact_lock_shared(4343890, -1);
+        SELECT swept_until INTO at FROM bhr_statsweep WHERE name = 'blocks';
+        IF NOT FOUND THEN
+            at := now();
+            INSERT INTO bhr_statsweep (name, swept_until) VALUES ('blocks', at) ON CONFLICT DO NOTHING;
+        END IF;
+
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bhr_statdelta (metric, source, txid, value)
+            SELECT m.metric, b.source, txid_current(), count(*) FROM new_rows b,
+                bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2
+            ON CONFLICT (metric, source, txid) DO UPDATE SET value = bhr_statdelta.value + EXCLUDED.value;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO bhr_statdelta (metric, source, txid, value)
+            SELECT m.metric, b.source, txid_current(), sum(b.sign) FROM (
+                SELECT source, active_entries, unblock_at, forced_unblock, 1 AS sign FROM new_rows
+                UNION ALL
+                SELECT source, active_entries, unblock_at, forced_unblock, -1 AS sign FROM old_rows
+            ) b, bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2 HAVING sum(b.sign) <> 0
+            ON CONFLICT (metric, source, txid) DO UPDATE SET value = bhr_statdelta.value + EXCLUDED.value;
+        ELSE
+            INSERT INTO bhr_statdelta (metric, source, txid, value)
+            SELECT m.metric, b.source, txid_current(), -count(*) FROM old_rows b,
+                bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, at) AS m(metric)
+            GROUP BY 1, 2
+            ON CONFLICT (metric, source, txid) DO UPDATE SET value = bhr_statdelta.value + EXCLUDED.value;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql'''
+
+# Going back restores the function of 0018_statcounter
+OLD_STATS_TRIGGER_FUNCTION = import_module('bhr.migrations.0018_statcounter').STATS_TRIGGER_FUNCTION.replace(
+    'CREATE FUNCTION', 'CREATE OR REPLACE FUNCTION')
+
+FOLD = '''
+INSERT INTO bhr_statcounter (metric, source, value)
+SELECT metric, source, sum(value) FROM bhr_statdelta GROUP BY 1, 2 HAVING sum(value) <> 0
+ON CONFLICT (metric, source) DO UPDATE SET value = bhr_statcounter.value + EXCLUDED.value;
+DELETE FROM bhr_statdelta'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0022_blockentry_active_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=20)),
+                ('source', models.CharField(max_length=30)),
+                ('txid', models.BigIntegerField()),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('metric', 'source', 'txid')},
+            },
+        ),
+        migrations.RunSQL(STATS_TRIGGER_FUNCTION, OLD_STATS_TRIGGER_FUNCTION),
+        migrations.RunSQL(migrations.RunSQL.noop, FOLD),
+    ]
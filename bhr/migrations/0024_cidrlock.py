@@ -0,0 +1,19 @@
+from django.db import migrations, models
+import netfields.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bhr', '0023_statdelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CidrLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cidr', netfields.fields.CidrAddressField(max_length=43, unique=True)),
+            ],
+        ),
+    ]
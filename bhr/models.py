@@ -1,23 +1,29 @@
-from django_pglocks import advisory_lock
-
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models import Q
-from django.db import transaction, connection
+from django.db.models import Case, IntegerField, Q, Value, When, prefetch_related_objects
+from django.db.models.expressions import RawSQL
+from django.db import transaction, connection, OperationalError
+from psycopg2 import errorcodes
 
 from netfields import CidrAddressField
+from array import array
+from contextlib import contextmanager
 import ipaddress
+import select
+import time
 
 from django.utils import timezone
 import datetime
 
 from django.conf import settings
+from django.core.cache import caches
 
 from urllib.parse import quote
 import logging
 
-from bhr.util import expand_time, ip_family
+from bhr.index import IntervalIndex, NetworkIndex
+from bhr.util import expand_time, ip_family, to_network
 
 
 logger = logging.getLogger(__name__)
@@ -35,9 +41,44 @@ class SourceBlacklistedError(Exception):
     pass
 
 
+class SearchTimeoutError(Exception):
+    pass
+
+
+def get_version(name):
+    """Get the current value of a version stamp, 0 if it was never bumped"""
+    return ChangeVersion.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+
+_whitelist_index = NetworkIndex()
+
+
+def get_whitelist_index():
+    """Get the whitelist index for this process, rebuilding it if the whitelist changed"""
+    global _whitelist_index
+    # Read the version before the entries, a change that lands in between
+    # only causes one extra rebuild instead of a stale index.
+    version = get_version('whitelist')
+    if _whitelist_index.version != version:
+        index = NetworkIndex(version)
+        for item in WhitelistEntry.objects.select_related('who').order_by('id'):
+            index.add(item.cidr, item)
+        _whitelist_index = index
+    return _whitelist_index
+
+
 def is_whitelisted(cidr):
+    return get_whitelist_index().find_overlap(cidr) or False
+
+
+def scan_whitelist(cidr):
+    """Check every whitelist entry for overlap with cidr.
+
+    This is the straightforward version of is_whitelisted, it is kept around to
+    check and benchmark the index against.
+    """
     cidr = ipaddress.ip_network(str(cidr))
-    for item in WhitelistEntry.objects.all():
+    for item in WhitelistEntry.objects.order_by('id'):
         if cidr[0] in item.cidr or cidr[-1] in item.cidr:
             return item
         if item.cidr[0] in cidr or item.cidr[-1] in cidr:
@@ -51,8 +92,7 @@ def is_prefixlen_too_small(cidr):
         minimum_prefixlen = settings.BHR.get('minimum_prefixlen', 24)
     else:
         minimum_prefixlen = settings.BHR.get('minimum_prefixlen_v6', 64)
-    cidr = ipaddress.ip_network(str(cidr))
-    return cidr.prefixlen < minimum_prefixlen
+    return to_network(cidr).prefixlen < minimum_prefixlen
 
 
 def is_source_blacklisted(source):
@@ -63,6 +103,148 @@ def is_source_blacklisted(source):
         return False
 
 
+class BlockPolicy(object):
+    """The whitelist, prefix length and source blacklist checks for a batch of blocks.
+
+    The whitelist index and the blacklist entries for the given sources are
+    loaded once, so checking a whole batch costs a constant number of queries.
+    """
+
+    def __init__(self, sources=()):
+        self.whitelist = get_whitelist_index()
+        self.sources = set(sources)
+        self.blacklist = {}
+        for entry in SourceBlacklistEntry.objects.filter(source__in=self.sources).select_related('who'):
+            self.blacklist[entry.source] = entry
+
+    def is_whitelisted(self, cidr):
+        return self.whitelist.find_overlap(cidr) or False
+
+    def is_prefixlen_too_small(self, cidr):
+        return is_prefixlen_too_small(cidr)
+
+    def is_source_blacklisted(self, source):
+        if source not in self.sources:
+            self.sources.add(source)
+            entry = is_source_blacklisted(source)
+            if entry:
+                self.blacklist[source] = entry
+        return self.blacklist.get(source, False)
+
+    def check(self, cidr, source):
+        wle = self.is_whitelisted(cidr)
+        if wle:
+            raise WhitelistError(wle.why)
+        if self.is_prefixlen_too_small(cidr):
+            raise PrefixLenTooSmallError("Prefix length in %s is too small" % cidr)
+        item = self.is_source_blacklisted(source)
+        if item:
+            raise SourceBlacklistedError("Source %s is blacklisted: %s: %s" % (source, item.who, item.why))
+
+    def verdict(self, cidr, source):
+        """Why check() would reject a block as a dict with a status, None if it would not"""
+        wle = self.is_whitelisted(cidr)
+        if wle:
+            return dict(status='whitelisted', whitelist=dict(cidr=str(wle.cidr), who=str(wle.who), why=wle.why))
+        if self.is_prefixlen_too_small(cidr):
+            return dict(status='prefixlen_too_small')
+        item = self.is_source_blacklisted(source)
+        if item:
+            return dict(status='source_blacklisted', blacklist=dict(who=str(item.who), why=item.why))
+        return None
+
+
+class ChangeVersion(models.Model):
+    """Version stamps used to invalidate per-process caches.
+
+    Versions are taken from a database sequence, so a value is never reused
+    even if the transaction that bumped it is rolled back.
+    """
+    name = models.CharField(max_length=30, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    updated = models.DateTimeField('date updated', auto_now=True)
+
+
+class CidrLock(models.Model):
+    """A row for every cidr that was ever blocked, locked by lock_cidrs"""
+    cidr = CidrAddressField(unique=True)
+
+
+# The advisory lock that keeps sweep_stats and block changes apart, the
+# bhr_block_stats trigger takes it in shared mode.
+CIDR_LOCK_NAMESPACE = 0x424852
+STATS_LOCK_KEY = -1
+
+
+def lock_cidrs(cidrs):
+    """Serialize block changes for these cidrs until the current transaction ends.
+
+    Locks a bhr_cidrlock row per cidr, adding the rows of new cidrs, so only
+    changes to the same cidrs wait on each other and a large batch does not
+    use up the lock table.  The rows are taken in cidr order so that two
+    transactions locking overlapping sets of cidrs can not deadlock.
+    """
+    cidrs = sorted(set(str(to_network(cidr, strict=False)) for cidr in cidrs))
+    with connection.cursor() as c:
+        # DO UPDATE locks the existing rows even though the WHERE never updates them
+        c.execute("""INSERT INTO bhr_cidrlock (cidr) SELECT cidr FROM unnest(%s::cidr[]) AS c(cidr) ORDER BY cidr
+                     ON CONFLICT (cidr) DO UPDATE SET cidr = EXCLUDED.cidr WHERE false""", [cidrs])
+
+
+# Notified when blocks are added, extended or unblocked
+BLOCK_CHANNEL = 'bhr_blocks'
+
+
+def notify_blocks_changed():
+    """Wake up anything listening for block changes once the current transaction commits"""
+    with connection.cursor() as c:
+        c.execute("SELECT pg_notify(%s, '')", [BLOCK_CHANNEL])
+
+
+class BlockChangeListener(object):
+    """Wait for block changes using LISTEN/NOTIFY.
+
+    Use as a context manager and call wait() between checks for new work, the
+    LISTEN happens on entry so changes made while checking are not missed.
+    Inside a transaction notifications can not be received, wait() then falls
+    back to sleeping for poll_interval.
+    """
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.available = False
+
+    def __enter__(self):
+        self.available = connection.vendor == 'postgresql' and not connection.in_atomic_block
+        if self.available:
+            with connection.cursor() as c:
+                c.execute("LISTEN %s" % BLOCK_CHANNEL)
+        return self
+
+    def __exit__(self, *exc):
+        if self.available and connection.connection is not None:
+            with connection.cursor() as c:
+                c.execute("UNLISTEN %s" % BLOCK_CHANNEL)
+            self.drain()
+
+    def drain(self):
+        pgconn = connection.connection
+        pgconn.poll()
+        received = bool(pgconn.notifies)
+        del pgconn.notifies[:]
+        return received
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a change, returns True if one was seen"""
+        if not self.available:
+            time.sleep(min(timeout, self.poll_interval))
+            return False
+        if self.drain():
+            return True
+        select.select([connection.connection], [], [], timeout)
+        return self.drain()
+
+
 class WhitelistEntry(models.Model):
     cidr = CidrAddressField()
     who = models.ForeignKey(User, on_delete=models.PROTECT)
@@ -79,9 +261,7 @@ class SourceBlacklistEntry(models.Model):
 
 class CurrentBlockManager(models.Manager):
     def get_queryset(self):
-        return super(CurrentBlockManager, self).get_queryset().filter(
-            id__in=BlockEntry.objects.distinct('block_id').filter(removed__isnull=True).values_list('block_id',
-                                                                                                    flat=True))
+        return super(CurrentBlockManager, self).get_queryset().filter(active_entries__gt=0)
 
 
 class ExpectedBlockManager(models.Manager):
@@ -101,17 +281,17 @@ class PendingBlockManager(models.Manager):
             Q(unblock_at__isnull=True)
         ).exclude(
             forced_unblock=True,
-        ).exclude(
-            id__in=BlockEntry.objects.distinct('block_id').filter(removed__isnull=True).values_list('block_id',
-                                                                                                    flat=True)
+        ).filter(
+            active_entries=0,
         )
 
 
 class PendingRemovalBlockManager(models.Manager):
     def get_queryset(self):
+        # block entries share unblock_at with their block
         return super(PendingRemovalBlockManager, self).get_queryset().filter(
-            id__in=BlockEntry.objects.distinct('block_id').filter(removed__isnull=True, unblock_at__lte=timezone.now()
-                                                                  ).values_list('block_id', flat=True)
+            active_entries__gt=0,
+            unblock_at__lte=timezone.now(),
         ).order_by('unblock_at')
 
 
@@ -154,6 +334,9 @@ class Block(models.Model):
     unblock_why = models.TextField(blank=True)
     unblock_who = models.ForeignKey(User, on_delete=models.PROTECT, related_name='+', null=True, blank=True)
 
+    # Denormalized number of block entries that are not removed, maintained by a trigger on bhr_blockentry
+    active_entries = models.PositiveIntegerField(default=0, editable=False)
+
     objects = models.Manager()
     current = CurrentBlockManager()
     expected = ExpectedBlockManager()
@@ -163,15 +346,38 @@ class Block(models.Model):
 
     def save(self, *args, **kwargs):
         if self.skip_whitelist is False and self.forced_unblock is False:
-            wle = is_whitelisted(self.cidr)
-            if wle:
-                raise WhitelistError(wle.why)
-            if is_prefixlen_too_small(self.cidr):
-                raise PrefixLenTooSmallError("Prefix length in %s is too small" % self.cidr)
-            item = is_source_blacklisted(self.source)
-            if item:
-                raise SourceBlacklistedError("Source %s is blacklisted: %s: %s" % (self.source, item.who, item.why))
-        super(Block, self).save(*args, **kwargs)
+            BlockPolicy([self.source]).check(self.cidr, self.source)
+        created = self.pk is None
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            # active_entries is kept by a trigger on bhr_blockentry, writing back
+            # the copy loaded with this block would undo acks made since
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != 'active_entries']
+        with block_change_atomic():
+            old = None
+            if not created:
+                old = Block.objects.filter(pk=self.pk).values('cidr', 'unblock_at', 'forced_unblock').first()
+                invalidate_dupe_cache([self.cidr] + ([old['cidr']] if old else []))
+            super(Block, self).save(*args, **kwargs)
+            change = CHANGE_ADD if old is None else self._change_kind(old)
+            if change:
+                record_block_changes([(self.pk, change)])
+
+    def _change_kind(self, old):
+        """The kind of change an update from the old cidr, unblock_at and forced_unblock made, or None"""
+        now = timezone.now()
+
+        def expected(forced_unblock, unblock_at):
+            return not forced_unblock and (unblock_at is None or unblock_at > now)
+
+        was_expected = expected(old['forced_unblock'], old['unblock_at'])
+        if not expected(self.forced_unblock, self.unblock_at):
+            return CHANGE_UNBLOCK if was_expected else None
+        if not was_expected or to_network(self.cidr, strict=False) != to_network(old['cidr'], strict=False):
+            return CHANGE_ADD
+        if self.unblock_at != old['unblock_at']:
+            return CHANGE_EXTEND
+        return None
 
     @property
     def is_unblockable(self):
@@ -208,8 +414,99 @@ class Block(models.Model):
         self.unblock_why = why
         now = timezone.now()
         self.unblock_at = now
-        BlockEntry.objects.filter(block_id=self.id).update(unblock_at=now)
-        self.save()
+        with block_change_atomic():
+            invalidate_dupe_cache([self.cidr])
+            BlockEntry.objects.filter(block_id=self.id).update(unblock_at=now)
+            # logs the unblock
+            self.save()
+
+
+@contextmanager
+def outer_atomic_blocks_allowed(depth):
+    """Let block changes run inside depth more atomic blocks opened by the caller.
+
+    For callers that commit right after the change, like the admin change
+    form, and for tests and benchmarks that roll everything back.  Nested
+    allowances add up.
+    """
+    previous = getattr(connection, 'bhr_outer_atomic_blocks', 0)
+    connection.bhr_outer_atomic_blocks = previous + depth
+    try:
+        yield
+    finally:
+        connection.bhr_outer_atomic_blocks = previous
+
+
+@contextmanager
+def block_change_atomic():
+    """transaction.atomic for a change to blocks.
+
+    Refuses to run inside a transaction opened by the caller, unless allowed
+    by outer_atomic_blocks_allowed: the change would hold the lock taken by
+    record_block_changes until the caller commits.  Block changes nested in
+    another one are not checked again.
+    """
+    if getattr(connection, 'bhr_in_block_change', False):
+        with transaction.atomic():
+            yield
+        return
+    depth = len(connection.savepoint_ids) + connection.in_atomic_block
+    if depth > getattr(connection, 'bhr_outer_atomic_blocks', 0):
+        raise transaction.TransactionManagementError(
+            "Block changes must not run inside another transaction, it would hold the block change lock")
+    connection.bhr_in_block_change = True
+    try:
+        with transaction.atomic():
+            yield
+    finally:
+        connection.bhr_in_block_change = False
+
+
+CHANGE_ADD = "A"
+CHANGE_EXTEND = "E"
+CHANGE_UNBLOCK = "U"
+
+
+class BlockChange(models.Model):
+    """Log of changes to the set of expected blocks.
+
+    Rows are only ever added by record_block_changes, which makes sure that ids
+    become visible in order: once a change is visible, every change with a
+    lower id is too.  That makes the id usable as a cursor by clients.
+    """
+
+    CHANGE_KINDS = (
+        (CHANGE_ADD, 'Added'),
+        (CHANGE_EXTEND, 'Extended'),
+        (CHANGE_UNBLOCK, 'Unblocked'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    block = models.ForeignKey(Block, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=CHANGE_KINDS)
+    added = models.DateTimeField('date added', auto_now_add=True)
+
+
+def record_block_changes(changes):
+    """Log (block id, kind) changes to blocks and notify listeners.
+
+    This must be the last thing done in a transaction.  Bumping the blocks
+    version locks its row until commit, so change ids are handed out in
+    commit order, but every other block change waits for that commit.
+    Anything slow done after this, or by a caller that wraps the change in a
+    transaction of its own, stalls all block writers.
+    """
+    if not changes:
+        return
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute("""INSERT INTO bhr_changeversion (name, version, updated)
+            VALUES ('blocks', nextval('bhr_changeversion_seq'), now())
+            ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version, updated = EXCLUDED.updated""")
+        block_ids, kinds = zip(*changes)
+        c.execute("""INSERT INTO bhr_blockchange (block_id, kind, added)
+            SELECT block_id, kind, now() FROM unnest(%s::integer[], %s::varchar[]) AS c(block_id, kind)""",
+                  [list(block_ids), list(kinds)])
+        notify_blocks_changed()
 
 
 class BlockEntry(models.Model):
@@ -231,7 +528,234 @@ class BlockEntry(models.Model):
 
     @classmethod
     def set_unblocked_by_id(self, id):
-        BlockEntry.objects.filter(pk=id).update(removed=timezone.now())
+        """Mark the entry as removed, returns False if it already was"""
+        with transaction.atomic():
+            entry = BlockEntry.objects.filter(pk=id, removed__isnull=True)
+            block_id = entry.values_list('block_id', flat=True).first()
+            if block_id is None or not entry.update(removed=timezone.now()):
+                return False
+        return True
+
+
+LEASE_BLOCK = "B"
+LEASE_UNBLOCK = "U"
+
+# Per id results of set_blocked_multi and set_unblocked_multi
+ACK_OK = "ok"
+ACK_ALREADY = "already-acked"
+ACK_UNKNOWN = "unknown"
+
+
+class QueueLease(models.Model):
+    """A claim by one of the workers of an ident on a queued block or unblock"""
+
+    LEASE_KINDS = (
+        (LEASE_BLOCK, 'Block'),
+        (LEASE_UNBLOCK, 'Unblock'),
+    )
+
+    ident = models.CharField("blocker ident", max_length=50)
+    block = models.ForeignKey(Block, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=LEASE_KINDS)
+    expires = models.DateTimeField('lease expires')
+
+    class Meta:
+        unique_together = ('ident', 'block', 'kind')
+
+
+STAT_METRICS = ('block_pending', 'unblock_pending', 'current', 'expected')
+
+
+class StatCounter(models.Model):
+    """Number of blocks per source counted in each of STAT_METRICS.
+
+    Counted as of StatSweep.swept_until.  Changes to the blocks since the
+    last sweep are in StatDelta, and blocks that expired since then are
+    folded in by BHRDB.stats and BHRDB.sweep_stats.
+    """
+    metric = models.CharField(max_length=20)
+    source = models.CharField(max_length=30)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('metric', 'source')
+
+
+class StatDelta(models.Model):
+    """Change to a StatCounter made by one transaction.
+
+    Written by triggers on bhr_block, see migrations 0018_statcounter and
+    0023_statdelta.  Every transaction only touches its own rows, so block
+    writers never wait on each other for the counters.
+    """
+    metric = models.CharField(max_length=20)
+    source = models.CharField(max_length=30)
+    txid = models.BigIntegerField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('metric', 'source', 'txid')
+
+
+class OffenderSummary(models.Model):
+    """The last block of each cidr and how many blocks the cidr had.
+
+    Maintained by triggers on bhr_block, see migration 0021_offendersummary,
+    so that autoscaling does not sort the whole history of repeat offenders.
+    """
+    cidr = CidrAddressField(unique=True)
+    last_block = models.ForeignKey(Block, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    added = models.DateTimeField()
+    unblock_at = models.DateTimeField(null=True)
+    block_count = models.PositiveIntegerField(default=0)
+
+    @property
+    def duration(self):
+        """The duration of the last block, like Block.duration"""
+        if self.unblock_at is None:
+            return None
+        return self.unblock_at - self.added
+
+    @property
+    def age(self):
+        """The age of the last block, like Block.age"""
+        if self.unblock_at is None:
+            return None
+        return timezone.now() - self.unblock_at
+
+
+class StatSweep(models.Model):
+    """The point in time the stat counters are evaluated at"""
+    name = models.CharField(max_length=30, primary_key=True)
+    swept_until = models.DateTimeField()
+
+
+# Change in the counters for the blocks that expired between start and end
+STATS_WINDOW_SQL = """
+    SELECT m.metric, b.source, sum(t.sign) AS delta FROM bhr_block b
+    CROSS JOIN (VALUES (1, {end}::timestamptz), (-1, {start}::timestamptz)) AS t(sign, at)
+    CROSS JOIN LATERAL bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, t.at) AS m(metric)
+    WHERE b.unblock_at > {start} AND b.unblock_at <= {end}
+    GROUP BY 1, 2 HAVING sum(t.sign) <> 0"""
+
+
+class DupeCache(object):
+    """Recently seen expected blocks by cidr, to answer duplicate blocks without a transaction.
+
+    Enabled by naming a cache in BHR['dupe_cache'], which has to be shared by
+    every process (memcached, redis or the database cache) for unblocks in
+    one process to reach the others.  Entries are only written for committed
+    blocks while add_block_multi holds the cidr lock, and every other change
+    to a block deletes them under the same lock with invalidate_dupe_cache,
+    so an entry is never older than the block it describes.  Expiry is
+    checked against the cached unblock_at.
+    """
+    prefix = 'bhr:dupe:'
+    fields = ('id', 'cidr', 'who_id', 'source', 'why', 'added', 'unblock_at', 'flag', 'skip_whitelist')
+
+    def __init__(self):
+        alias = settings.BHR.get('dupe_cache')
+        self.cache = caches[alias] if alias else None
+        self.ttl = settings.BHR.get('dupe_cache_ttl', 60)
+
+    def __bool__(self):
+        return self.cache is not None
+
+    def key(self, cidr):
+        return self.prefix + str(to_network(cidr, strict=False))
+
+    def get_many(self, networks):
+        """Get the cached blocks by network, as unsaved Block instances"""
+        keys = {self.key(n): n for n in networks}
+        found = {}
+        for key, (values, username) in self.cache.get_many(list(keys)).items():
+            b = Block(who=User(id=values['who_id'], username=username), **values)
+            b._state.adding = False
+            found[keys[key]] = b
+        return found
+
+    def set_many(self, blocks):
+        entries = {}
+        for b in blocks:
+            values = {f: getattr(b, f) for f in self.fields}
+            values['cidr'] = str(values['cidr'])
+            entries[self.key(b.cidr)] = (values, b.who.username)
+        if entries:
+            self.cache.set_many(entries, timeout=self.ttl)
+
+    def delete_many(self, cidrs):
+        self.cache.delete_many([self.key(cidr) for cidr in cidrs])
+
+    def count(self, hits=0, misses=0):
+        for name, value in ('hits', hits), ('misses', misses):
+            if value:
+                key = self.prefix + name
+                self.cache.add(key, 0, timeout=None)
+                try:
+                    self.cache.incr(key, value)
+                except ValueError:  # evicted in between
+                    self.cache.set(key, value, timeout=None)
+
+    def stats(self):
+        """Get the shared hit and miss counters"""
+        counters = self.cache.get_many([self.prefix + 'hits', self.prefix + 'misses'])
+        return {name: counters.get(self.prefix + name, 0) for name in ('hits', 'misses')}
+
+
+DEDUPE_DUPE = "dupe"
+DEDUPE_RECORD = "record"
+
+
+def invalidate_dupe_cache(cidrs):
+    """Drop the cached blocks of cidrs before they are changed in the current transaction.
+
+    Holds the cidr locks until commit, so add_block_multi can not cache the
+    old blocks again in the meantime.  Does nothing if the cache is disabled.
+    """
+    dupe_cache = DupeCache()
+    if dupe_cache:
+        cidrs = list(cidrs)
+        lock_cidrs(cidrs)
+        dupe_cache.delete_many(cidrs)
+
+
+def get_dedupe_mode(source):
+    """How blocks from source inside a longer lasting covering block are handled, None to block them anyway"""
+    return settings.BHR.get('covering_dedupe', {}).get(source)
+
+
+def outlasts(block_unblock_at, unblock_at):
+    """Does a block until block_unblock_at last at least until unblock_at, None being forever"""
+    return block_unblock_at is None or (unblock_at is not None and unblock_at <= block_unblock_at)
+
+
+def supernets(network):
+    """The networks strictly containing network, most specific first"""
+    for prefixlen in range(network.prefixlen - 1, -1, -1):
+        yield network.supernet(new_prefix=prefixlen)
+
+
+# Uses the bhr_block_cidr_gist index
+COVERING_BLOCKS_SQL = """
+    SELECT b.id, b.cidr, u.username AS who__username, b.source, b.why, b.added, b.unblock_at, b.skip_whitelist
+    FROM bhr_block b JOIN auth_user u ON u.id = b.who_id
+    WHERE
+        b.cidr >>= %s
+    AND
+        (b.unblock_at IS NULL OR b.unblock_at > %s)
+    AND
+        b.forced_unblock IS false
+    ORDER BY masklen(b.cidr) DESC, b.added DESC"""
+
+BATCH_COVERING_BLOCKS_SQL = """
+    SELECT DISTINCT ON (r.cidr) b.*, r.cidr AS covered
+    FROM unnest(%s::cidr[]) AS r(cidr)
+    JOIN bhr_block b ON b.cidr >> r.cidr
+    WHERE
+        (b.unblock_at IS NULL OR b.unblock_at > %s)
+    AND
+        b.forced_unblock IS false
+    ORDER BY r.cidr, b.unblock_at DESC NULLS FIRST, b.added DESC"""
 
 
 class BHRDB(object):
@@ -259,7 +783,8 @@ class BHRDB(object):
 
     def get_last_block(self, cidr):
         """Get most recent block record"""
-        return Block.objects.filter(cidr=cidr).order_by('-added').first()
+        summary = OffenderSummary.objects.filter(cidr=cidr).select_related('last_block').first()
+        return summary.last_block if summary else None
 
     def get_last_block_duration(self, cidr):
         """Get most recent block record duration"""
@@ -286,64 +811,276 @@ class BHRDB(object):
         # regular repeat offender
         return duration/return_to_base_factor
 
+    def get_blocks(self, cidrs):
+        """Get the existing block records for many cidrs at once, keyed by network"""
+        blocks = Block.expected.filter(cidr__in=cidrs).order_by('cidr', '-added').distinct('cidr').select_related('who')
+        return {b.cidr: b for b in blocks}
+
+    def get_covering_blocks(self, networks):
+        """Get the longest lasting expected block strictly containing each network, keyed by network"""
+        blocks = Block.objects.raw(BATCH_COVERING_BLOCKS_SQL, [[str(n) for n in networks], timezone.now()])
+        return {to_network(b.covered): b for b in blocks}
+
+    def get_last_blocks(self, cidrs):
+        """Get the offender summaries of many cidrs at once, keyed by network.
+
+        They have the duration and age of the most recent block of the cidr,
+        which is all autoscale_duration needs.
+        """
+        return {s.cidr: s for s in OffenderSummary.objects.filter(cidr__in=cidrs)}
+
+    def autoscale_duration(self, duration, last_block):
+        """Scale a requested block duration based on the last block of the same cidr"""
+        if not last_block or not last_block.duration:
+            return duration
+        last_duration = last_block.duration.total_seconds() or duration
+        scaled_duration = max(duration, self.scale_duration(last_block.age.total_seconds(), last_duration))
+        logger.info("Scaled duration from %d to %d", duration, scaled_duration)
+        return scaled_duration
+
     def add_block_multi(self, who, blocks):
-        created = []
-        with advisory_lock("add_block"), transaction.atomic():
-            for block in blocks:
-                b = self.add_block(who=who, **block)
+        """Add many blocks using a constant number of queries.
+
+        The result is the same as calling add_block for each entry in order,
+        including entries for the same cidr later in the batch seeing the
+        blocks created or extended earlier in the batch.
+        """
+        now = timezone.now()
+        requests = []
+        for block in blocks:
+            request = dict(duration=None, unblock_at=None, skip_whitelist=False, extend=True, autoscale=False)
+            request.update(block)
+            if request['duration']:
+                request['duration'] = expand_time(request['duration'])
+            if request['duration'] and not request['unblock_at']:
+                request['unblock_at'] = now + datetime.timedelta(seconds=request['duration'])
+            request['network'] = to_network(request['cidr'], strict=False)
+            requests.append(request)
+
+        if not requests:
+            return []
+
+        dupe_cache = DupeCache()
+        if dupe_cache:
+            cached = dupe_cache.get_many(r['network'] for r in requests)
+            dupes = [self._cached_dupe(r, cached.get(r['network']), now) for r in requests]
+            if all(dupes):
+                dupe_cache.count(hits=len(dupes))
+                for r in requests:
+                    logger.info('DUPE IP=%s', r['cidr'])
+                return dupes
+            hits = sum(1 for d in dupes if d)
+            dupe_cache.count(hits=hits, misses=len(requests) - hits)
+
+        cidrs = [r['cidr'] for r in requests]
+        with block_change_atomic():
+            lock_cidrs(r['network'] for r in requests)
+            policy = BlockPolicy(r['source'] for r in requests if not r['skip_whitelist'])
+            existing = self.get_blocks(cidrs)
+            last_blocks = {}
+            if any(r['duration'] and r['autoscale'] for r in requests):
+                last_blocks = self.get_last_blocks(cidrs)
+            dedupe_modes = {r['source']: get_dedupe_mode(r['source']) for r in requests}
+            covering_blocks = {}
+            if any(dedupe_modes.values()):
+                covering_blocks = self.get_covering_blocks(
+                    r['network'] for r in requests if dedupe_modes[r['source']] and r['network'] not in existing)
+
+            result = []
+            created = []
+            recorded = []
+            extended = {}
+            dupes = []
+            for r in requests:
+                cidr, network, unblock_at, duration = r['cidr'], r['network'], r['unblock_at'], r['duration']
+                b = existing.get(network)
+                if b:
+                    if r['extend'] is False or b.unblock_at is None or (unblock_at and unblock_at <= b.unblock_at):
+                        logger.info('DUPE IP=%s', cidr)
+                        if b.pk:
+                            dupes.append(b)
+                        result.append(b)
+                        continue
+                    if not b.skip_whitelist:
+                        policy.check(b.cidr, b.source)
+                    b.unblock_at = unblock_at
+                    if b.pk:
+                        extended[b.pk] = b
+                    logger.info('EXTEND IP=%s time extended UNTIL=%s DURATION=%s', cidr, unblock_at, duration)
+                    result.append(b)
+                    continue
+
+                if duration and r['autoscale']:
+                    scaled_duration = self.autoscale_duration(duration, last_blocks.get(network))
+                    if scaled_duration != duration:
+                        duration = scaled_duration
+                        unblock_at = now + datetime.timedelta(seconds=duration)
+
+                if not r['skip_whitelist']:
+                    policy.check(network, r['source'])
+
+                mode = dedupe_modes[r['source']]
+                covering = None
+                if mode:
+                    covering = self._find_covering(network, unblock_at, covering_blocks,
+                                                   existing if created or extended else {}, extended)
+                if covering and mode == DEDUPE_DUPE:
+                    logger.info('DUPE IP=%s covered by %s', cidr, covering.cidr)
+                    result.append(covering)
+                    continue
+                if covering:
+                    # Keep the request in the history without giving the backends anything to do
+                    b = Block(cidr=cidr, who=who, source=r['source'], why=r['why'], added=now, unblock_at=unblock_at,
+                              skip_whitelist=r['skip_whitelist'], forced_unblock=True, unblock_who=who,
+                              unblock_why="Covered by %s" % covering.cidr)
+                    recorded.append(b)
+                    logger.info('RECORD IP=%s covered by %s', cidr, covering.cidr)
+                    result.append(b)
+                    continue
+
+                b = Block(cidr=cidr, who=who, source=r['source'], why=r['why'], added=now, unblock_at=unblock_at,
+                          skip_whitelist=r['skip_whitelist'])
                 created.append(b)
-        return created
+                last_blocks[network] = b
+                if b.is_unblockable:
+                    existing[network] = b
+
+                quoted_why = quote(r['why'].encode('ascii', 'ignore'))
+                logger.info('BLOCK IP=%s WHO=%s SOURCE=%s WHY=%s UNTIL="%s" DURATION=%s', cidr, who, r['source'],
+                            quoted_why, unblock_at, duration)
+                result.append(b)
+
+            if extended:
+                self._extend_blocks(extended.values())
+
+            if created:
+                # It is possible that a block is added, and then after it expires,
+                # but before it is unblocked, a new block is added for that entry.
+                # In that case, allow the new block
+                # (since we don't know if a backend may have already unblocked the old one)
+                # but set the old record as already unblocked.
+                # This should prevent a "block,block,unblock" timeline that results in the address
+                # ending up not actually blocked.
+                cidrs = [b.cidr for b in created]
+                BlockEntry.objects.filter(removed__isnull=True, block__cidr__in=cidrs).update(removed=now)
+                Block.objects.bulk_create(created)
+
+            if recorded:
+                Block.objects.bulk_create(recorded)
+
+            if dupe_cache:
+                dupe_cache.delete_many(b.cidr for b in extended.values())
+                dupe_cache.set_many(b for b in dupes if b.pk not in extended)
+
+            record_block_changes([(pk, CHANGE_EXTEND) for pk in extended] +
+                                 [(b.pk, CHANGE_ADD) for b in created])
+
+        return result
+
+    def _cached_dupe(self, request, b, now):
+        """The cached block if the request would be a DUPE of it, else None"""
+        if b is None or (b.unblock_at is not None and b.unblock_at <= now):
+            return None
+        unblock_at = request['unblock_at']
+        if request['extend'] is False or b.unblock_at is None or (unblock_at and unblock_at <= b.unblock_at):
+            return b
+        return None
+
+    def _find_covering(self, network, unblock_at, covering_blocks, batch_blocks, extended):
+        """Find a block containing network that lasts until unblock_at.
+
+        covering_blocks is from get_covering_blocks, batch_blocks are the
+        blocks by network of the batch so far, searched by walking the
+        supernets of network.
+        """
+        b = covering_blocks.get(network)
+        if b is not None:
+            b = extended.get(b.pk, b)
+            if outlasts(b.unblock_at, unblock_at):
+                return b
+        if batch_blocks:
+            for supernet in supernets(network):
+                b = batch_blocks.get(supernet)
+                if b is not None and outlasts(b.unblock_at, unblock_at):
+                    return b
+        return None
+
+    def _extend_blocks(self, blocks):
+        """Write the new unblock_at of extended blocks to them and their block entries"""
+        ids = [b.pk for b in blocks]
+        unblock_ats = [b.unblock_at for b in blocks]
+        with connection.cursor() as c:
+            c.execute("""
+                WITH extended AS (
+                    SELECT * FROM unnest(%s::integer[], %s::timestamptz[]) AS e(id, unblock_at)
+                ), blocks AS (
+                    UPDATE bhr_block b SET unblock_at = e.unblock_at FROM extended e WHERE b.id = e.id
+                )
+                UPDATE bhr_blockentry be SET unblock_at = e.unblock_at FROM extended e WHERE be.block_id = e.id
+            """, [ids, unblock_ats])
 
     def add_block(self, cidr, who, source, why, duration=None, unblock_at=None,
                   skip_whitelist=False, extend=True, autoscale=False):
+        block = dict(cidr=cidr, source=source, why=why, duration=duration, unblock_at=unblock_at,
+                     skip_whitelist=skip_whitelist, extend=extend, autoscale=autoscale)
+        return self.add_block_multi(who, [block])[0]
+
+    def preflight_blocks(self, source, cidrs, duration=None, unblock_at=None, extend=True):
+        """What add_block_multi would do with blocks of cidrs from source, without doing it.
+
+        Returns a dict for each cidr with its status: whitelisted,
+        prefixlen_too_small or source_blacklisted when the block would be
+        rejected, blocked when it would be a DUPE of the block expiring at
+        unblock_at, extend when that block would be extended, covered or
+        record when the covering_dedupe mode of the source applies, or block.
+        Costs a constant number of queries for the whole batch.
+        """
+        now = timezone.now()
         if duration:
             duration = expand_time(duration)
-
-        now = timezone.now()
         if duration and not unblock_at:
             unblock_at = now + datetime.timedelta(seconds=duration)
-
-        with advisory_lock("add_block") as acquired, transaction.atomic():
-            b = self.get_block(cidr)
+        networks = [to_network(cidr, strict=False) for cidr in cidrs]
+        policy = BlockPolicy([source])
+        # Blocks are only changed in memory to plan the rest of the batch
+        existing = self.get_blocks(networks)
+        mode = get_dedupe_mode(source)
+        covering_blocks = {}
+        if mode:
+            covering_blocks = self.get_covering_blocks(n for n in networks if n not in existing)
+
+        result = []
+        planned = False
+        extended = {}
+        for cidr, network in zip(cidrs, networks):
+            b = existing.get(network)
             if b:
                 if extend is False or b.unblock_at is None or (unblock_at and unblock_at <= b.unblock_at):
-                    logger.info('DUPE IP=%s', cidr)
-                    return b
-                b.unblock_at = unblock_at
-                BlockEntry.objects.filter(block_id=b.id).update(unblock_at=unblock_at)
-                logger.info('EXTEND IP=%s time extended UNTIL=%s DURATION=%s', cidr, unblock_at, duration)
-                b.save()
-                return b
-
-            if duration and autoscale:
-                lb = self.get_last_block(cidr)
-                if lb and lb.duration:
-                    last_duration = lb.duration and lb.duration.total_seconds() or duration
-                    scaled_duration = max(duration, self.scale_duration(lb.age.total_seconds(), last_duration))
-                    logger.info("Scaled duration from %d to %d", duration, scaled_duration)
-                    duration = scaled_duration
-                    unblock_at = now + datetime.timedelta(seconds=duration)
-
-            b = Block(cidr=cidr, who=who, source=source, why=why, added=now, unblock_at=unblock_at,
-                      skip_whitelist=skip_whitelist)
-            b.save()
-
-            # It is possible that a block is added, and then after it expires,
-            # but before it is unblocked, a new block is added for that entry.
-            # In that case, allow the new block
-            # (since we don't know if a backend may have already unblocked the old one)
-            # but set the old record as already unblocked.
-            # This should prevent a "block,block,unblock" timeline that results in the address
-            # ending up not actually blocked.
-            pending_unblock_records = BlockEntry.objects.filter(removed__isnull=True, block__cidr=cidr).all()
-            for e in pending_unblock_records:
-                e.set_unblocked()
-                e.save()
-
-        quoted_why = quote(why.encode('ascii', 'ignore'))
-        logger.info('BLOCK IP=%s WHO=%s SOURCE=%s WHY=%s UNTIL="%s" DURATION=%s', cidr, who, source, quoted_why,
-                    unblock_at, duration)
-        return b
+                    verdict = dict(status='blocked', unblock_at=b.unblock_at)
+                else:
+                    verdict = None if b.skip_whitelist else policy.verdict(network, b.source)
+                    if not verdict:
+                        verdict = dict(status='extend', unblock_at=b.unblock_at)
+                        b.unblock_at = unblock_at
+                        extended[b.pk] = b
+                        planned = True
+            else:
+                verdict = policy.verdict(network, source)
+                covering = None
+                if not verdict and mode:
+                    covering = self._find_covering(network, unblock_at, covering_blocks,
+                                                   existing if planned else {}, extended)
+                if covering:
+                    verdict = dict(status='covered' if mode == DEDUPE_DUPE else 'record',
+                                   covering=dict(cidr=str(covering.cidr), unblock_at=covering.unblock_at))
+                elif not verdict:
+                    verdict = dict(status='block')
+                    if unblock_at is None or unblock_at > now:
+                        existing[network] = Block(cidr=network, source=source, unblock_at=unblock_at)
+                        planned = True
+            verdict['cidr'] = cidr
+            result.append(verdict)
+        return result
 
     def unblock_now(self, cidr, who, why):
         b = self.get_block(cidr)
@@ -352,20 +1089,32 @@ class BHRDB(object):
 
         b.unblock_now(who, why)
 
+    def unblock_now_multi(self, block_ids, who, why):
+        """Unblock every block in block_ids now, like Block.unblock_now but with a fixed number of queries"""
+        now = timezone.now()
+        with block_change_atomic():
+            blocks = list(Block.objects.filter(id__in=block_ids).values_list('id', 'cidr'))
+            ids = [id for id, cidr in blocks]
+            invalidate_dupe_cache(cidr for id, cidr in blocks)
+            for id, cidr in blocks:
+                logger.info("UNBLOCK_NOW ID=%s IP=%s", id, cidr)
+            BlockEntry.objects.filter(block_id__in=ids).update(unblock_at=now)
+            Block.objects.filter(id__in=ids).update(forced_unblock=True, unblock_who=who, unblock_why=why,
+                                                    unblock_at=now)
+            record_block_changes([(id, CHANGE_UNBLOCK) for id in ids])
+
     def set_blocked(self, b, ident):
         logger.info("SET_BLOCKED ID=%s IP=%s IDENT=%s", b.id, b.cidr, ident)
         return b.blockentry_set.create(ident=ident, unblock_at=b.unblock_at)
 
     def set_unblocked(self, b, ident):
-        b = b.blockentry_set.get(ident=ident)
-        b.set_unblocked()
-        b.save()
-        logger.info("SET_UNBLOCKED ID=%s IP=%s IDENT=%s", b.block.id, b.block.cidr, ident)
+        entry = b.blockentry_set.get(ident=ident)
+        BlockEntry.set_unblocked_by_id(entry.id)
+        logger.info("SET_UNBLOCKED ID=%s IP=%s IDENT=%s", b.id, b.cidr, ident)
 
     def set_unblocked_by_blockentry_id(self, block_id):
         b = BlockEntry.objects.get(pk=block_id)
-        b.set_unblocked()
-        b.save()
+        BlockEntry.set_unblocked_by_id(b.id)
 
     def block_queue(self, ident, limit=200, added_since='2014-09-01'):
         return Block.objects.raw("""
@@ -387,33 +1136,388 @@ class BHRDB(object):
 
                                  [ident, added_since, timezone.now(), limit])
 
+    def get_block_set_version(self):
+        """Get a version and last modified time for the set of expected blocks.
+
+        The version changes whenever a block is added, extended or unblocked,
+        and when a block expires.  Returns (version string, datetime or None).
+        """
+        with connection.cursor() as c:
+            c.execute("""SELECT v.version, v.updated,
+                             (SELECT max(unblock_at) FROM bhr_block WHERE unblock_at <= %s)
+                         FROM (SELECT 'blocks' AS name) n
+                         LEFT JOIN bhr_changeversion v ON v.name = n.name""", [timezone.now()])
+            version, updated, expired = c.fetchone()
+        expired_us = int(expired.timestamp() * 1000000) if expired else 0
+        last_modified = max([t for t in (updated, expired) if t], default=None)
+        return "%d.%d" % (version or 0, expired_us), last_modified
+
+    def parse_delta_cursor(self, cursor):
+        """Split a get_block_delta cursor into (change id, datetime), raises ValueError"""
+        change_id, timestamp = cursor.split('-')
+        try:
+            return int(change_id), datetime.datetime.fromtimestamp(int(timestamp) / 1000000, datetime.timezone.utc)
+        except (ValueError, OverflowError, OSError) as e:
+            raise ValueError("Invalid cursor %r: %s" % (cursor, e))
+
+    def get_block_delta(self, cursor=None):
+        """Get the changes to the set of expected blocks since cursor.
+
+        Returns the cursor for the next call and rows of (action, id, cidr,
+        who, source, why, added, unblock_at).  action is 'add', 'modify' for
+        a changed unblock_at, or 'remove' for blocks that were unblocked or
+        expired.  Removals come first, so a cidr that was removed and blocked
+        again ends up blocked.  Without a cursor all expected blocks are
+        returned as adds.
+        """
+        # Read the head first, anything committed after this is picked up next time
+        head = self.get_change_cursor()
+        now = timezone.now()
+        next_cursor = "%d-%d" % (head, int(now.timestamp() * 1000000))
+        fields = ('cidr', 'who__username', 'source', 'why', 'added', 'unblock_at')
+
+        if cursor is None:
+            blocks = self.expected().order_by('id').values_list('id', *fields)
+            return next_cursor, (('add',) + row for row in blocks.iterator(chunk_size=2000))
+
+        change_id, since = self.parse_delta_cursor(cursor)
+        with connection.cursor() as c:
+            c.execute("""
+                WITH changed AS (
+                    SELECT block_id, bool_or(kind = %s) AS added FROM bhr_blockchange
+                    WHERE id > %s AND id <= %s GROUP BY block_id
+                ), expired AS (
+                    SELECT id AS block_id FROM bhr_block WHERE unblock_at > %s AND unblock_at <= %s
+                ), touched AS (
+                    SELECT coalesce(c.block_id, e.block_id) AS block_id, coalesce(c.added, false) AS added
+                    FROM changed c FULL JOIN expired e ON e.block_id = c.block_id
+                ), delta AS (
+                    SELECT CASE WHEN b.forced_unblock OR b.unblock_at <= %s THEN 'remove'
+                                WHEN t.added THEN 'add' ELSE 'modify' END AS action,
+                        b.id, b.cidr, u.username, b.source, b.why, b.added, b.unblock_at
+                    FROM touched t
+                    JOIN bhr_block b ON b.id = t.block_id
+                    JOIN auth_user u ON u.id = b.who_id
+                )
+                SELECT * FROM delta ORDER BY action <> 'remove', id""",
+                      [CHANGE_ADD, change_id, head, since, now, now])
+            return next_cursor, c.fetchall()
+
+    def get_change_cursor(self):
+        """Get the id of the latest change to the blocks"""
+        return BlockChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def block_queue_since(self, ident, cursor=0, limit=200):
+        """Get blocks added after cursor that ident has not blocked yet.
+
+        Only the changes after cursor are scanned.  Returns the blocks and the
+        cursor to pass on the next call.
+        """
+        # Read the head first, anything committed after this is picked up next time
+        head = self.get_change_cursor()
+        blocks = list(Block.objects.raw("""
+                                 SELECT b.*, c.id AS change_id FROM bhr_blockchange c
+                                 JOIN bhr_block b ON b.id = c.block_id
+                                 LEFT JOIN bhr_blockentry be
+                                 ON b.id=be.block_id AND be.ident = %s
+                                 WHERE
+                                     c.id > %s AND c.id <= %s
+                                 AND
+                                     c.kind = %s
+                                 AND
+                                     (b.unblock_at IS NULL OR
+                                      b.unblock_at > %s)
+                                 AND
+                                     b.forced_unblock is false
+                                 AND
+                                     be.id IS NULL
+                                 ORDER BY
+                                     c.id ASC
+                                 LIMIT %s """,
+
+                                 [ident, cursor, head, CHANGE_ADD, timezone.now(), limit]))
+        if len(blocks) == limit:
+            head = blocks[-1].change_id
+        return blocks, head
+
     def unblock_queue(self, ident):
         return BlockEntry.objects.filter(
             removed__isnull=True,
             ident=ident,
             unblock_at__lte=timezone.now(),
-        ).order_by('unblock_at')
+        ).order_by('unblock_at').select_related('block')
 
-    def set_blocked_multi(self, ident, ids):
+    def _expire_leases(self, ident, kind, now):
+        QueueLease.objects.filter(ident=ident, kind=kind, expires__lte=now).delete()
+
+    def claim_block_queue(self, ident, lease, limit=200, added_since='2014-09-01'):
+        """Claim up to limit queued blocks for one worker of ident for lease seconds.
+
+        Concurrent claims for the same ident get disjoint sets of blocks.  A
+        block that is not set_blocked before its lease expires can be claimed
+        again.
+        """
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=lease)
+        with transaction.atomic():
+            self._expire_leases(ident, LEASE_BLOCK, now)
+            return list(Block.objects.raw("""
+                WITH candidates AS (
+                    SELECT b.id FROM bhr_block b
+                    LEFT JOIN bhr_blockentry be
+                    ON b.id=be.block_id AND be.ident = %(ident)s
+                    LEFT JOIN bhr_queuelease l
+                    ON b.id=l.block_id AND l.ident = %(ident)s AND l.kind = %(kind)s AND l.expires > %(now)s
+                    WHERE
+                        b.added >= %(added_since)s
+                    AND
+                        (b.unblock_at IS NULL OR
+                         b.unblock_at > %(now)s)
+                    AND
+                        b.forced_unblock is false
+                    AND
+                        be.id IS NULL AND l.id IS NULL
+                    ORDER BY
+                        b.added ASC
+                    LIMIT %(limit)s
+                    FOR NO KEY UPDATE OF b SKIP LOCKED
+                ), claimed AS (
+                    INSERT INTO bhr_queuelease (ident, block_id, kind, expires)
+                    SELECT %(ident)s, id, %(kind)s, %(expires)s FROM candidates
+                    ON CONFLICT (ident, block_id, kind) DO UPDATE SET expires = EXCLUDED.expires
+                    WHERE bhr_queuelease.expires <= %(now)s
+                    RETURNING block_id
+                )
+                SELECT b.* FROM bhr_block b JOIN claimed ON b.id = claimed.block_id
+                ORDER BY b.added ASC """,
+                dict(ident=ident, kind=LEASE_BLOCK, now=now, expires=expires, added_since=added_since, limit=limit)))
+
+    def claim_unblock_queue(self, ident, lease, limit=200):
+        """Claim up to limit queued unblocks for one worker of ident for lease seconds"""
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=lease)
         with transaction.atomic():
-            for id in ids:
-                block = Block.objects.get(pk=id)
-                block.blockentry_set.create(ident=ident, unblock_at=block.unblock_at)
-                logger.info("SET_BLOCKED ID=%s IP=%s IDENT=%s", id, block.cidr, ident)
+            self._expire_leases(ident, LEASE_UNBLOCK, now)
+            entries = list(BlockEntry.objects.raw("""
+                WITH candidates AS (
+                    SELECT be.block_id FROM bhr_blockentry be
+                    LEFT JOIN bhr_queuelease l
+                    ON be.block_id=l.block_id AND l.ident = be.ident AND l.kind = %(kind)s AND l.expires > %(now)s
+                    WHERE
+                        be.removed IS NULL
+                    AND
+                        be.ident = %(ident)s
+                    AND
+                        be.unblock_at <= %(now)s
+                    AND
+                        l.id IS NULL
+                    ORDER BY
+                        be.unblock_at ASC
+                    LIMIT %(limit)s
+                    FOR NO KEY UPDATE OF be SKIP LOCKED
+                ), claimed AS (
+                    INSERT INTO bhr_queuelease (ident, block_id, kind, expires)
+                    SELECT %(ident)s, block_id, %(kind)s, %(expires)s FROM candidates
+                    ON CONFLICT (ident, block_id, kind) DO UPDATE SET expires = EXCLUDED.expires
+                    WHERE bhr_queuelease.expires <= %(now)s
+                    RETURNING block_id
+                )
+                SELECT be.* FROM bhr_blockentry be JOIN claimed ON be.block_id = claimed.block_id
+                WHERE be.ident = %(ident)s
+                ORDER BY be.unblock_at ASC """,
+                dict(ident=ident, kind=LEASE_UNBLOCK, now=now, expires=expires, limit=limit)))
+            prefetch_related_objects(entries, 'block')
+            return entries
+
+    def set_blocked_multi(self, ident, ids):
+        """Mark the blocks with the given ids as blocked by ident.
+
+        Returns a dict mapping each id to ACK_OK, ACK_ALREADY if ident had
+        already blocked it, or ACK_UNKNOWN if there is no such block.
+        """
+        ids = [int(id) for id in ids]
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH ids AS (
+                    SELECT DISTINCT unnest(%s::integer[]) AS id
+                ), inserted AS (
+                    INSERT INTO bhr_blockentry (block_id, ident, added, unblock_at)
+                    SELECT b.id, %s, %s, b.unblock_at FROM bhr_block b JOIN ids ON ids.id = b.id
+                    ON CONFLICT (block_id, ident) DO NOTHING
+                    RETURNING block_id
+                )
+                SELECT ids.id, b.cidr, inserted.block_id IS NOT NULL FROM ids
+                LEFT JOIN bhr_block b ON b.id = ids.id
+                LEFT JOIN inserted ON inserted.block_id = ids.id""",
+                           [ids, ident, timezone.now()])
+            rows = {id: (cidr, inserted) for id, cidr, inserted in cursor.fetchall()}
+
+        results = {}
+        for id in ids:
+            cidr, inserted = rows[id]
+            if cidr is None:
+                results[id] = ACK_UNKNOWN
+            elif inserted:
+                results[id] = ACK_OK
+                logger.info("SET_BLOCKED ID=%s IP=%s IDENT=%s", id, cidr, ident)
+            else:
+                results[id] = ACK_ALREADY
+        return results
 
     def set_unblocked_multi(self, ids):
-        with transaction.atomic():
-            for id in ids:
-                BlockEntry.set_unblocked_by_id(id)
+        """Mark the block entries with the given ids as unblocked.
+
+        Returns a dict mapping each id to ACK_OK, ACK_ALREADY if the entry was
+        already unblocked, or ACK_UNKNOWN if there is no such entry.
+        """
+        ids = [int(id) for id in ids]
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH ids AS (
+                    SELECT DISTINCT unnest(%s::integer[]) AS id
+                ), updated AS (
+                    UPDATE bhr_blockentry be SET removed = %s
+                    FROM ids WHERE be.id = ids.id AND be.removed IS NULL
+                    RETURNING be.id
+                )
+                SELECT ids.id, be.id IS NOT NULL, updated.id IS NOT NULL FROM ids
+                LEFT JOIN bhr_blockentry be ON be.id = ids.id
+                LEFT JOIN updated ON updated.id = ids.id""",
+                           [ids, timezone.now()])
+            rows = {id: (exists, updated) for id, exists, updated in cursor.fetchall()}
+
+        results = {}
+        for id in ids:
+            exists, updated = rows[id]
+            if not exists:
+                results[id] = ACK_UNKNOWN
+            elif updated:
+                results[id] = ACK_OK
                 logger.info("SET_UNBLOCKED ID=%s", id)
+            else:
+                results[id] = ACK_ALREADY
+        return results
+
+    def reconcile_active_entries(self, fix=True):
+        """Find blocks whose active_entries does not match their block entries.
+
+        Returns a list of (block id, stored count, actual count).  If fix is
+        set the stored counts are corrected as well.
+        """
+        sql = """
+            SELECT b.id, b.active_entries, coalesce(c.active, 0) AS actual FROM bhr_block b
+            LEFT JOIN (SELECT block_id, count(*) AS active FROM bhr_blockentry
+                       WHERE removed IS NULL GROUP BY block_id) c ON c.block_id = b.id
+            WHERE b.active_entries <> coalesce(c.active, 0)"""
+        if fix:
+            sql = """
+                WITH drift AS (%s FOR UPDATE OF b)
+                UPDATE bhr_block b SET active_entries = drift.actual FROM drift
+                WHERE b.id = drift.id
+                RETURNING b.id, drift.active_entries, b.active_entries""" % sql
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql)
+            return sorted(cursor.fetchall())
+
+    def sync(self, ident, blocked_ids=(), unblocked_ids=(), limit=200, lease=0):
+        """Acknowledge the previous batch and fetch the next one in a single transaction.
+
+        blocked_ids are block ids to set_blocked for ident, unblocked_ids are
+        block entry ids to set_unblocked.  Returns the next block queue and
+        unblock queue for ident, claimed for lease seconds if lease is set.
+        """
+        with transaction.atomic():
+            if blocked_ids:
+                self.set_blocked_multi(ident, blocked_ids)
+            if unblocked_ids:
+                self.set_unblocked_multi(unblocked_ids)
+            if lease:
+                blocks = self.claim_block_queue(ident, lease, limit=limit)
+                unblocks = self.claim_unblock_queue(ident, lease, limit=limit)
+            else:
+                blocks = list(self.block_queue(ident, limit=limit))
+                unblocks = list(self.unblock_queue(ident)[:limit])
+        return blocks, unblocks
 
     def get_history(self, query):
-        if query[0].isdigit():  # assume cidr block
-            return Block.objects.filter(cidr__in_cidr=query).select_related('who').order_by('-added')
-        else:
-            return Block.objects.filter(why__contains=query).select_related('who').order_by('-added')
+        try:
+            to_network(query)
+        except ValueError:
+            return self.search_history(query)
+        return Block.objects.filter(cidr__in_cidr=query).select_related('who').order_by('-added')
+
+    def covering_blocks(self, cidr):
+        """The expected blocks that contain or equal cidr, most specific first.
+
+        Returns dicts like Block.objects.values() with who__username.  This is
+        called for single addresses at a high rate, so the query skips the ORM.
+        """
+        with connection.cursor() as c:
+            c.execute(COVERING_BLOCKS_SQL, [str(cidr), timezone.now()])
+            columns = [col[0] for col in c.description]
+            return [dict(zip(columns, row)) for row in c.fetchall()]
+
+    def search_history(self, query):
+        """Blocks whose why or source contains query, best matches first.
+
+        Exact matches come first, then whys starting with query, newest first
+        within each.  The trigram indexes from migration 0019 turn the contains
+        filters into index scans.
+        """
+        rank = Case(When(Q(why=query) | Q(source=query), then=Value(2)),
+                    When(why__startswith=query, then=Value(1)),
+                    default=Value(0), output_field=IntegerField())
+        return Block.objects.filter(Q(why__contains=query) | Q(source__contains=query)).select_related(
+            'who').annotate(rank=rank).order_by('-rank', '-added')
+
+    def get_history_page(self, query, page=1, page_size=100, timeout=None):
+        """Get one page of get_history(query) with the block entries prefetched.
+
+        Returns (blocks, has_next).  Raises SearchTimeoutError if the queries
+        take longer than timeout seconds, the BHR search_timeout setting by
+        default.
+        """
+        if timeout is None:
+            timeout = settings.BHR.get('search_timeout', 5)
+        start = (page - 1) * page_size
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute("SET LOCAL statement_timeout = %s", [int(timeout * 1000)])
+            try:
+                blocks = list(self.get_history(query).prefetch_related('blockentry_set')[start:start + page_size + 1])
+            except OperationalError as e:
+                if getattr(e.__cause__, 'pgcode', None) != errorcodes.QUERY_CANCELED:
+                    raise
+                raise SearchTimeoutError("Searching for %s took longer than %s seconds" % (query, timeout))
+            c.execute("SET LOCAL statement_timeout TO DEFAULT")
+        return blocks[:page_size], len(blocks) > page_size
+
+    def get_stat_counters(self):
+        """Get the counters as of now as a dict of {(metric, source): value}"""
+        window = STATS_WINDOW_SQL.format(start="(SELECT swept_until FROM bhr_statsweep WHERE name = 'blocks')",
+                                         end="%s")
+        with connection.cursor() as c:
+            c.execute("""SELECT metric, source, sum(value)::bigint FROM (
+                             SELECT metric, source, value FROM bhr_statcounter
+                             UNION ALL
+                             SELECT metric, source, value FROM bhr_statdelta
+                             UNION ALL
+                             %s
+                         ) counters GROUP BY metric, source""" % window, [timezone.now()] * 2)
+            return {(metric, source): value for metric, source, value in c.fetchall()}
 
     def stats(self):
+        ret = dict.fromkeys(STAT_METRICS, 0)
+        for (metric, source), value in self.get_stat_counters().items():
+            ret[metric] += value
+        return ret
+
+    def source_stats(self):
+        counters = self.get_stat_counters()
+        return {source: counters[metric, source] for metric, source in sorted(counters, key=lambda k: k[1])
+                if metric == 'expected' and counters[metric, source]}
+
+    def count_stats(self):
+        """Compute stats() from the blocks instead of the counters"""
         ret = dict()
         ret['block_pending'] = self.pending().count()
         ret['unblock_pending'] = self.pending_removal().count()
@@ -422,7 +1526,8 @@ class BHRDB(object):
 
         return ret
 
-    def source_stats(self):
+    def count_source_stats(self):
+        """Compute source_stats() from the blocks instead of the counters"""
         stats = {}
         with connection.cursor() as c:
             c.execute('''SELECT source, count(source) from bhr_block
@@ -434,6 +1539,195 @@ class BHRDB(object):
                 stats[source] = count
         return stats
 
+    def _lock_stats(self, cursor):
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [CIDR_LOCK_NAMESPACE, STATS_LOCK_KEY])
+
+    def sweep_stats(self):
+        """Fold the changes and the blocks that expired since the last sweep into the counters.
+
+        Keeps the number of rows get_stat_counters has to look at small, run
+        it periodically with manage.py sweep_stats.  Returns the number of
+        counters that changed.
+        """
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as c:
+            # Waits for every transaction that wrote deltas to commit
+            self._lock_stats(c)
+            c.execute("SELECT swept_until FROM bhr_statsweep WHERE name = 'blocks'")
+            row = c.fetchone()
+            if row is None:
+                return self.rebuild_stats()
+            if row[0] >= now:
+                now = row[0]
+            c.execute("""WITH deltas AS (
+                             DELETE FROM bhr_statdelta RETURNING metric, source, value
+                         )
+                         INSERT INTO bhr_statcounter (metric, source, value)
+                         SELECT metric, source, sum(value) FROM (
+                             SELECT metric, source, value FROM deltas
+                             UNION ALL
+                             %s
+                         ) changes GROUP BY 1, 2 HAVING sum(value) <> 0 ORDER BY 1, 2
+                         ON CONFLICT (metric, source) DO UPDATE SET value = bhr_statcounter.value + EXCLUDED.value
+                      """ % STATS_WINDOW_SQL.format(start="%s", end="%s"), [now, row[0], row[0], now])
+            changed = c.rowcount
+            c.execute("UPDATE bhr_statsweep SET swept_until = %s WHERE name = 'blocks'", [now])
+        return changed
+
+    def rebuild_stats(self):
+        """Recompute all counters from the blocks, returns the number of counters"""
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as c:
+            self._lock_stats(c)
+            c.execute("DELETE FROM bhr_statdelta")
+            c.execute("DELETE FROM bhr_statcounter")
+            c.execute("""INSERT INTO bhr_statcounter (metric, source, value)
+                         SELECT m.metric, b.source, count(*) FROM bhr_block b,
+                             bhr_block_metrics(b.active_entries, b.unblock_at, b.forced_unblock, %s) AS m(metric)
+                         GROUP BY 1, 2""", [now])
+            count = c.rowcount
+            c.execute("""INSERT INTO bhr_statsweep (name, swept_until) VALUES ('blocks', %s)
+                         ON CONFLICT (name) DO UPDATE SET swept_until = EXCLUDED.swept_until""", [now])
+        return count
+
+    def verify_stats(self):
+        """Compare the counters to the blocks.
+
+        Returns a list of (name, counted, actual) for every stat that differs.
+        """
+        with transaction.atomic():
+            stats, source_stats = self.stats(), self.source_stats()
+            actual, actual_sources = self.count_stats(), self.count_source_stats()
+
+        diffs = [(k, stats[k], actual[k]) for k in STAT_METRICS if stats[k] != actual[k]]
+        for source in sorted(set(source_stats) | set(actual_sources)):
+            counted, expected = source_stats.get(source, 0), actual_sources.get(source, 0)
+            if counted != expected:
+                diffs.append(('expected[%s]' % source, counted, expected))
+        return diffs
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+NEVER = 2 ** 63 - 1
+
+# Computed by postgres so building the index does not parse millions of cidrs in python.
+# v6 addresses overflow a bigint, they come back as text.
+INDEX_COLUMNS = {
+    'family': RawSQL('family(bhr_block.cidr)', ()),
+    'masklen': RawSQL('masklen(bhr_block.cidr)', ()),
+    'v4_start': RawSQL("CASE WHEN family(bhr_block.cidr) = 4 THEN bhr_block.cidr - '0.0.0.0'::inet END", ()),
+    'v6_start': RawSQL("CASE WHEN family(bhr_block.cidr) = 6 THEN host(bhr_block.cidr) END", ()),
+    'unblock_at_us': RawSQL("(extract(epoch from bhr_block.unblock_at) * 1000000)::bigint", ()),
+}
+
+
+class _IndexedBlocks(object):
+    """Blocks in an IntervalIndex, with their ids, sources and unblock_at in arrays"""
+
+    def __init__(self, rows, sources):
+        """rows are ExpectedBlockIndex._rows, sources is a shared list of source names"""
+        source_numbers = {source: n for n, source in enumerate(sources)}
+        self.sources = sources
+        self.ids = array('q')
+        self.prefixlens = array('B')
+        self.source_numbers = array('l')
+        self.unblock_at = array('q')  # microseconds since the epoch, NEVER for no unblock_at
+        self.index = IntervalIndex(self._ranges(rows, source_numbers))
+
+    def _ranges(self, rows, source_numbers):
+        for id, family, masklen, v4_start, v6_start, source, unblock_at in rows:
+            if source not in source_numbers:
+                source_numbers[source] = len(self.sources)
+                self.sources.append(source)
+            yield family, v4_start if family == 4 else int(ipaddress.IPv6Address(v6_start)), masklen, len(self.ids)
+            self.ids.append(id)
+            self.prefixlens.append(masklen)
+            self.source_numbers.append(source_numbers[source])
+            self.unblock_at.append(NEVER if unblock_at is None else unblock_at)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find_covering(self, address, now, skip=()):
+        """Get (prefixlen, id, source, unblock_at) of the blocks covering address that are not expired at now"""
+        found = []
+        for n in self.index.find_covering(address):
+            if self.unblock_at[n] > now and self.ids[n] not in skip:
+                found.append((self.prefixlens[n], self.ids[n], self.sources[self.source_numbers[n]],
+                              self.unblock_at[n]))
+        return found
+
+
+class ExpectedBlockIndex(object):
+    """The expected blocks in memory, for looking up many addresses at once.
+
+    The index is built from the expected blocks as of a BlockChange cursor.
+    refresh() reads the blocks changed since then into a small overlay that
+    is rebuilt on every refresh, until the overlay grows to rebuild_ratio of
+    the index and everything is rebuilt.  Expiring blocks are not logged as
+    changes, they are skipped by comparing unblock_at at lookup time.
+    """
+    rebuild_ratio = 0.1
+    min_rebuild = 10000
+
+    def __init__(self):
+        self.db = BHRDB()
+        # Read the cursor first, changes that land in between are applied again by refresh
+        self.cursor = self.db.get_change_cursor()
+        self.sources = []
+        self.base = _IndexedBlocks(self._rows(Block.expected.all()), self.sources)
+        self.changed = {}
+        self.overlay = _IndexedBlocks([], self.sources)
+
+    def _rows(self, queryset):
+        return queryset.annotate(**INDEX_COLUMNS).values_list(
+            'id', 'family', 'masklen', 'v4_start', 'v6_start', 'source', 'unblock_at_us',
+        ).iterator(chunk_size=10000)
+
+    def needs_rebuild(self, changes):
+        return changes > max(self.min_rebuild, self.rebuild_ratio * len(self.base))
+
+    def refresh(self):
+        """Apply the changes since the last refresh, returns False if the index needs a rebuild instead"""
+        head = self.db.get_change_cursor()
+        if head == self.cursor:
+            return True
+        if head < self.cursor:
+            return False
+        block_ids = set(BlockChange.objects.filter(id__gt=self.cursor, id__lte=head).values_list('block_id', flat=True))
+        if self.needs_rebuild(len(block_ids | set(self.changed))):
+            return False
+        rows = {row[0]: row for row in self._rows(Block.expected.filter(id__in=block_ids))}
+        for id in block_ids:
+            self.changed[id] = rows.get(id)
+        self.overlay = _IndexedBlocks([row for row in self.changed.values() if row], self.sources)
+        self.cursor = head
+        return True
+
+    def lookup(self, address):
+        """Get the expected blocks covering the ipaddress address, most specific first.
+
+        Returns dicts with the id, cidr, source and unblock_at of each block.
+        """
+        now = (timezone.now() - EPOCH) // datetime.timedelta(microseconds=1)
+        found = self.base.find_covering(address, now, skip=self.changed)
+        if len(self.overlay):
+            found = sorted(found + self.overlay.find_covering(address, now), reverse=True)
+        return [dict(id=id, cidr=ipaddress.ip_network((address, prefixlen), strict=False), source=source,
+                     unblock_at=None if unblock_at == NEVER else EPOCH + datetime.timedelta(microseconds=unblock_at))
+                for prefixlen, id, source, unblock_at in found]
+
+
+_expected_block_index = None
+
+
+def get_expected_block_index():
+    """Get the expected block index of this process, up to date with the latest changes"""
+    global _expected_block_index
+    if _expected_block_index is None or not _expected_block_index.refresh():
+        _expected_block_index = ExpectedBlockIndex()
+    return _expected_block_index
+
 
 def filter_local_networks(query):
     local_nets = settings.BHR.get("local_networks", [])
@@ -456,3 +1750,16 @@ class InCidr(models.Lookup):
 
 
 models.fields.Field.register_lookup(InCidr)
+
+
+class CoversCidr(models.Lookup):
+    lookup_name = "covers_cidr"
+
+    def as_sql(self, qn, connection):
+        lhs, lhs_params = self.process_lhs(qn, connection)
+        rhs, rhs_params = self.process_rhs(qn, connection)
+        params = lhs_params + rhs_params
+        return '%s >>= %s' % (lhs, rhs), params
+
+
+models.fields.Field.register_lookup(CoversCidr)
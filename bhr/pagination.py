@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OptInCursorPagination(CursorPagination):
+    """Keyset pagination on the block id, only used when the client asks for a page_size.
+
+    Without page_size the full list is returned as before.
+    """
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 10000
+    ordering = 'id'
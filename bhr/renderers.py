@@ -0,0 +1,18 @@
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils import encoders, json
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Render a list as one JSON object per line"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render_item(self, item):
+        return json.dumps(item, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        items = data if isinstance(data, list) else [data]
+        return "".join(self.render_item(item) for item in items).encode('utf-8')
@@ -1,8 +1,10 @@
 from bhr.models import WhitelistEntry, Block, BlockEntry
+from django.db.models.query import QuerySet
 from rest_framework import serializers
-from bhr.models import BHRDB, is_whitelisted, is_prefixlen_too_small, is_source_blacklisted
+from rest_framework.reverse import reverse
+from bhr.models import BHRDB, BlockPolicy
 
-from bhr.util import expand_time
+from bhr.util import expand_time, to_network
 
 
 class WhitelistEntrySerializer(serializers.ModelSerializer):
@@ -61,6 +63,104 @@ class UnBlockEntrySerializer(serializers.HyperlinkedModelSerializer):
         fields = ('id', 'block', 'ident', 'added', 'set_unblocked')
 
 
+class FastSerializer(object):
+    """Serialize many rows to the same data as serializer_class, without its per row overhead.
+
+    Querysets are read with values() so no model instances are built, lists
+    of instances are read attribute by attribute.  Hyperlinks are reversed
+    once with a placeholder pk and only the pk is filled in for each row.
+    """
+    serializer_class = None
+    values = ()
+    links = {}
+    placeholder_pk = '8675309000'
+
+    def __init__(self, context):
+        request = context.get('request')
+        self.urls = {}
+        for field, view_name in self.links.items():
+            url = reverse(view_name, kwargs={'pk': self.placeholder_pk}, request=request)
+            self.urls[field] = url.split(self.placeholder_pk, 1)
+        self.datetime = serializers.DateTimeField().to_representation
+
+    def url(self, field, pk):
+        prefix, suffix = self.urls[field]
+        return "%s%s%s" % (prefix, pk, suffix)
+
+    def instance_values(self, obj):
+        values = {}
+        for field in self.values:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values[field] = value
+        return values
+
+    def data(self, rows):
+        if isinstance(rows, QuerySet):
+            rows = rows.values(*self.values)
+        return [self.to_representation(row if isinstance(row, dict) else self.instance_values(row)) for row in rows]
+
+    def to_representation(self, row):
+        raise NotImplementedError
+
+
+class FastBlockSerializer(FastSerializer):
+    serializer_class = BlockSerializer
+    values = ('id', 'who__username', 'cidr', 'source', 'why', 'added', 'unblock_at', 'skip_whitelist')
+    links = {'url': 'block-detail', 'set_blocked': 'block-set-blocked'}
+
+    def to_representation(self, row):
+        return {
+            'who': row['who__username'],
+            'url': self.url('url', row['id']),
+            'cidr': str(row['cidr']),
+            'source': row['source'],
+            'why': row['why'],
+            'added': self.datetime(row['added']),
+            'unblock_at': self.datetime(row['unblock_at']),
+            'skip_whitelist': row['skip_whitelist'],
+            'set_blocked': self.url('set_blocked', row['id']),
+        }
+
+
+class FastBlockBriefSerializer(FastSerializer):
+    serializer_class = BlockBriefSerializer
+    values = ('cidr', )
+
+    def to_representation(self, row):
+        return {'cidr': str(row['cidr'])}
+
+
+class FastBlockQueueSerializer(FastSerializer):
+    serializer_class = BlockQueueSerializer
+    values = ('id', 'cidr', 'added')
+    links = {'set_blocked': 'block-set-blocked'}
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'cidr': str(row['cidr']),
+            'set_blocked': self.url('set_blocked', row['id']),
+            'added': self.datetime(row['added']),
+        }
+
+
+class FastUnBlockEntrySerializer(FastSerializer):
+    serializer_class = UnBlockEntrySerializer
+    values = ('id', 'block__cidr', 'ident', 'added')
+    links = {'set_unblocked': 'blockentry-set-unblocked'}
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'block': {'cidr': str(row['block__cidr'])},
+            'ident': row['ident'],
+            'added': self.datetime(row['added']),
+            'set_unblocked': self.url('set_unblocked', row['id']),
+        }
+
+
 class BlockRequestSerializer(serializers.Serializer):
     cidr = serializers.CharField(max_length=50)
     source = serializers.CharField(max_length=30)
@@ -78,6 +178,16 @@ class BlockRequestSerializer(serializers.Serializer):
             raise serializers.ValidationError("Invalid duration")
         return value
 
+    def get_policy(self):
+        """Get a BlockPolicy shared by all of the requests being validated"""
+        root = self.root
+        if not hasattr(root, '_policy'):
+            data = root.initial_data
+            if not isinstance(data, (list, tuple)):
+                data = [data]
+            root._policy = BlockPolicy(d.get('source') for d in data if hasattr(d, 'get'))
+        return root._policy
+
     def validate(self, attrs):
         if attrs.get('duration') and attrs.get('unblock_at'):
             raise serializers.ValidationError("Specify only one of duration and unblock_at")
@@ -86,22 +196,75 @@ class BlockRequestSerializer(serializers.Serializer):
         source = attrs.get('source')
         skip_whitelist = attrs.get('skip_whitelist')
         if cidr and not skip_whitelist:
-            item = is_whitelisted(cidr)
+            policy = self.get_policy()
+            item = policy.is_whitelisted(cidr)
             if item:
                 raise serializers.ValidationError("whitelisted: %s: %s" % (item.who, item.why))
-            if is_prefixlen_too_small(cidr):
+            if policy.is_prefixlen_too_small(cidr):
                 raise serializers.ValidationError("Prefix length in %s is too small" % cidr)
-            item = is_source_blacklisted(source)
+            item = policy.is_source_blacklisted(source)
             if item:
                 raise serializers.ValidationError("Source %s is blacklisted: %s: %s" % (source, item.who, item.why))
 
         return attrs
 
 
+class PreflightSerializer(serializers.Serializer):
+    source = serializers.CharField(max_length=30)
+    cidrs = serializers.ListField(child=serializers.CharField(max_length=50), max_length=10000)
+    duration = serializers.CharField(required=False)
+    unblock_at = serializers.DateTimeField(required=False)
+    extend = serializers.BooleanField(default=True)
+
+    def validate_duration(self, value):
+        try:
+            expand_time(value)
+        except ValueError:
+            raise serializers.ValidationError("Invalid duration")
+        return value
+
+    def validate_cidrs(self, value):
+        invalid = []
+        for cidr in value:
+            try:
+                to_network(cidr, strict=False)
+            except ValueError:
+                invalid.append(cidr)
+        if invalid:
+            raise serializers.ValidationError(["Invalid cidr: %s" % cidr for cidr in invalid[:10]])
+        return value
+
+    def validate(self, attrs):
+        if attrs.get('duration') and attrs.get('unblock_at'):
+            raise serializers.ValidationError("Specify only one of duration and unblock_at")
+        return attrs
+
+
 class SetBlockedSerializer(serializers.Serializer):
     ident = serializers.CharField()
 
 
+class QueueParamsSerializer(serializers.Serializer):
+    """Query parameters of the block and unblock queues"""
+    timeout = serializers.IntegerField(default=0, min_value=0)
+    lease = serializers.IntegerField(default=0, min_value=0)
+    cursor = serializers.IntegerField(default=0, min_value=0, max_value=2**63 - 1)
+
+
+class LookupSerializer(serializers.Serializer):
+    ips = serializers.ListField(child=serializers.IPAddressField(), max_length=100000)
+
+
+class AckSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1, max_value=2**31 - 1))
+
+
+class SyncSerializer(serializers.Serializer):
+    blocked = serializers.ListField(child=serializers.IntegerField(min_value=1, max_value=2**31 - 1), default=list)
+    unblocked = serializers.ListField(child=serializers.IntegerField(min_value=1, max_value=2**31 - 1), default=list)
+    lease = serializers.IntegerField(default=0, min_value=0)
+
+
 class UnblockNowSerializer(serializers.Serializer):
     cidr = serializers.CharField(max_length=50)
     why = serializers.CharField()
@@ -1,23 +1,59 @@
+from django.conf import settings
+from django.core.cache import caches
 from django.contrib.auth.models import User, Permission
-from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction, OperationalError
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+import bhr.models
 import dateutil.parser
 import datetime
 import ipaddress
 import json
+import random
 import csv
-
-from bhr.models import BHRDB, Block, WhitelistEntry, SourceBlacklistEntry, is_whitelisted, is_prefixlen_too_small
-from bhr.models import is_source_blacklisted, filter_local_networks
-from bhr.util import expand_time, ip_family
+import gzip
+import os
+import tempfile
+from io import StringIO
+
+from bhr.models import BHRDB, Block, BlockEntry, QueueLease, WhitelistError, WhitelistEntry, SourceBlacklistEntry, is_whitelisted, is_prefixlen_too_small
+from bhr.models import is_source_blacklisted, filter_local_networks, scan_whitelist, lock_cidrs
+from bhr.models import DupeCache, ExpectedBlockIndex, OffenderSummary, get_expected_block_index
+from bhr.models import ACK_OK, ACK_ALREADY, ACK_UNKNOWN, StatCounter, StatDelta, StatSweep, SearchTimeoutError, COVERING_BLOCKS_SQL
+from bhr.models import BATCH_COVERING_BLOCKS_SQL, outer_atomic_blocks_allowed
+from bhr.admin import force_unblock
+from bhr.exports import get_export_file, write_exports
+from bhr.index import IntervalIndex, NetworkIndex
+from bhr.serializers import (BlockSerializer, FastBlockSerializer, FastBlockBriefSerializer, FastBlockQueueSerializer,
+                             FastUnBlockEntrySerializer)
+from bhr.util import expand_time, ip_family, iter_csv, aggregate_networks
 
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from time import sleep
+import threading
+import time
 
 
 # Create your tests here.
 
-class DBTests(TestCase):
+def count_queries(fn, *args, **kwargs):
+    with CaptureQueriesContext(connection) as ctx:
+        fn(*args, **kwargs)
+    return len(ctx.captured_queries)
+
+
+class BHRTestCase(TestCase):
+    """TestCase that lets block changes run inside the two atomic blocks each test runs in"""
+    def run(self, result=None):
+        with outer_atomic_blocks_allowed(2):
+            return super(BHRTestCase, self).run(result)
+
+
+class DBTests(BHRTestCase):
     def setUp(self):
         self.db = BHRDB()
         self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
@@ -35,6 +71,52 @@ class DBTests(TestCase):
         b2 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
         self.assertEqual(b1.id, b2.id)
 
+    def test_add_block_multi_returns_results_in_order(self):
+        old = self.db.add_block('1.2.3.1', self.user, 'test', 'testing', duration=60)
+        blocks = [
+            dict(cidr='1.2.3.2', source='test', why='new', duration=60),
+            dict(cidr='1.2.3.1', source='test', why='dupe', duration=30),
+            dict(cidr='1.2.3.2', source='test', why='dupe in batch', duration=30),
+            dict(cidr='1.2.3.2/32', source='test', why='extend in batch', duration=120),
+            dict(cidr='1.2.3.1', source='test', why='extend', duration=120),
+        ]
+        result = self.db.add_block_multi(self.user, blocks)
+
+        self.assertEqual([b.id for b in result], [result[0].id, old.id, result[0].id, result[0].id, old.id])
+        self.assertEqual(Block.objects.count(), 2)
+        for b in Block.objects.all():
+            self.assertAlmostEqual(b.duration.total_seconds(), 120, delta=2)
+        self.assertEqual(Block.objects.get(pk=result[0].id).why, 'new')
+
+    def test_add_block_multi_extends_block_entries(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=60)
+        self.db.set_blocked(b1, 'bgp1')
+        self.db.add_block_multi(self.user, [dict(cidr='1.2.3.4', source='test', why='testing', duration=600)])
+        b1.refresh_from_db()
+        self.assertEqual(b1.blockentry_set.get().unblock_at, b1.unblock_at)
+
+    def test_add_block_multi_is_all_or_nothing(self):
+        WhitelistEntry(who=self.user, why='test', cidr='141.142.0.0/16').save()
+        blocks = [
+            dict(cidr='1.2.3.4', source='test', why='testing', duration=60),
+            dict(cidr='141.142.2.2', source='test', why='testing', duration=60),
+        ]
+        with self.assertRaises(WhitelistError):
+            self.db.add_block_multi(self.user, blocks)
+        self.assertEqual(Block.objects.count(), 0)
+
+    def test_add_block_multi_query_count_does_not_grow(self):
+        def add(count, offset):
+            blocks = []
+            for i in range(count):
+                blocks.append(dict(cidr='1.2.%d.%d' % (offset, i), source='test', why='new', duration=60))
+                blocks.append(dict(cidr='1.2.0.%d' % i, source='test', why='extend', duration=60 + offset,
+                                   autoscale=True))
+            return self.db.add_block_multi(self.user, blocks)
+
+        add(20, 0)
+        self.assertEqual(count_queries(add, 2, 1), count_queries(add, 20, 2))
+
     def test_blocking_changes_expected(self):
         expected = self.db.expected().all()
         self.assertEqual(len(expected), 0)
@@ -96,6 +178,183 @@ class DBTests(TestCase):
 
         self.assertEqual(len(q), 0)
 
+    def test_block_queue_since(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        b2 = self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+
+        q, cursor = self.db.block_queue_since('bgp1')
+        self.assertEqual([b.id for b in q], [b1.id, b2.id])
+
+        q, cursor = self.db.block_queue_since('bgp1', cursor)
+        self.assertEqual(q, [])
+
+        b3 = self.db.add_block('1.2.3.6', self.user, 'test', 'testing')
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=300)
+        q, cursor = self.db.block_queue_since('bgp1', cursor)
+        self.assertEqual([b.id for b in q], [b3.id])
+
+    def test_block_queue_since_skips_blocked_and_unblocked(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        b2 = self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        self.db.set_blocked(b1, 'bgp1')
+        self.db.unblock_now('1.2.3.5', self.user, 'testing')
+
+        q, cursor = self.db.block_queue_since('bgp1')
+        self.assertEqual(q, [])
+        q, cursor = self.db.block_queue_since('bgp2')
+        self.assertEqual([b.id for b in q], [b1.id])
+
+    def test_block_queue_since_limit(self):
+        blocks = [self.db.add_block('1.2.3.%d' % i, self.user, 'test', 'testing') for i in range(5)]
+
+        seen = []
+        cursor = 0
+        for i in range(3):
+            q, cursor = self.db.block_queue_since('bgp1', cursor, limit=2)
+            seen.extend(b.id for b in q)
+        self.assertEqual(seen, [b.id for b in blocks])
+
+    def test_claim_block_queue_gives_disjoint_batches(self):
+        blocks = [self.db.add_block('1.2.3.%d' % i, self.user, 'test', 'testing') for i in range(5)]
+
+        first = self.db.claim_block_queue('bgp1', 60, limit=3)
+        second = self.db.claim_block_queue('bgp1', 60, limit=3)
+        third = self.db.claim_block_queue('bgp1', 60, limit=3)
+        self.assertEqual([b.id for b in first + second], [b.id for b in blocks])
+        self.assertEqual(third, [])
+
+        # other idents are not affected
+        self.assertEqual(len(self.db.claim_block_queue('bgp2', 60)), 5)
+
+    def test_claim_block_queue_expired_lease(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        b2 = self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        self.db.claim_block_queue('bgp1', 60)
+        self.db.set_blocked(b1, 'bgp1')
+        QueueLease.objects.update(expires=timezone.now())
+
+        q = self.db.claim_block_queue('bgp1', 60)
+        self.assertEqual([b.id for b in q], [b2.id])
+
+    def test_claim_unblock_queue(self):
+        for i in range(3):
+            b = self.db.add_block('1.2.3.%d' % i, self.user, 'test', 'testing')
+            self.db.set_blocked(b, 'bgp1')
+            self.db.unblock_now('1.2.3.%d' % i, self.user, 'testing')
+
+        first = self.db.claim_unblock_queue('bgp1', 60, limit=2)
+        second = self.db.claim_unblock_queue('bgp1', 60, limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(len(set(e.id for e in first + second)), 3)
+
+        QueueLease.objects.update(expires=timezone.now())
+        self.assertEqual(len(self.db.claim_unblock_queue('bgp1', 60)), 3)
+
+    def test_set_blocked_multi_results(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        b2 = self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        self.db.set_blocked(b1, 'bgp1')
+
+        results = self.db.set_blocked_multi('bgp1', [b2.id, b1.id, 999999])
+        self.assertEqual(results, {b2.id: ACK_OK, b1.id: ACK_ALREADY, 999999: ACK_UNKNOWN})
+        self.assertEqual(list(self.db.block_queue('bgp1')), [])
+        self.assertEqual(b2.blockentry_set.get(ident='bgp1').unblock_at, b2.unblock_at)
+
+    def test_set_unblocked_multi_results(self):
+        b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        b2 = self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        e1 = self.db.set_blocked(b1, 'bgp1')
+        e2 = self.db.set_blocked(b2, 'bgp1')
+        self.db.set_unblocked_multi([e1.id])
+
+        results = self.db.set_unblocked_multi([e1.id, e2.id, 999999])
+        self.assertEqual(results, {e1.id: ACK_ALREADY, e2.id: ACK_OK, 999999: ACK_UNKNOWN})
+        self.assertEqual(BlockEntry.objects.filter(removed__isnull=True).count(), 0)
+
+    def test_set_blocked_multi_constant_queries(self):
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr='1.2.3.%d' % i, source='test', why='testing') for i in range(20)])
+        ids = [b.id for b in blocks]
+        self.assertEqual(count_queries(self.db.set_blocked_multi, 'bgp1', ids[:2]),
+                         count_queries(self.db.set_blocked_multi, 'bgp1', ids[2:]))
+        entries = list(BlockEntry.objects.values_list('id', flat=True))
+        self.assertEqual(count_queries(self.db.set_unblocked_multi, entries[:2]),
+                         count_queries(self.db.set_unblocked_multi, entries[2:]))
+
+    def _active(self, b):
+        return Block.objects.get(pk=b.pk).active_entries
+
+    def test_active_entries(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.assertEqual(list(Block.pending.all()), [b])
+
+        self.db.set_blocked(b, 'bgp1')
+        self.db.set_blocked_multi('bgp2', [b.id, b.id])
+        self.db.set_blocked_multi('bgp2', [b.id])
+        self.assertEqual(self._active(b), 2)
+        self.assertEqual(list(Block.current.all()), [b])
+        self.assertEqual(list(Block.pending.all()), [])
+
+        self.db.set_unblocked(b, 'bgp1')
+        self.db.set_unblocked(b, 'bgp1')
+        self.assertEqual(self._active(b), 1)
+        self.db.set_unblocked_multi(BlockEntry.objects.values_list('id', flat=True))
+        self.assertEqual(self._active(b), 0)
+        self.assertEqual(list(Block.current.all()), [])
+        self.assertEqual(self.db.reconcile_active_entries(), [])
+
+    def test_active_entries_superseded(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=30)
+        self.db.set_blocked(b, 'bgp1')
+        Block.objects.filter(pk=b.pk).update(unblock_at=timezone.now())
+        self.assertEqual(list(Block.pending_removal.all()), [b])
+
+        b2 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.assertEqual(self._active(b), 0)
+        self.assertEqual(list(Block.pending_removal.all()), [])
+        self.assertEqual(list(Block.pending.all()), [b2])
+        self.assertEqual(self.db.reconcile_active_entries(), [])
+
+    def test_active_entries_survive_block_saves(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        stale = Block.objects.get(pk=b.pk)
+        self.db.set_blocked(b, 'bgp1')
+        b.unblock_now(self.user, 'testing')
+        self.assertEqual(self._active(b), 1)
+        self.assertEqual(list(Block.pending_removal.all()), [b])
+
+        self.db.set_blocked_multi('bgp2', [b.id])
+        stale.why = 'edited'
+        stale.save()
+        self.assertEqual(self._active(b), 2)
+        self.assertEqual(self.db.reconcile_active_entries(), [])
+
+    def test_active_entries_follow_direct_entry_writes(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        entry = BlockEntry.objects.create(block=b, ident='bgp1')
+        BlockEntry.objects.create(block=b, ident='bgp2', removed=timezone.now())
+        self.assertEqual(self._active(b), 1)
+        entry.removed = timezone.now()
+        entry.save()
+        self.assertEqual(self._active(b), 0)
+        BlockEntry.objects.filter(ident='bgp2').update(removed=None)
+        self.assertEqual(self._active(b), 1)
+        BlockEntry.objects.all().delete()
+        self.assertEqual(self._active(b), 0)
+        self.assertEqual(self.db.reconcile_active_entries(), [])
+
+    def test_reconcile_active_entries(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.db.set_blocked(b, 'bgp1')
+        Block.objects.update(active_entries=3)
+
+        self.assertEqual(self.db.reconcile_active_entries(fix=False), [(b.id, 3, 1)])
+        self.assertEqual(self._active(b), 3)
+        call_command('reconcile_active_entries', stdout=StringIO())
+        self.assertEqual(self._active(b), 1)
+        self.assertEqual(self.db.reconcile_active_entries(), [])
+
     def test_block_two_blockers(self):
         b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
 
@@ -234,6 +493,70 @@ class DBTests(TestCase):
         self.db.set_unblocked(b1, 'bgp1')
         check_counts()
 
+    def test_stats_counters_follow_changes(self):
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr='1.2.3.%d' % i, source='src%d' % (i % 3), why='testing', duration=300) for i in range(10)])
+        self.db.set_blocked_multi('bgp1', [b.id for b in blocks[:6]])
+        self.db.add_block_multi(self.user, [dict(cidr='1.2.3.1', source='test', why='testing', duration=600)])
+        self.db.unblock_now('1.2.3.2', self.user, 'testing')
+        self.db.set_unblocked_multi(BlockEntry.objects.filter(block__cidr='1.2.3.3').values_list('id', flat=True))
+        Block.objects.filter(cidr='1.2.3.4').update(forced_unblock=True)
+        Block.objects.filter(cidr='1.2.3.9').delete()
+
+        self.assertEqual(self.db.verify_stats(), [])
+        self.assertEqual(self.db.stats(), dict(block_pending=4, unblock_pending=1, current=5, expected=7))
+
+    def test_stats_expired_blocks(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=300)
+        self.db.set_blocked(b, 'bgp1')
+        Block.objects.filter(pk=b.pk).update(unblock_at=timezone.now())
+
+        stats = dict(block_pending=0, unblock_pending=1, current=1, expected=0)
+        self.assertEqual(self.db.stats(), stats)
+        self.assertEqual(self.db.source_stats(), {})
+        self.assertNotEqual(self.db.sweep_stats(), 0)
+        self.assertEqual(self.db.stats(), stats)
+        self.assertEqual(StatCounter.objects.get(metric='unblock_pending', source='test').value, 1)
+        self.assertEqual(StatDelta.objects.count(), 0)
+        self.assertEqual(self.db.sweep_stats(), 0)
+
+    def test_stats_after_a_missed_sweep(self):
+        self.db.rebuild_stats()
+        # the sweeper last ran an hour ago
+        StatSweep.objects.update(swept_until=timezone.now() - datetime.timedelta(hours=1))
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr='1.2.3.%d' % i, source='src%d' % (i % 3), why='testing', duration=300) for i in range(10)])
+        self.db.set_blocked_multi('bgp1', [b.id for b in blocks[:6]])
+        Block.objects.filter(id__in=[b.id for b in blocks[:2]]).update(
+            unblock_at=timezone.now() - datetime.timedelta(hours=2))
+        Block.objects.filter(id__in=[b.id for b in blocks[2:5]]).update(
+            unblock_at=timezone.now() - datetime.timedelta(minutes=30))
+        self.db.unblock_now('1.2.3.9', self.user, 'testing')
+
+        stats = dict(block_pending=3, unblock_pending=5, current=6, expected=4)
+        self.assertEqual(self.db.stats(), stats)
+        self.assertEqual(self.db.verify_stats(), [])
+        self.assertNotEqual(StatDelta.objects.count(), 0)
+        self.assertNotEqual(self.db.sweep_stats(), 0)
+        self.assertEqual(StatDelta.objects.count(), 0)
+        self.assertEqual(self.db.stats(), stats)
+        self.assertEqual(self.db.verify_stats(), [])
+
+    def test_stats_single_query(self):
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.assertEqual(count_queries(self.db.stats), 1)
+
+    def test_stats_verify_and_rebuild(self):
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.db.sweep_stats()
+        StatCounter.objects.filter(metric='expected').update(value=5)
+
+        self.assertEqual(self.db.verify_stats(), [('expected', 5, 1), ('expected[test]', 5, 1)])
+        with self.assertRaises(CommandError):
+            call_command('sweep_stats', verify=True, stdout=StringIO())
+        call_command('sweep_stats', rebuild=True, verify=True, stdout=StringIO())
+        self.assertEqual(self.db.verify_stats(), [])
+
     def test_source_stats(self):
         b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
 
@@ -253,6 +576,35 @@ class DBTests(TestCase):
         self.assertEqual(bool(is_whitelisted("141.142.4.0/24")), True)
         self.assertEqual(bool(is_whitelisted("141.0.0.0/8")), True)
 
+    def test_whitelist_v6(self):
+        WhitelistEntry(who=self.user, why='test', cidr='2001:db8::/48').save()
+
+        self.assertEqual(bool(is_whitelisted("2001:db9::1")), False)
+        self.assertEqual(bool(is_whitelisted("2001:db8:0:1::/64")), True)
+        self.assertEqual(bool(is_whitelisted("2001:db8::/32")), True)
+        self.assertEqual(bool(is_whitelisted("1.2.3.4")), False)
+
+    def test_whitelist_returns_the_same_entry_as_a_scan(self):
+        for cidr in '141.142.0.0/16', '141.142.2.0/24', '141.142.2.2/32', '10.0.0.0/8':
+            WhitelistEntry(who=self.user, why=cidr, cidr=cidr).save()
+
+        for query in '141.142.2.2', '141.142.2.0/24', '141.0.0.0/8', '10.1.1.1', '1.2.3.4':
+            self.assertEqual(is_whitelisted(query), scan_whitelist(query), query)
+
+    def test_whitelist_index_is_rebuilt_on_change(self):
+        self.assertEqual(bool(is_whitelisted("141.142.2.2")), False)
+
+        entry = WhitelistEntry(who=self.user, why='test', cidr='141.142.0.0/16')
+        entry.save()
+        self.assertEqual(bool(is_whitelisted("141.142.2.2")), True)
+
+        WhitelistEntry.objects.filter(pk=entry.pk).update(cidr='10.0.0.0/8')
+        self.assertEqual(bool(is_whitelisted("141.142.2.2")), False)
+        self.assertEqual(bool(is_whitelisted("10.1.1.1")), True)
+
+        WhitelistEntry.objects.all().delete()
+        self.assertEqual(bool(is_whitelisted("10.1.1.1")), False)
+
     def test_block_then_whitelist_then_unblock_works(self):
         b1 = self.db.add_block('1.2.3.4', self.user, 'other', 'testing')
         WhitelistEntry(who=self.user, why='test', cidr='1.2.3.0/24').save()
@@ -281,6 +633,88 @@ class DBTests(TestCase):
         SourceBlacklistEntry(who=self.user, why='test', source='test').save()
         self.assertEqual(bool(is_source_blacklisted("test")), True)
 
+    def test_preflight_blocks(self):
+        WhitelistEntry(who=self.user, why='local', cidr='10.0.0.0/8').save()
+        SourceBlacklistEntry(who=self.user, why='noisy', source='bad').save()
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=600)
+        self.db.add_block('1.2.3.5', self.user, 'test', 'testing', duration=30)
+        cidrs = ['10.1.1.1', '1.2.0.0/16', '1.2.3.4', '1.2.3.5', '1.2.3.6', '1.2.3.6']
+        verdicts = self.db.preflight_blocks('test', cidrs, duration=60)
+        self.assertEqual([v['cidr'] for v in verdicts], cidrs)
+        self.assertEqual([v['status'] for v in verdicts],
+                         ['whitelisted', 'prefixlen_too_small', 'blocked', 'extend', 'block', 'blocked'])
+        self.assertEqual(verdicts[0]['whitelist']['why'], 'local')
+        self.assertEqual(verdicts[2]['unblock_at'], self.db.get_block('1.2.3.4').unblock_at)
+        # the second 1.2.3.6 sees the block the first one would add
+        self.assertLess(verdicts[5]['unblock_at'], verdicts[2]['unblock_at'])
+
+        verdicts = self.db.preflight_blocks('bad', ['1.2.3.4', '1.2.3.6'], duration=60)
+        self.assertEqual([v['status'] for v in verdicts], ['blocked', 'source_blacklisted'])
+        self.assertEqual(verdicts[1]['blacklist']['why'], 'noisy')
+
+        # nothing was blocked
+        self.assertEqual(self.db.expected().count(), 2)
+
+    def test_preflight_blocks_matches_add_block(self):
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=600)
+        self.db.add_block('1.2.3.5', self.user, 'test', 'testing', duration=30)
+        cidrs = ['1.2.3.4', '1.2.3.5', '1.2.3.6', '1.2.3.6']
+        verdicts = self.db.preflight_blocks('test', cidrs, duration=60)
+        before = set(str(b.cidr.network_address) for b in self.db.expected().all())
+        blocks = self.db.add_block_multi(self.user, [dict(cidr=c, source='test', why='testing', duration=60) for c in cidrs])
+        for cidr, verdict, block in zip(cidrs, verdicts, blocks):
+            with self.subTest(verdict=verdict):
+                if verdict['status'] == 'block':
+                    self.assertNotIn(cidr, before)
+                elif verdict['status'] == 'extend':
+                    self.assertGreater(block.unblock_at, verdict['unblock_at'])
+                elif cidr in before:
+                    self.assertEqual(block.unblock_at, verdict['unblock_at'])
+                else:
+                    self.assertIs(block, blocks[cidrs.index(cidr)])
+
+    @override_settings(BHR=dict(settings.BHR, covering_dedupe={'scanner': 'dupe'}))
+    def test_covering_dedupe_dupe(self):
+        wide = self.db.add_block('1.2.3.0/24', self.user, 'other', 'testing', duration=600)
+        b = self.db.add_block('1.2.3.4', self.user, 'scanner', 'testing', duration=60)
+        self.assertEqual(b.id, wide.id)
+        self.assertEqual(Block.objects.count(), 1)
+
+        # the covering block has to last as long as the requested one
+        b = self.db.add_block('1.2.3.5', self.user, 'scanner', 'testing', duration=6000)
+        self.assertNotEqual(b.id, wide.id)
+        # other sources are not deduped
+        b = self.db.add_block('1.2.3.6', self.user, 'other', 'testing', duration=60)
+        self.assertNotEqual(b.id, wide.id)
+        self.assertEqual(self.db.expected().count(), 3)
+
+    @override_settings(BHR=dict(settings.BHR, covering_dedupe={'scanner': 'record'}))
+    def test_covering_dedupe_record(self):
+        self.db.add_block('1.2.3.0/24', self.user, 'other', 'testing', duration=600)
+        b = self.db.add_block('1.2.3.4', self.user, 'scanner', 'testing', duration=60)
+        self.assertEqual(b.cidr, '1.2.3.4')
+        self.assertIsNotNone(b.pk)
+        self.assertTrue(b.forced_unblock)
+        self.assertEqual(b.unblock_why, 'Covered by 1.2.3.0/24')
+        self.assertEqual(self.db.get_history('1.2.3.4').count(), 1)
+        self.assertEqual(self.db.expected().count(), 1)
+        self.assertEqual(len(list(self.db.block_queue('bgp1'))), 1)
+        self.assertEqual(self.db.block_queue_since('bgp1')[0][0].source, 'other')
+
+    @override_settings(BHR=dict(settings.BHR, covering_dedupe={'scanner': 'dupe'}))
+    def test_covering_dedupe_in_batch(self):
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr='1.2.3.0/24', source='scanner', why='testing', duration=600),
+            dict(cidr='1.2.3.4', source='scanner', why='testing', duration=60),
+        ])
+        self.assertIs(blocks[0], blocks[1])
+        self.assertEqual(Block.objects.count(), 1)
+
+        verdicts = self.db.preflight_blocks('scanner', ['1.2.3.5', '1.2.4.0/24', '1.2.4.5'], duration=60)
+        self.assertEqual([v['status'] for v in verdicts], ['covered', 'block', 'covered'])
+        self.assertEqual(verdicts[0]['covering']['cidr'], '1.2.3.0/24')
+        self.assertEqual(verdicts[2]['covering']['cidr'], '1.2.4.0/24')
+
     def test_filter_local(self):
         b1 = self.db.add_block('1.2.3.4', self.user, 'other', 'testing')
         local = filter_local_networks(self.db.expected())
@@ -303,7 +737,199 @@ class DBTests(TestCase):
         self.assertEqual(len(local), 0)
 
 
-class ScalingTests(TestCase):
+class SlowSearchBHRDB(BHRDB):
+    def get_history(self, query):
+        return super(SlowSearchBHRDB, self).get_history(query).extra(where=['(SELECT 1 FROM pg_sleep(1)) = 1'])
+
+
+class SearchTests(BHRTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+
+    def add(self, cidr, why, source='test'):
+        return self.db.add_block(cidr, self.user, source, why)
+
+    def test_search_history_ranks_exact_and_prefix_matches_first(self):
+        older_exact = self.add('1.2.3.1', 'ssh scan')
+        prefix = self.add('1.2.3.2', 'ssh scan from somewhere')
+        contains = self.add('1.2.3.3', 'another ssh scan')
+        self.add('1.2.3.4', 'http scan')
+        exact = self.add('1.2.3.5', 'ssh scan')
+        source = self.add('1.2.3.6', 'unrelated', source='ssh scan')
+
+        blocks = list(self.db.get_history('ssh scan'))
+        self.assertEqual([b.id for b in blocks], [source.id, exact.id, older_exact.id, prefix.id, contains.id])
+
+    def test_search_history_is_case_sensitive_and_literal(self):
+        self.add('1.2.3.1', 'SSH scan')
+        self.add('1.2.3.2', '100% sure')
+        self.assertEqual(list(self.db.get_history('ssh')), [])
+        self.assertEqual(len(self.db.get_history('100%')), 1)
+        self.assertEqual(list(self.db.get_history('1_0')), [])
+
+    def test_get_history_page(self):
+        for i in range(5):
+            self.add('1.2.3.%d' % i, 'scan %d' % i)
+
+        blocks, has_next = self.db.get_history_page('scan', page_size=2)
+        self.assertEqual([str(b.cidr) for b in blocks], ['1.2.3.4/32', '1.2.3.3/32'])
+        self.assertTrue(has_next)
+        blocks, has_next = self.db.get_history_page('scan', page=3, page_size=2)
+        self.assertEqual([str(b.cidr) for b in blocks], ['1.2.3.0/32'])
+        self.assertFalse(has_next)
+
+    def test_get_history_page_cidr(self):
+        self.add('1.2.3.4', 'scan')
+        blocks, has_next = self.db.get_history_page('1.2.3.0/24')
+        self.assertEqual(len(blocks), 1)
+        self.assertFalse(has_next)
+        self.add('fe80::1', 'scan')
+        self.assertEqual(len(self.db.get_history_page('fe80::/64')[0]), 1)
+
+    def test_get_history_page_timeout(self):
+        self.add('1.2.3.4', 'scan')
+        start = time.time()
+        with self.assertRaises(SearchTimeoutError):
+            SlowSearchBHRDB().get_history_page('scan', timeout=0.1)
+        self.assertLess(time.time() - start, 1)
+        # the timeout does not outlive the search
+        self.assertEqual(len(SlowSearchBHRDB().get_history_page('scan')[0]), 1)
+
+
+class ConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+
+    def run_concurrently(self, fn, args_list):
+        errors = []
+
+        def run(*args):
+            try:
+                fn(*args)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=args) for args in args_list]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_cidr_locks_only_wait_for_the_same_cidr(self):
+        lock_cidrs(['1.2.3.4'])  # existing and new rows lock alike
+        locked, waiting = threading.Event(), threading.Event()
+        results = {}
+
+        def hold():
+            with transaction.atomic():
+                lock_cidrs(['1.2.3.4', '1.2.3.5/32'])
+                locked.set()
+                waiting.wait(10)
+
+        def try_lock(cidr):
+            locked.wait(10)
+            try:
+                with transaction.atomic(), connection.cursor() as c:
+                    c.execute("SET LOCAL lock_timeout = '200ms'")
+                    lock_cidrs([cidr])
+                results[cidr] = True
+            except OperationalError:
+                results[cidr] = False
+
+        def check():
+            try:
+                for cidr in '1.2.3.4/32', '1.2.3.5', '1.2.3.6':
+                    try_lock(cidr)
+            finally:
+                waiting.set()
+
+        self.run_concurrently(lambda f: f(), [(hold,), (check,)])
+        self.assertEqual(results, {'1.2.3.4/32': False, '1.2.3.5': False, '1.2.3.6': True})
+
+    def test_concurrent_blocks_of_the_same_cidr_are_not_duplicated(self):
+        def add(cidr):
+            self.db.add_block(cidr, self.user, 'test', 'testing', duration=300)
+
+        self.run_concurrently(add, [('1.2.3.4',)] * 4 + [('1.2.3.4/32',)] * 4)
+        self.assertEqual(Block.objects.filter(cidr='1.2.3.4/32').count(), 1)
+
+    def test_concurrent_claims_are_disjoint(self):
+        for i in range(50):
+            self.db.add_block('1.2.3.%d' % i, self.user, 'test', 'testing')
+
+        claimed = []
+
+        def claim():
+            while True:
+                q = self.db.claim_block_queue('bgp1', 60, limit=5)
+                if not q:
+                    return
+                claimed.extend(b.id for b in q)
+
+        self.run_concurrently(claim, [()] * 4)
+        self.assertEqual(len(claimed), 50)
+        self.assertEqual(len(set(claimed)), 50)
+
+    def test_concurrent_acks_for_the_same_sources_do_not_deadlock(self):
+        new, entries = {}, {}
+        for n, source in enumerate(['s1', 's2']):
+            new[source] = self.db.add_block('1.2.%d.1' % n, self.user, source, 'testing', duration=300)
+            b = self.db.add_block('1.2.%d.2' % n, self.user, source, 'testing', duration=300)
+            entries[source] = self.db.set_blocked(b, 'bgp1')
+        barrier = threading.Barrier(2)
+
+        # Each transaction changes the counters of one source, then of the other
+        def ack(block, entry):
+            with transaction.atomic():
+                self.db.set_blocked_multi('bgp1', [block.id])
+                barrier.wait(timeout=10)
+                self.db.set_unblocked_multi([entry.id])
+
+        self.run_concurrently(ack, [(new['s1'], entries['s2']), (new['s2'], entries['s1'])])
+        self.assertEqual(self.db.verify_stats(), [])
+        self.db.sweep_stats()
+        self.assertEqual(self.db.verify_stats(), [])
+
+    def test_concurrent_multi_blocks_do_not_deadlock(self):
+        cidrs = ['1.2.3.%d' % i for i in range(20)]
+
+        def add(cidrs):
+            blocks = [dict(cidr=c, source='test', why='testing', duration=300) for c in cidrs]
+            self.db.add_block_multi(self.user, blocks)
+
+        self.run_concurrently(add, [(cidrs,), (cidrs[::-1],), (cidrs[5:],)])
+        self.assertEqual(Block.objects.count(), 20)
+
+
+class LongPollTests(TransactionTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_blockentry'))
+        self.client.login(username='admin', password='admin')
+
+    def test_block_queue_wakes_up_on_new_block(self):
+        def add():
+            sleep(0.5)
+            self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=300)
+            connection.close()
+
+        t = threading.Thread(target=add)
+        start = time.time()
+        t.start()
+        data = self.client.get("/bhr/api/queue/bgp1", {'timeout': 10}).data
+        t.join()
+        self.assertEqual(len(data), 1)
+        # polling would only notice the block after a full second
+        self.assertLess(time.time() - start, 0.9)
+
+
+class ScalingTests(BHRTestCase):
     def setUp(self):
         self.db = BHRDB()
         self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
@@ -326,6 +952,46 @@ class ScalingTests(TestCase):
 
         self.assertAlmostEqual(lb.duration.total_seconds(), 10, places=1)
 
+    def assertSummaryMatchesBlocks(self):
+        summaries = {(str(s.cidr), s.last_block_id, s.added, s.unblock_at, s.block_count)
+                     for s in OffenderSummary.objects.all()}
+        expected = set()
+        for cidr in set(Block.objects.values_list('cidr', flat=True)):
+            blocks = Block.objects.filter(cidr=cidr).order_by('-added', '-id')
+            b = blocks[0]
+            expected.add((str(cidr), b.id, b.added, b.unblock_at, blocks.count()))
+        self.assertEqual(summaries, expected)
+
+    def test_offender_summary(self):
+        self.add_older_block(60, 30)
+        self.assertSummaryMatchesBlocks()
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=10)
+        self.db.add_block_multi(self.user, [dict(cidr='1.2.3.%d' % (i % 3), source='test', why='testing')
+                                            for i in range(6)])
+        self.assertSummaryMatchesBlocks()
+        self.assertEqual(OffenderSummary.objects.get(cidr='1.2.3.4').block_count, 2)
+
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=600)
+        self.assertSummaryMatchesBlocks()
+        self.db.unblock_now('1.2.3.4', self.user, 'testing')
+        self.assertSummaryMatchesBlocks()
+        self.assertEqual(self.db.get_last_block('1.2.3.4'), b)
+
+        b.delete()
+        self.assertSummaryMatchesBlocks()
+        BlockEntry.objects.all().delete()
+        Block.objects.all().delete()
+        self.assertFalse(OffenderSummary.objects.exists())
+
+    def test_autoscale_batch(self):
+        self.add_older_block(60 * 60, 60 * 5)
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr='1.2.3.4', source='test', why='testing', duration=60 * 5, autoscale=True),
+            dict(cidr='1.2.3.5', source='test', why='testing', duration=60 * 5, autoscale=True),
+        ])
+        self.assertAlmostEqual(blocks[0].duration.total_seconds(), 60 * 10, places=0)
+        self.assertAlmostEqual(blocks[1].duration.total_seconds(), 60 * 5, places=0)
+
     def test_that_scaling_doesnt_break_with_manual_unblock(self):
         b1 = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=None)
         self.db.unblock_now('1.2.3.4', self.user, 'testing')
@@ -352,13 +1018,17 @@ class ScalingTests(TestCase):
             expected_duration=60*60*24)
 
 
-class ApiTest(TestCase):
+class ApiTest(BHRTestCase):
     def setUp(self):
         self.user = user = User.objects.create_user('admin', 'temporary@gmail.com', 'admin')
         self.client.login(username='admin', password='admin')
         for perm in 'add_block change_block add_blockentry change_blockentry'.split():
             self.user.user_permissions.add(Permission.objects.get(codename=perm))
 
+    def _get_json(self, url, params=None):
+        response = self.client.get(url, params)
+        return json.loads(b"".join(response.streaming_content).decode())
+
     def _add_block(self, cidr='1.2.3.4', duration=30, skip_whitelist=0, source='test', extend=False, why='testing'):
         return self.client.post('/bhr/api/block', dict(
             cidr=cidr,
@@ -373,6 +1043,22 @@ class ApiTest(TestCase):
         response = self._add_block()
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    def test_block_and_entry_api_writes_keep_active_entries(self):
+        self._add_block()
+        id = Block.objects.get().id
+        self.client.post("/bhr/api/set_blocked_multi/bgp1", data=json.dumps({"ids": [id]}),
+                         content_type="application/json")
+        response = self.client.patch("/bhr/api/blocks/%d/" % id, data=json.dumps({"why": "edited"}),
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Block.objects.get(pk=id).active_entries, 1)
+
+        self.user.user_permissions.add(Permission.objects.get(codename='delete_blockentry'))
+        entry = BlockEntry.objects.get(block_id=id)
+        response = self.client.delete("/bhr/api/blockentries/%d/" % entry.id)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Block.objects.get(pk=id).active_entries, 0)
+
     def test_block_twice_returns_the_same_block(self):
         r1 = self._add_block().data
         r2 = self._add_block().data
@@ -410,6 +1096,55 @@ class ApiTest(TestCase):
         self.assertEqual(len(data), 1)
         self.assertEqual(data[0]['cidr'], '1.2.3.4/32')
 
+    def test_block_queue_timeout_returns_existing_blocks(self):
+        self._add_block()
+        start = time.time()
+        data = self.client.get("/bhr/api/queue/bgp1", {'timeout': 5}).data
+        self.assertEqual(len(data), 1)
+        self.assertLess(time.time() - start, 1)
+
+    def test_block_queue_timeout_falls_back_to_polling(self):
+        # notifications are never delivered inside the test transaction
+        start = time.time()
+        data = self.client.get("/bhr/api/queue/bgp1", {'timeout': 1}).data
+        self.assertEqual(len(data), 0)
+        self.assertGreaterEqual(time.time() - start, 1)
+
+    def test_block_queue_lease(self):
+        self._add_block('1.2.3.4')
+        self._add_block('1.2.3.5')
+
+        first = self.client.get("/bhr/api/queue/bgp1", {'lease': 60}).data
+        second = self.client.get("/bhr/api/queue/bgp1", {'lease': 60}).data
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 0)
+
+        # without a lease the queue is unchanged
+        self.assertEqual(len(self.client.get("/bhr/api/queue/bgp1").data), 2)
+
+    def test_queues_reject_bad_parameters(self):
+        for url, params in [("/bhr/api/queue/bgp1", {'lease': 'abc'}),
+                            ("/bhr/api/queue/bgp1", {'timeout': 'abc'}),
+                            ("/bhr/api/queue/bgp1", {'lease': -1}),
+                            ("/bhr/api/unblock_queue/bgp1", {'lease': 'abc'}),
+                            ("/bhr/api/cursor_queue/bgp1", {'cursor': 'abc'}),
+                            ("/bhr/api/cursor_queue/bgp1", {'cursor': 2**63})]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, (url, params))
+            self.assertIn(list(params)[0], response.data)
+
+    def test_cursor_queue(self):
+        data = self.client.get("/bhr/api/cursor_queue/bgp1").data
+        self.assertEqual(data['blocks'], [])
+        self._add_block()
+
+        data = self.client.get("/bhr/api/cursor_queue/bgp1", {'cursor': data['cursor']}).data
+        self.assertEqual(len(data['blocks']), 1)
+        self.assertEqual(data['blocks'][0]['cidr'], '1.2.3.4/32')
+
+        data = self.client.get("/bhr/api/cursor_queue/bgp1", {'cursor': data['cursor']}).data
+        self.assertEqual(data['blocks'], [])
+
     def test_unblock_queue(self):
         data = self.client.get("/bhr/api/unblock_queue/bgp1").data
         self.assertEqual(len(data), 0)
@@ -461,12 +1196,12 @@ class ApiTest(TestCase):
 
         block = self.client.get("/bhr/api/queue/bgp1").data[0]
 
-        data = self.client.get("/bhr/api/pending_blocks/").data
+        data = self._get_json("/bhr/api/pending_blocks/")
         self.assertEqual(data[0]['cidr'], '1.2.3.4/32')
 
         self.client.post(block['set_blocked'], dict(ident='bgp1'))
 
-        data = self.client.get("/bhr/api/pending_blocks/").data
+        data = self._get_json("/bhr/api/pending_blocks/")
         self.assertEqual(len(data), 0)
 
     def test_current_blocks(self):
@@ -474,12 +1209,12 @@ class ApiTest(TestCase):
 
         block = self.client.get("/bhr/api/queue/bgp1").data[0]
 
-        data = self.client.get("/bhr/api/current_blocks/").data
+        data = self._get_json("/bhr/api/current_blocks/")
         self.assertEqual(len(data), 0)
 
         self.client.post(block['set_blocked'], dict(ident='bgp1'))
 
-        data = self.client.get("/bhr/api/current_blocks/").data
+        data = self._get_json("/bhr/api/current_blocks/")
         self.assertEqual(data[0]['cidr'], '1.2.3.4/32')
 
     def test_history(self):
@@ -508,11 +1243,90 @@ class ApiTest(TestCase):
         hist = self.client.get("/bhr/api/query/1.2.3.4").data
         self.assertEqual(len(hist), 2)
 
+    def test_covering_blocks(self):
+        db = BHRDB()
+        net24 = db.add_block('1.2.3.0/24', self.user, 'test', 'testing', skip_whitelist=True)
+        db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        db.add_block('1.2.0.0/16', self.user, 'test', 'testing', skip_whitelist=True).unblock_now(self.user, 'test')
+        expired = db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        Block.objects.filter(pk=expired.pk).update(unblock_at=timezone.now() - datetime.timedelta(seconds=1))
+        db.add_block('2001:db8::/64', self.user, 'test', 'testing')
+
+        def covering(cidr):
+            return [b['cidr'] for b in self.client.get("/bhr/api/covering/" + cidr).data]
+
+        self.assertEqual(covering('1.2.3.4'), ['1.2.3.4/32', '1.2.3.0/24'])
+        self.assertEqual(covering('1.2.3.5'), ['1.2.3.0/24'])
+        self.assertEqual(covering('1.2.3.0/25'), ['1.2.3.0/24'])
+        self.assertEqual(covering('1.2.0.0/16'), [])
+        self.assertEqual(covering('2001:db8::1'), ['2001:db8::/64'])
+        self.assertEqual(self.client.get("/bhr/api/covering/1.2.3.4").data[1]['url'],
+                         'http://testserver/bhr/api/blocks/%d/' % net24.id)
+        # the same JSON as the serializers of the history
+        self.assertEqual(JSONRenderer().render(self.client.get("/bhr/api/covering/1.2.3.4").data[1]),
+                         JSONRenderer().render([b for b in self.client.get("/bhr/api/query/1.2.3.0/24").data
+                                                if b['cidr'] == '1.2.3.0/24'][0]))
+        self.assertEqual(self.client.get("/bhr/api/covering/nonsense").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_covering_blocks_uses_the_gist_index(self):
+        with connection.cursor() as c:
+            c.execute("SET LOCAL enable_seqscan = off")
+            c.execute("EXPLAIN " + COVERING_BLOCKS_SQL, ['1.2.3.4', timezone.now()])
+            plan = "\n".join(row[0] for row in c.fetchall())
+        self.assertIn("bhr_block_cidr_gist", plan)
+        self.assertIn("bhr_block_cidr_gist", Block.objects.filter(cidr__covers_cidr='1.2.3.4').explain())
+
+    def test_batch_covering_blocks_uses_the_gist_index(self):
+        with connection.cursor() as c:
+            c.execute("SET LOCAL enable_seqscan = off")
+            c.execute("EXPLAIN " + BATCH_COVERING_BLOCKS_SQL, [['1.2.3.4', '1.2.4.4'], timezone.now()])
+            plan = "\n".join(row[0] for row in c.fetchall())
+        self.assertIn("bhr_block_cidr_gist", plan)
+
+    def test_covers_cidr_lookup(self):
+        BHRDB().add_block('1.2.3.0/24', self.user, 'test', 'testing', skip_whitelist=True)
+        self.assertEqual(Block.objects.filter(cidr__covers_cidr='1.2.3.4').count(), 1)
+        self.assertEqual(Block.objects.filter(cidr__covers_cidr='1.2.3.0/24').count(), 1)
+        self.assertEqual(Block.objects.filter(cidr__covers_cidr='1.2.0.0/16').count(), 0)
+
+    def test_lookup(self):
+        self._add_block('1.2.3.4', source='one')
+        self._add_block('2001:db8::1', source='six')
+        bhr.models._expected_block_index = None
+        response = self.client.post('/bhr/api/lookup', {'ips': ['1.2.3.4', '1.2.3.5', '2001:db8::1']}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = json.loads(response.content.decode())['results']
+        self.assertEqual(sorted(results), ['1.2.3.4', '2001:db8::1'])
+        block = results['1.2.3.4'][0]
+        self.assertEqual(block['cidr'], '1.2.3.4/32')
+        self.assertEqual(block['source'], 'one')
+        self.assertEqual(block['unblock_at'], self.client.get("/bhr/api/query/1.2.3.4").data[0]['unblock_at'])
+
+        response = self.client.post('/bhr/api/lookup', {'ips': ['1.2.3.4', 'nonsense']}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for data in {'ips': '1.2.3.4'}, {'ips': [1]}, ['1.2.3.4'], {}:
+            response = self.client.post('/bhr/api/lookup', data, content_type="application/json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_preflight(self):
+        self._add_block('1.2.3.4')
+        response = self.client.post('/bhr/api/preflight', {'source': 'test', 'cidrs': ['1.2.3.4', '1.2.3.5'], 'duration': '1h'},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        verdicts = response.data
+        self.assertEqual([(v['cidr'], v['status']) for v in verdicts], [('1.2.3.4', 'extend'), ('1.2.3.5', 'block')])
+        self.assertEqual(verdicts[0]['unblock_at'], self.client.get("/bhr/api/query/1.2.3.4").data[0]['unblock_at'])
+        self.assertEqual(len(self.client.get("/bhr/api/query/1.2.3.5").data), 0)
+
+        response = self.client.post('/bhr/api/preflight', {'source': 'test', 'cidrs': ['1.2.3.4', 'nonsense']},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_all_in_one(self):
         """Test everything.  Not so useful if things fail, but useful to see how things work"""
 
         def check(which, cnt):
-            data = self.client.get("/bhr/api/%s_blocks/" % which).data
+            data = self._get_json("/bhr/api/%s_blocks/" % which)
             self.assertEqual(len(data), cnt, which)
 
         def check_counts(pending=0, current=0, expected=0):
@@ -582,10 +1396,14 @@ class ApiTest(TestCase):
         q = self.client.get("/bhr/api/unblock_queue/bgp2").data
         self.assertEqual(len(q), 0, "there should be no unblock queue for bgp2")
 
+    def _get_csv(self, url, params=None):
+        response = self.client.get(url, params)
+        return b"".join(response.streaming_content).decode()
+
     def test_list_csv(self):
         self._add_block(duration=30)
 
-        csv_txt = self.client.get("/bhr/list.csv").content.decode()
+        csv_txt = self._get_csv("/bhr/list.csv")
 
         data = list(csv.DictReader(csv_txt.splitlines()))
 
@@ -599,7 +1417,7 @@ class ApiTest(TestCase):
         sleep(.1)
         self._add_block(cidr='1.1.1.2', duration=30, why='block 2')
 
-        csv_txt = self.client.get("/bhr/list.csv").content.decode()
+        csv_txt = self._get_csv("/bhr/list.csv")
         data = list(csv.DictReader(csv_txt.splitlines()))
 
         self.assertEqual(len(data), 2)
@@ -611,16 +1429,193 @@ class ApiTest(TestCase):
         self._add_block(cidr='1.1.1.3', duration=30, why='block 3')
 
         # due to the use of >= this will get the last record again
-        csv_txt = self.client.get("/bhr/list.csv", {'since': added}).content.decode()
+        csv_txt = self._get_csv("/bhr/list.csv", {'since': added})
         data = list(csv.DictReader(csv_txt.splitlines()))
         self.assertEqual(len(data), 2)
         self.assertEqual(data[0]['why'], "block 2")
         self.assertEqual(data[1]['why'], "block 3")
 
+    def test_publist_csv_streams(self):
+        self._add_block('1.2.3.4', duration=30)
+        self._add_block('1.2.3.5', duration=30)
+
+        response = self.client.get("/bhr/publist.csv")
+        self.assertTrue(response.streaming)
+        data = list(csv.DictReader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(sorted(d['cidr'] for d in data), ['1.2.3.4/32', '1.2.3.5/32'])
+        self.assertEqual(list(data[0]), ['cidr', 'added', 'unblock_at'])
+
+    def test_conditional_get(self):
+        self._add_block('1.2.3.4', duration=30)
+        for url in "/bhr/publist.csv", "/bhr/list.csv", "/bhr/api/expected_blocks/":
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Last-Modified', response)
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_conditional_get_changes(self):
+        self._add_block('1.2.3.4', duration=30)
+        etag = self.client.get("/bhr/publist.csv")['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/bhr/publist.csv", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len([q for q in queries if 'bhr_' in q['sql']]), 1)
+
+        # expiring a block changes the set without a new version
+        Block.objects.update(unblock_at=timezone.now())
+        expired_etag = self.client.get("/bhr/publist.csv")['ETag']
+        self.assertNotEqual(expired_etag, etag)
+
+        self._add_block('1.2.3.5', duration=30)
+        response = self.client.get("/bhr/publist.csv", HTTP_IF_NONE_MATCH=expired_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], expired_etag)
+
+    def _get_delta(self, cursor=None, fmt='jsonl'):
+        params = {'cursor': cursor} if cursor else {}
+        response = self.client.get("/bhr/delta." + fmt, params)
+        body = b"".join(response.streaming_content).decode()
+        if fmt == 'csv':
+            rows = list(csv.DictReader(body.splitlines()))
+        else:
+            rows = [json.loads(line) for line in body.splitlines()]
+        return response['X-BHR-Cursor'], [(r['action'], r['cidr']) for r in rows]
+
+    def test_delta(self):
+        self._add_block('1.2.3.4', duration=30)
+        cursor, rows = self._get_delta()
+        self.assertEqual(rows, [('add', '1.2.3.4/32')])
+
+        cursor, rows = self._get_delta(cursor)
+        self.assertEqual(rows, [])
+
+        self._add_block('1.2.3.5', duration=30)
+        self._add_block('1.2.3.4', duration=60, extend=True)
+        cursor, rows = self._get_delta(cursor, fmt='csv')
+        self.assertEqual(rows, [('modify', '1.2.3.4/32'), ('add', '1.2.3.5/32')])
+
+        self.client.post("/bhr/api/unblock_now", dict(cidr='1.2.3.5', why='testing'))
+        Block.objects.filter(cidr='1.2.3.4').update(unblock_at=timezone.now())
+        self._add_block('1.2.3.5', duration=30)
+        cursor, rows = self._get_delta(cursor)
+        self.assertEqual(rows, [('remove', '1.2.3.4/32'), ('remove', '1.2.3.5/32'), ('add', '1.2.3.5/32')])
+
+        cursor, rows = self._get_delta(cursor)
+        self.assertEqual(rows, [])
+
+    def test_delta_block_edits(self):
+        self._add_block('1.2.3.4', duration=30)
+        id = Block.objects.get().id
+        cursor, rows = self._get_delta()
+        etag = self.client.get("/bhr/publist.csv")['ETag']
+
+        unblock_at = (timezone.now() + datetime.timedelta(hours=1)).isoformat()
+        response = self.client.patch("/bhr/api/blocks/%d/" % id, data=json.dumps({"unblock_at": unblock_at}),
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(self.client.get("/bhr/publist.csv")['ETag'], etag)
+        cursor, rows = self._get_delta(cursor)
+        self.assertEqual(rows, [('modify', '1.2.3.4/32')])
+
+        b = Block.objects.get()
+        b.why = 'edited'
+        b.save()
+        self.assertEqual(self._get_delta(cursor)[1], [])
+
+        b.forced_unblock = True
+        b.save()
+        cursor, rows = self._get_delta(cursor)
+        self.assertEqual(rows, [('remove', '1.2.3.4/32')])
+
+    def test_delta_invalid_cursor(self):
+        for cursor in 'banana', '1-99999999999999999999999':
+            response = self.client.get("/bhr/delta.csv", {'cursor': cursor})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _get_export(self, fmt, **params):
+        response = self.client.get("/bhr/export/" + fmt, params)
+        return b"".join(response.streaming_content).decode().splitlines()
+
+    def test_export_aggregates_around_whitelist(self):
+        WhitelistEntry(who=self.user, why='test', cidr='10.0.0.2/32').save()
+        for i in 0, 1, 3, 4, 5, 6, 7:
+            self._add_block('10.0.0.%d' % i)
+        self._add_block('2001:db8::1')
+
+        cidrs = self._get_export('cidr')
+        self.assertEqual(cidrs, ['10.0.0.0/31', '10.0.0.3/32', '10.0.0.4/30', '2001:db8::1/128'])
+        self.assertFalse(any(is_whitelisted(c) for c in cidrs))
+
+    def test_export_ipset(self):
+        self._add_block('10.0.0.0')
+        self._add_block('10.0.0.1')
+        self.assertEqual(self._get_export('ipset', name='blocked'), [
+            'create blocked-v4 hash:net family inet -exist',
+            'create blocked-v4-tmp hash:net family inet maxelem 65536 -exist',
+            'flush blocked-v4-tmp',
+            'add blocked-v4-tmp 10.0.0.0/31',
+            'swap blocked-v4-tmp blocked-v4',
+            'destroy blocked-v4-tmp',
+            'create blocked-v6 hash:net family inet6 -exist',
+            'create blocked-v6-tmp hash:net family inet6 maxelem 65536 -exist',
+            'flush blocked-v6-tmp',
+            'swap blocked-v6-tmp blocked-v6',
+            'destroy blocked-v6-tmp',
+        ])
+
+    def test_export_nft(self):
+        self._add_block('10.0.0.0')
+        self._add_block('2001:db8::1')
+        self.assertEqual(self._get_export('nft', table='bhr'), [
+            'flush set inet bhr bhr_v4',
+            'add element inet bhr bhr_v4 { 10.0.0.0/32 }',
+            'flush set inet bhr bhr_v6',
+            'add element inet bhr bhr_v6 { 2001:db8::1/128 }',
+        ])
+        response = self.client.get("/bhr/export/nft", {'table': 'bhr; flush ruleset'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_block_lists_stream(self):
+        for i in range(5):
+            self._add_block('1.2.3.%d' % i, why=u'\u0153 %d' % i)
+        for url in "/bhr/api/current_blocks/", "/bhr/api/expected_blocks/", "/bhr/api/pending_blocks/":
+            response = self.client.get(url)
+            self.assertTrue(response.streaming)
+            data = json.loads(b"".join(response.streaming_content).decode())
+            self.assertEqual(len(data), 0 if url == "/bhr/api/current_blocks/" else 5)
+
+    def test_block_list_stream_matches_rendered(self):
+        from bhr.views import PendingBlockViewset
+        for i in range(5):
+            self._add_block('1.2.3.%d' % i, why=u'\u0153 %d' % i)
+        PendingBlockViewset.chunk_size = 2
+        self.addCleanup(delattr, PendingBlockViewset, 'chunk_size')
+
+        streamed = b"".join(self.client.get("/bhr/api/pending_blocks/").streaming_content)
+        rendered = self.client.get("/bhr/api/pending_blocks/", {'page_size': 100}).data['results']
+        self.assertEqual(streamed, JSONRenderer().render(rendered))
+
+        lines = b"".join(self.client.get("/bhr/api/pending_blocks/", HTTP_ACCEPT='application/x-ndjson').streaming_content)
+        self.assertEqual([json.loads(line) for line in lines.splitlines()], json.loads(streamed.decode()))
+
+    def test_block_list_pagination(self):
+        for i in range(5):
+            self._add_block('1.2.3.%d' % i)
+        seen = []
+        url = "/bhr/api/expected_blocks/?page_size=2"
+        while url:
+            data = self.client.get(url).data
+            self.assertLessEqual(len(data['results']), 2)
+            seen.extend(b['cidr'] for b in data['results'])
+            url = data['next']
+        self.assertEqual(seen, ['1.2.3.%d/32' % i for i in range(5)])
+
     def test_list_csv_unicode_crap(self):
         unicode_crap = u'\u0153\u2211\xb4\xae\u2020\xa5\xa8\u02c6\xf8\u03c0\u201c\u2018'
         self._add_block(why=unicode_crap)
-        csv_txt = self.client.get("/bhr/list.csv").content.decode()
+        csv_txt = self._get_csv("/bhr/list.csv")
 
         data = list(csv.DictReader(csv_txt.splitlines()))
         self.assertEqual(len(data), 1)
@@ -638,6 +1633,31 @@ class ApiTest(TestCase):
         q = self.client.get("/bhr/api/queue/bgp1").data
         self.assertEqual(len(q), 0)
 
+    def test_set_blocked_multi_results(self):
+        self._add_block('1.2.3.4')
+        id = self.client.get("/bhr/api/queue/bgp1").data[0]['id']
+
+        data = json.dumps({"ids": [id, id + 1000]})
+        response = self.client.post("/bhr/api/set_blocked_multi/bgp1", data=data, content_type="application/json")
+        self.assertEqual(response.data, {'status': 'ok', 'results': [
+            {'id': id, 'status': 'ok'},
+            {'id': id + 1000, 'status': 'unknown'},
+        ]})
+
+        response = self.client.post("/bhr/api/set_blocked_multi/bgp1", data=data, content_type="application/json")
+        self.assertEqual(response.data['results'][0], {'id': id, 'status': 'already-acked'})
+
+    def test_set_blocked_multi_rejects_bad_ids(self):
+        for url in "/bhr/api/set_blocked_multi/bgp1", "/bhr/api/set_unblocked_multi":
+            for data in {}, {"ids": ["x"]}, {"ids": [None]}, {"ids": 1}, {"ids": [99999999999]}, {"ids": [0]}:
+                response = self.client.post(url, data=json.dumps(data), content_type="application/json")
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('ids', response.data)
+        for field in 'blocked', 'unblocked':
+            response = self.client.post("/bhr/api/sync/bgp1", data=json.dumps({field: [99999999999]}),
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_set_unblocked_multi(self):
         self._add_block('1.2.3.4', duration=2)
         self._add_block('4.3.2.1', duration=2)
@@ -667,6 +1687,35 @@ class ApiTest(TestCase):
         blocks = self.client.get("/bhr/api/unblock_queue/bgp1").data
         self.assertEqual(len(blocks), 0)
 
+    def _sync(self, ident='bgp1', **data):
+        return self.client.post("/bhr/api/sync/" + ident, data=json.dumps(data), content_type="application/json")
+
+    def test_sync(self):
+        self._add_block('1.2.3.4', duration=1)
+        self._add_block('4.3.2.1', duration=1)
+
+        data = self._sync().data
+        self.assertEqual(len(data['block_queue']), 2)
+        self.assertEqual(data['unblock_queue'], [])
+
+        sleep(2)
+        data = self._sync(blocked=[b['id'] for b in data['block_queue']]).data
+        self.assertEqual(data['block_queue'], [])
+        self.assertEqual(len(data['unblock_queue']), 2)
+        self.assertEqual(data['unblock_queue'][0]['block']['cidr'], '1.2.3.4/32')
+
+        data = self._sync(unblocked=[e['id'] for e in data['unblock_queue']]).data
+        self.assertEqual(data, {'block_queue': [], 'unblock_queue': []})
+
+    def test_sync_lease(self):
+        self._add_block('1.2.3.4')
+        self.assertEqual(len(self._sync(lease=60).data['block_queue']), 1)
+        self.assertEqual(len(self._sync(lease=60).data['block_queue']), 0)
+
+    def test_sync_invalid(self):
+        response = self._sync(blocked='banana')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_stats(self):
         self._add_block('1.2.3.4', duration=2)
         self._add_block('4.3.2.1', duration=2)
@@ -679,13 +1728,13 @@ class ApiTest(TestCase):
         self._add_block('2.2.2.1', source='two')
         self._add_block('2.2.2.2', source='two')
         
-        blocks = self.client.get("/bhr/api/expected_blocks/").data
+        blocks = self._get_json("/bhr/api/expected_blocks/")
         self.assertEqual(len(blocks), 3)
 
-        blocks = self.client.get("/bhr/api/expected_blocks/?source=one").data
+        blocks = self._get_json("/bhr/api/expected_blocks/?source=one")
         self.assertEqual(len(blocks), 1)
 
-        blocks = self.client.get("/bhr/api/expected_blocks/?source=two").data
+        blocks = self._get_json("/bhr/api/expected_blocks/?source=two")
         self.assertEqual(len(blocks), 2)
 
     def test_double_block_race_condition(self):
@@ -739,7 +1788,248 @@ class ApiTest(TestCase):
         self.assertEqual(block['unblock_at'], None)
 
 
-class UtilTest(TestCase):
+class FastSerializerTest(BHRTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        self.db.add_block('2001:db8::/64', self.user, 'test', 'testing "quoted" \u2603', duration=30)
+        b = self.db.add_block('10.0.0.0/24', self.user, 'other', 'testing', duration=1, skip_whitelist=True)
+        self.db.set_blocked(b, 'bgp1')
+        Block.objects.filter(pk=b.pk).update(unblock_at=timezone.now() - datetime.timedelta(seconds=1))
+        BlockEntry.objects.filter(block=b).update(unblock_at=timezone.now() - datetime.timedelta(seconds=1))
+
+    def assertSameJSON(self, fast_serializer_class, rows, path='/bhr/api/queue/bgp1'):
+        for params in {}, {'format': 'json'}:
+            context = {'request': RequestFactory().get(path, params)}
+            expected = fast_serializer_class.serializer_class(rows, many=True, context=context).data
+            self.assertTrue(expected)
+            self.assertEqual(JSONRenderer().render(fast_serializer_class(context).data(rows)),
+                             JSONRenderer().render(expected))
+            self.assertEqual(JSONRenderer().render(fast_serializer_class(context).data(list(rows))),
+                             JSONRenderer().render(expected))
+
+    def test_block(self):
+        self.assertSameJSON(FastBlockSerializer, Block.objects.order_by('id'))
+
+    def test_block_brief(self):
+        self.assertSameJSON(FastBlockBriefSerializer, Block.objects.order_by('id'))
+
+    def test_block_queue(self):
+        self.assertSameJSON(FastBlockQueueSerializer, Block.objects.order_by('id'))
+        self.assertSameJSON(FastBlockQueueSerializer, list(self.db.block_queue('bgp1')))
+
+    def test_unblock_entry(self):
+        self.assertSameJSON(FastUnBlockEntrySerializer, self.db.unblock_queue('bgp1')[:200])
+
+    def test_queryset_is_read_with_values(self):
+        context = {'request': RequestFactory().get('/')}
+        self.assertEqual(count_queries(FastBlockSerializer(context).data, Block.objects.all()), 1)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class QueryBudgetTest(BHRTestCase):
+    """The number of queries an endpoint makes must not grow with the number of rows it handles"""
+
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_superuser('admin', 'a@b.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.added = 0
+
+    def add_rows(self, count):
+        """Add count each of whitelist entries, queued, current and expiring blocks"""
+        first = 4 * self.added
+        self.added += count
+        cidrs = [str(ipaddress.ip_address(int(ipaddress.ip_address('10.0.0.0')) + first + i)) for i in range(4 * count)]
+        WhitelistEntry.objects.bulk_create(
+            WhitelistEntry(cidr=str(ipaddress.ip_address(int(ipaddress.ip_address('192.168.0.0')) + first + i)),
+                           who=self.user, why='test')
+            for i in range(count))
+        blocks = self.db.add_block_multi(self.user, [
+            dict(cidr=cidr, source='test-%d' % (i % 3), why='testing', duration=300) for i, cidr in enumerate(cidrs)])
+        blocked = [b.id for b in blocks[count:]]
+        self.db.set_blocked_multi('bgp1', blocked)
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        Block.objects.filter(id__in=blocked[-count:]).update(unblock_at=past)
+        BlockEntry.objects.filter(block_id__in=blocked[-count:]).update(unblock_at=past)
+
+    def consume(self, response):
+        self.assertLess(response.status_code, 400, response)
+        if response.streaming:
+            b"".join(response.streaming_content)
+
+    def assertQueriesConstant(self, fn):
+        self.add_rows(2)
+        few = count_queries(fn)
+        self.add_rows(5)
+        self.assertEqual(count_queries(fn), few)
+
+    def assertGetConstant(self, url, params=None, **extra):
+        self.assertQueriesConstant(lambda: self.consume(self.client.get(url, params, **extra)))
+
+    def test_api_lists(self):
+        for url in ['/bhr/api/whitelist/', '/bhr/api/blocks/', '/bhr/api/blockentries/',
+                    '/bhr/api/current_blocks/', '/bhr/api/expected_blocks/', '/bhr/api/pending_blocks/',
+                    '/bhr/api/current_blocks_brief/', '/bhr/api/pending_removal_blocks/',
+                    '/bhr/api/query/10.0.0.0/8', '/bhr/api/covering/10.0.0.1', '/bhr/api/stats',
+                    '/bhr/api/source_stats']:
+            with self.subTest(url=url):
+                self.assertGetConstant(url)
+
+    def test_api_list_formats(self):
+        for params in {'format': 'api'}, {'format': 'ndjson'}, {'page_size': 100}:
+            with self.subTest(params=params):
+                self.assertGetConstant('/bhr/api/current_blocks/', params)
+
+    def test_exports(self):
+        for url in ['/bhr/list.csv', '/bhr/publist.csv', '/bhr/delta.csv', '/bhr/delta.jsonl',
+                    '/bhr/export/cidr', '/bhr/export/ipset', '/bhr/export/nft']:
+            with self.subTest(url=url):
+                self.assertGetConstant(url)
+
+    def test_queues(self):
+        for url, params in [('/bhr/api/queue/bgp2', None), ('/bhr/api/queue/bgp2', {'lease': 60}),
+                            ('/bhr/api/cursor_queue/bgp2', None),
+                            ('/bhr/api/unblock_queue/bgp1', None), ('/bhr/api/unblock_queue/bgp1', {'lease': 60})]:
+            with self.subTest(url=url, params=params):
+                self.assertGetConstant(url, params)
+
+    def test_sync(self):
+        for lease in 0, 60:
+            with self.subTest(lease=lease):
+                def sync():
+                    data = self.client.post('/bhr/api/sync/bgp1', {'lease': lease}, content_type="application/json").data
+                    self.assertTrue(data['block_queue'])
+                    self.assertTrue(data['unblock_queue'] or lease)
+                self.assertQueriesConstant(sync)
+
+    def test_acks(self):
+        def set_blocked_multi():
+            ids = list(Block.current.values_list('id', flat=True))
+            self.consume(self.client.post('/bhr/api/set_blocked_multi/bgp4', {'ids': ids}, content_type="application/json"))
+
+        def set_unblocked_multi():
+            ids = list(BlockEntry.objects.filter(removed__isnull=True).values_list('id', flat=True))
+            self.consume(self.client.post('/bhr/api/set_unblocked_multi', {'ids': ids}, content_type="application/json"))
+
+        self.assertQueriesConstant(set_blocked_multi)
+        self.assertQueriesConstant(set_unblocked_multi)
+
+    def test_lookup(self):
+        def lookup():
+            bhr.models._expected_block_index = None
+            ips = [str(cidr.network_address) for cidr in Block.objects.values_list('cidr', flat=True)]
+            self.consume(self.client.post('/bhr/api/lookup', {'ips': ips}, content_type="application/json"))
+
+        self.assertQueriesConstant(lookup)
+
+    def test_preflight(self):
+        def preflight():
+            cidrs = [str(cidr) for cidr in Block.objects.values_list('cidr', flat=True)]
+            self.consume(self.client.post('/bhr/api/preflight', {'source': 'test-1', 'cidrs': cidrs, 'duration': 600},
+                                          content_type="application/json"))
+
+        self.assertQueriesConstant(preflight)
+
+    def test_browser_pages(self):
+        for url, params in [('/bhr/list', None), ('/bhr/list/source/test-1', None), ('/bhr/stats', None),
+                            ('/bhr/query', {'query': '10.0.0.0/8'}), ('/bhr/query', {'query': 'testing'})]:
+            with self.subTest(url=url, params=params):
+                self.assertGetConstant(url, params)
+
+    def test_unblock_pages(self):
+        def unblock():
+            ids = [str(id) for id in Block.current.values_list('id', flat=True)]
+            self.consume(self.client.post('/bhr/unblock', {'block_id': ids, 'query': 'list'}))
+
+        def do_unblock():
+            ids = " ".join(str(id) for id in Block.current.values_list('id', flat=True))
+            self.consume(self.client.post('/bhr/do_unblock', {'block_ids': ids, 'query': 'list', 'why': 'test'}))
+
+        self.assertQueriesConstant(unblock)
+        self.assertQueriesConstant(do_unblock)
+        self.assertFalse(Block.current.filter(forced_unblock=False).exists())
+
+
+class ExportTest(BHRTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('admin', 'temporary@gmail.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_block'))
+        self.db = BHRDB()
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=30)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        settings_override = override_settings(BHR=dict(settings.BHR, export_dir=self.dir))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_write_exports(self):
+        self.assertEqual(write_exports(), ['list.csv', 'publist.csv'])
+        self.assertEqual(write_exports(), [])
+
+        export = get_export_file('publist.csv')
+        with export.open() as f:
+            data = list(csv.DictReader(f.read().decode().splitlines()))
+        self.assertEqual([d['cidr'] for d in data], ['1.2.3.4/32'])
+        with export.open(gzipped=True) as f, export.open() as plain:
+            self.assertEqual(gzip.decompress(f.read()), plain.read())
+
+        for i in range(3):
+            self.db.add_block('1.2.3.%d' % (10 + i), self.user, 'test', 'testing')
+            self.assertEqual(write_exports(), ['list.csv', 'publist.csv'])
+        # the current and the previous version are kept
+        self.assertEqual(len([f for f in os.listdir(self.dir) if f.startswith('publist.csv-')]), 4)
+
+    def test_served_from_file(self):
+        call_command('export_blocks', once=True, stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/bhr/publist.csv")
+            plain = b"".join(response.streaming_content)
+            gzipped = self.client.get("/bhr/publist.csv", HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(gzip.decompress(b"".join(gzipped.streaming_content)), plain)
+            self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+            self.assertNotEqual(gzipped['ETag'], response['ETag'])
+
+            response = self.client.get("/bhr/publist.csv", HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual([q for q in queries if 'bhr_' in q['sql']], [])
+        self.assertIn(b'1.2.3.4/32', plain)
+
+    def test_stale_files_fall_back_to_the_database(self):
+        write_exports()
+        self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        response = self.client.get("/bhr/publist.csv")
+        self.assertNotIn(b'1.2.3.5/32', b"".join(response.streaming_content))
+
+        # the exporter stopped checking
+        checked = time.time() - 301
+        for name in 'publist.csv', 'list.csv':
+            os.utime(os.path.join(self.dir, name + '.json'), (checked, checked))
+        self.assertIsNone(get_export_file('publist.csv'))
+        response = self.client.get("/bhr/publist.csv")
+        self.assertIn(b'1.2.3.5/32', b"".join(response.streaming_content))
+
+    def test_checking_current_files_keeps_them_served(self):
+        write_exports()
+        checked = time.time() - 301
+        os.utime(os.path.join(self.dir, 'publist.csv.json'), (checked, checked))
+        self.assertEqual(write_exports(), [])
+        self.assertIsNotNone(get_export_file('publist.csv'))
+        with override_settings(BHR=dict(settings.BHR, export_max_age=0)):
+            self.assertIsNone(get_export_file('publist.csv'))
+
+    def test_query_parameters_are_not_served_from_file(self):
+        write_exports()
+        self.db.add_block('1.2.3.5', self.user, 'test', 'testing')
+        response = self.client.get("/bhr/list.csv", {'source': 'test'})
+        self.assertIn(b'1.2.3.5/32', b"".join(response.streaming_content))
+
+
+class UtilTest(BHRTestCase):
     def test_expand_time(self):
         cases = [
             ('10',      10),
@@ -767,8 +2057,298 @@ class UtilTest(TestCase):
 
         self.assertRaises(ValueError, ip_family, "banana")
 
+    def test_aggregate_networks(self):
+        nets = ['10.0.0.0/32', '10.0.0.1/32', '10.0.0.2/31', '10.0.0.3/32', '10.0.0.5/32', '10.0.1.0/24',
+                '10.0.1.7/32', '2001:db8::/128', '2001:db8::1/128']
+        self.assertEqual([str(n) for n in aggregate_networks(nets)],
+                         ['10.0.0.0/30', '10.0.0.5/32', '10.0.1.0/24', '2001:db8::/127'])
+        self.assertRaises(ValueError, list, aggregate_networks(['10.0.0.1/32', '10.0.0.0/32']))
+
+    def test_aggregate_networks_random(self):
+        rng = random.Random(0)
+        for i in range(200):
+            nets = set(ipaddress.ip_network((0x0a000000 + rng.randint(0, 64), rng.randint(26, 32)), strict=False)
+                       for i in range(rng.randint(0, 40)))
+            gaps = set(ipaddress.ip_address(0x0a000000 + i) for i in range(0, 128)) - \
+                set(ip for n in nets for ip in n)
+            aggregated = list(aggregate_networks(sorted(nets)))
+
+            self.assertEqual(aggregated, list(ipaddress.collapse_addresses(nets)))
+            self.assertFalse(any(ip in n for n in aggregated for ip in gaps))
+
+    def test_iter_csv_chunks(self):
+        rows = [(i, 'row %d' % i) for i in range(7)]
+        chunks = list(iter_csv(rows, ['id', 'name'], chunk_size=3))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0], "id,name\r\n0,row 0\r\n1,row 1\r\n2,row 2\r\n")
+        data = list(csv.DictReader("".join(chunks).splitlines()))
+        self.assertEqual([d['name'] for d in data], [r[1] for r in rows])
+
+
+class NetworkIndexTest(BHRTestCase):
+    def test_find_overlap(self):
+        index = NetworkIndex()
+        index.add('10.0.0.0/8', 'ten')
+        index.add('192.168.1.0/24', 'one')
+        index.add('192.168.1.128/25', 'upper')
+        index.add('fe80::/10', 'link-local')
+
+        cases = [
+            ('10.1.2.3/32', 'ten'),
+            ('0.0.0.0/0', 'ten'),
+            ('192.168.0.0/16', 'one'),
+            ('192.168.1.200/32', 'one'),
+            ('192.168.2.0/24', None),
+            ('11.0.0.0/8', None),
+            ('fe80::1/128', 'link-local'),
+            ('2001:db8::/32', None),
+        ]
+        for network, value in cases:
+            self.assertEqual(index.find_overlap(network), value, network)
+
+    def test_find_overlap_prefers_the_first_added(self):
+        index = NetworkIndex()
+        index.add('192.168.1.128/25', 'upper')
+        index.add('192.168.0.0/16', 'wide')
+        self.assertEqual(index.find_overlap('192.168.1.200/32'), 'upper')
+        self.assertEqual(index.find_overlap('192.168.2.0/24'), 'wide')
 
-class WebUITest(TestCase):
+
+
+class IntervalIndexTest(BHRTestCase):
+    def test_find_covering(self):
+        networks = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3/32', '10.2.0.0/16', '10.1.2.0/24',
+                    '192.168.1.0/24', 'fe80::/10', 'fe80::/64']
+        index = IntervalIndex.from_networks((n, i) for i, n in enumerate(networks))
+        cases = [
+            ('10.1.2.3', [3, 5, 2, 1, 0]),
+            ('10.1.2.4', [5, 2, 1, 0]),
+            ('10.1.3.0', [1, 0]),
+            ('10.2.255.255', [4, 0]),
+            ('10.3.0.0', [0]),
+            ('10.255.255.255', [0]),
+            ('11.0.0.0', []),
+            ('9.255.255.255', []),
+            ('192.168.1.255', [6]),
+            ('fe80::1', [8, 7]),
+            ('fe80:0:0:1::1', [7]),
+            ('2001:db8::1', []),
+        ]
+        for address, keys in cases:
+            self.assertEqual(sorted(index.find_covering(ipaddress.ip_address(address))), sorted(keys), address)
+            prefixlens = [ipaddress.ip_network(networks[k]).prefixlen for k in index.find_covering(
+                ipaddress.ip_address(address))]
+            self.assertEqual(prefixlens, sorted(prefixlens, reverse=True), address)
+
+    def test_matches_a_scan(self):
+        rng = random.Random(0)
+        networks = [ipaddress.ip_network((0x0a000000 | rng.getrandbits(16), rng.randint(16, 32)), strict=False)
+                    for i in range(500)]
+        index = IntervalIndex.from_networks((n, i) for i, n in enumerate(networks))
+        for i in range(2000):
+            address = ipaddress.ip_address(0x0a000000 | rng.getrandbits(16))
+            self.assertEqual(sorted(index.find_covering(address)),
+                             [k for k, n in enumerate(networks) if address in n])
+
+
+class ExpectedBlockIndexTest(BHRTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+        bhr.models._expected_block_index = None
+
+    def covering(self, address):
+        return [(str(b['cidr']), b['source']) for b in get_expected_block_index().lookup(ipaddress.ip_address(address))]
+
+    def test_lookup(self):
+        self.db.add_block('1.2.3.0/24', self.user, 'wide', 'testing', skip_whitelist=True)
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=60)
+        self.assertEqual(self.covering('1.2.3.4'), [('1.2.3.4/32', 'test'), ('1.2.3.0/24', 'wide')])
+        self.assertEqual(self.covering('1.2.4.4'), [])
+        block = get_expected_block_index().lookup(ipaddress.ip_address('1.2.3.4'))[0]
+        self.assertEqual(block['id'], b.id)
+        self.assertEqual(block['unblock_at'], Block.objects.get(pk=b.id).unblock_at)
+
+    def test_refresh(self):
+        self.db.add_block('1.2.3.0/24', self.user, 'wide', 'testing', skip_whitelist=True)
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing')
+        index = get_expected_block_index()
+
+        self.db.add_block('1.2.3.5', self.user, 'new', 'testing')
+        self.db.unblock_now('1.2.3.0/24', self.user, 'testing')
+        self.assertEqual(self.covering('1.2.3.4'), [('1.2.3.4/32', 'test')])
+        self.assertEqual(self.covering('1.2.3.5'), [('1.2.3.5/32', 'new')])
+        self.assertEqual(self.covering('1.2.3.6'), [])
+        self.assertIs(get_expected_block_index(), index)
+
+        # blocked again after the unblock
+        self.db.add_block('1.2.3.0/24', self.user, 'again', 'testing', skip_whitelist=True)
+        self.assertEqual(self.covering('1.2.3.4'), [('1.2.3.4/32', 'test'), ('1.2.3.0/24', 'again')])
+        self.assertIs(get_expected_block_index(), index)
+
+    def test_extend(self):
+        b = self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=60)
+        get_expected_block_index()
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=3600, extend=True)
+        block = get_expected_block_index().lookup(ipaddress.ip_address('1.2.3.4'))[0]
+        self.assertEqual(block['unblock_at'], Block.objects.get(pk=b.id).unblock_at)
+        self.assertGreater(block['unblock_at'], timezone.now() + datetime.timedelta(seconds=3000))
+
+    def test_expired_blocks_are_skipped(self):
+        self.db.add_block('1.2.3.4', self.user, 'test', 'testing', duration=1)
+        index = get_expected_block_index()
+        self.assertEqual(len(self.covering('1.2.3.4')), 1)
+        sleep(1.5)
+        # expiring is not logged as a change
+        self.assertEqual(self.covering('1.2.3.4'), [])
+        self.assertIs(get_expected_block_index(), index)
+
+    def test_rebuilds_after_many_changes(self):
+        index = get_expected_block_index()
+        ExpectedBlockIndex.min_rebuild, saved = 2, ExpectedBlockIndex.min_rebuild
+        try:
+            for i in range(3):
+                self.db.add_block('1.2.3.%d' % i, self.user, 'test', 'testing')
+            self.assertIsNot(get_expected_block_index(), index)
+            self.assertEqual(len(get_expected_block_index().base), 3)
+        finally:
+            ExpectedBlockIndex.min_rebuild = saved
+
+
+@override_settings(
+    BHR=dict(settings.BHR, dupe_cache='dupes'),
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+        'dupes': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'dupes'},
+    })
+class DupeCacheTest(BHRTestCase):
+    def setUp(self):
+        self.db = BHRDB()
+        self.user = User.objects.create_user('admin', 'a@b.com', 'admin')
+        caches['dupes'].clear()
+
+    def add(self, cidr='1.2.3.4', duration=60, **kwargs):
+        return self.db.add_block(cidr, self.user, 'test', 'testing', duration=duration, **kwargs)
+
+    def test_duplicates_are_answered_from_the_cache(self):
+        b = self.add()
+        # the first duplicate is answered by the database and cached
+        self.add(duration=30)
+        with self.assertNumQueries(0):
+            cached = self.add(duration=30)
+        self.assertEqual((cached.id, cached.unblock_at, cached.who.username), (b.id, b.unblock_at, 'admin'))
+        context = {'request': RequestFactory().get('/bhr/api/block')}
+        self.assertEqual(JSONRenderer().render(BlockSerializer(cached, context=context).data),
+                         JSONRenderer().render(BlockSerializer(Block.objects.get(pk=b.pk), context=context).data))
+        self.assertEqual(DupeCache().stats(), {'hits': 1, 'misses': 2})
+
+    def test_extending_is_not_cached(self):
+        b = self.add()
+        self.add(duration=30)
+        extended = self.add(duration=600)
+        self.assertEqual(extended.id, b.id)
+        self.assertGreater(extended.unblock_at, b.unblock_at)
+        self.assertEqual(self.add().unblock_at, extended.unblock_at)
+        self.assertEqual(self.add(extend=False).unblock_at, extended.unblock_at)
+
+    def test_unblock_invalidates(self):
+        b = self.add()
+        self.add(duration=30)
+        self.db.unblock_now('1.2.3.4', self.user, 'testing')
+        self.assertNotEqual(self.add().id, b.id)
+
+        b = self.add('1.2.3.5')
+        self.add('1.2.3.5', duration=30)
+        self.db.unblock_now_multi([b.id], self.user, 'testing')
+        self.assertNotEqual(self.add('1.2.3.5').id, b.id)
+
+    def test_admin_and_block_updates_invalidate(self):
+        b = self.add()
+        self.add(duration=30)
+        force_unblock(None, None, Block.objects.filter(pk=b.pk))
+        self.assertNotEqual(self.add().id, b.id)
+
+        b = self.add('1.2.3.5')
+        self.add('1.2.3.5', duration=30)
+        b.why = 'edited'
+        b.save()
+        self.assertEqual(self.add('1.2.3.5', duration=30).why, 'edited')
+        b.forced_unblock = True
+        b.save()
+        self.assertNotEqual(self.add('1.2.3.5').id, b.id)
+
+    def test_batches_use_the_cache_when_every_block_is_a_dupe(self):
+        blocks = [dict(cidr=cidr, source='test', why='testing', duration=60, extend=False)
+                  for cidr in ('1.2.3.4', '1.2.3.5')]
+        self.db.add_block_multi(self.user, blocks)
+        self.db.add_block_multi(self.user, blocks)
+        with self.assertNumQueries(0):
+            self.db.add_block_multi(self.user, blocks)
+        # in a partial hit, the cached blocks still count as hits
+        self.db.add_block_multi(self.user, blocks + [dict(blocks[0], cidr='1.2.3.6')])
+        self.assertEqual(DupeCache().stats(), {'hits': 4, 'misses': 5})
+
+    def test_nothing_runs_after_the_change_log(self):
+        def after_change_log(fn):
+            with CaptureQueriesContext(connection) as ctx:
+                fn()
+            sql = [q['sql'] for q in ctx.captured_queries]
+            start = [i for i, q in enumerate(sql) if q.startswith('INSERT INTO bhr_changeversion')]
+            self.assertEqual(len(start), 1)
+            return sql[start[0] + 1:]
+
+        requests = [dict(cidr=cidr, source='test', why='testing', duration=60) for cidr in ('1.2.3.4', '1.2.3.5')]
+        for fn in [lambda: self.db.add_block_multi(self.user, requests),
+                   lambda: self.db.add_block_multi(self.user, [dict(r, duration=600) for r in requests]),
+                   lambda: self.db.unblock_now_multi(Block.objects.values_list('id', flat=True), self.user, 'testing')]:
+            rest = after_change_log(fn)
+            self.assertIn('INSERT INTO bhr_blockchange', rest[0])
+            self.assertIn('pg_notify', rest[1])
+            # leaving the atomic blocks of record_block_changes and its caller
+            self.assertEqual(len(rest), 4)
+            self.assertTrue(all(q.startswith('RELEASE SAVEPOINT') for q in rest[2:]))
+
+    def test_block_changes_refuse_an_outer_transaction(self):
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                self.add()
+            with self.assertRaises(transaction.TransactionManagementError):
+                self.db.unblock_now_multi([], self.user, 'testing')
+        b = self.add()
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                b.save()
+            with self.assertRaises(transaction.TransactionManagementError):
+                b.unblock_now(self.user, 'testing')
+            with self.assertRaises(transaction.TransactionManagementError):
+                force_unblock(None, None, Block.objects.filter(pk=b.pk))
+            with outer_atomic_blocks_allowed(1):
+                b.unblock_now(self.user, 'testing')
+        self.assertTrue(Block.objects.get(pk=b.pk).forced_unblock)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_change_form_saves_blocks(self):
+        b = self.add()
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username='admin', password='admin')
+        data = {'cidr': b.cidr, 'who': self.user.pk, 'source': b.source, 'why': 'changed', 'flag': b.flag,
+                'unblock_at_0': '2100-01-01', 'unblock_at_1': '00:00:00', 'unblock_why': ''}
+        response = self.client.post('/admin/bhr/block/%d/change/' % b.pk, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Block.objects.get(pk=b.pk).why, 'changed')
+
+    def test_metrics(self):
+        self.add()
+        self.add(extend=False)
+        self.add(extend=False)
+        self.user.user_permissions.add(Permission.objects.get(codename='add_block'))
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/bhr/api/metrics')
+        self.assertIn('bhr_dupe_cache_requests_total{result="hit"} 1 ', response.content.decode())
+
+
+class WebUITest(BHRTestCase):
 
     def setUp(self):
         self.user = User.objects.create_user('admin', 'temporary@gmail.com', 'admin')
@@ -787,3 +2367,16 @@ class WebUITest(TestCase):
     def test_login_post_invalid_password(self):
         response = self.client.post('/accounts/login/', {'username': 'admin', 'password': 'admin2'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_query_pages(self):
+        self.client.login(username='admin', password='admin')
+        for i in range(150):
+            BHRDB().add_block('1.2.%d.%d' % divmod(i, 256), self.user, 'test', 'scan')
+
+        response = self.client.get('/bhr/query', {'query': 'scan'})
+        self.assertEqual(len(response.context['blocks']), 100)
+        self.assertContains(response, 'page=2')
+        response = self.client.get('/bhr/query', {'query': 'scan', 'page': 2})
+        self.assertEqual(len(response.context['blocks']), 50)
+        self.assertNotContains(response, 'page=3')
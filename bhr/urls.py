@@ -28,12 +28,17 @@ urlpatterns = [
     url(r'^api/source_stats$', views.source_stats),
 
     url(r'^api/mblock$', views.mblock.as_view()),
+    url(r'^api/preflight$', views.preflight.as_view()),
     url(r'^api/set_blocked_multi/(?P<ident>.+)$', views.set_blocked_multi.as_view()),
     url(r'^api/set_unblocked_multi$', views.set_unblocked_multi.as_view()),
+    url(r'^api/sync/(?P<ident>.+)$', views.sync.as_view()),
 
     url(r'^api/queue/(?P<ident>.+)', views.BlockQueue.as_view()),
+    url(r'^api/cursor_queue/(?P<ident>.+)', views.BlockCursorQueue.as_view()),
     url(r'^api/unblock_queue/(?P<ident>.+)', views.UnBlockQueue.as_view()),
     url(r'^api/query/(?P<cidr>.+)', views.BlockHistory.as_view()),
+    url(r'^api/covering/(?P<cidr>.+)', views.CoveringBlocks.as_view()),
+    url(r'^api/lookup$', views.lookup.as_view()),
 
     url('^$', browser_views.IndexView.as_view(), name="home"),
     url('^add$', permission_required('bhr.add_block', raise_exception=True)(
@@ -47,6 +52,8 @@ urlpatterns = [
     url(r'^list$', login_required(browser_views.ListView.as_view()), name="list"),
     url(r'^list/source/(?P<source>.+)$', login_required(browser_views.SourceListView.as_view()), name="source-list"),
     url(r'^list.csv', views.bhlist.as_view(), name='csv'),
+    url(r'^delta\.(?P<fmt>csv|jsonl)$', views.bhdelta.as_view(), name='delta'),
+    url(r'^export/(?P<fmt>cidr|ipset|nft)$', views.bhexport.as_view(), name='export'),
 
     # auth mechanism agnostic login
     url(r'^login$', browser_views.login, name='login'),
@@ -1,19 +1,66 @@
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
 import csv
+import ipaddress
 from io import StringIO
 
 import socket
 
+CSV_CHUNK_SIZE = 2000
 
-def respond_csv(lst, headers):
+
+def iter_csv(rows, headers, chunk_size=CSV_CHUNK_SIZE):
+    """Render rows as csv, yielding one chunk of text per chunk_size rows.
+
+    Querysets are read with a server side cursor, so only one chunk of rows
+    is held in memory at a time.
+    """
+    if hasattr(rows, 'iterator'):
+        rows = rows.iterator(chunk_size=chunk_size)
     f = StringIO()
     writer = csv.writer(f)
     writer.writerow(headers)
 
-    for row in lst:
+    for n, row in enumerate(rows, 1):
         writer.writerow(row)
+        if n % chunk_size == 0:
+            yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+
+    yield f.getvalue()
+
+
+class JSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder that also encodes addresses and networks, as text"""
+    def default(self, o):
+        if isinstance(o, (ipaddress.IPv4Network, ipaddress.IPv6Network,
+                          ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            return str(o)
+        return super(JSONEncoder, self).default(o)
+
+
+def iter_jsonl(rows, headers, chunk_size=CSV_CHUNK_SIZE):
+    """Render rows as JSON lines objects with the headers as keys, in chunks like iter_csv"""
+    if hasattr(rows, 'iterator'):
+        rows = rows.iterator(chunk_size=chunk_size)
+    encoder = JSONEncoder()
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(dict(zip(headers, row))))
+        if len(lines) == chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
 
-    return HttpResponse(f.getvalue(), content_type="text/csv")
+
+def respond_csv(lst, headers):
+    return StreamingHttpResponse(iter_csv(lst, headers), content_type="text/csv")
+
+
+def respond_jsonl(lst, headers):
+    return StreamingHttpResponse(iter_jsonl(lst, headers), content_type="application/x-ndjson")
 
 
 time_suffixes = {
@@ -64,3 +111,125 @@ def ip_family(address):
         return 6
     else:
         raise ValueError("Invalid IP: {}".format(address))
+
+
+def to_network(cidr, strict=True):
+    """Return cidr as an ipaddress network object, only parsing it if needed"""
+    if isinstance(cidr, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return cidr
+    return ipaddress.ip_network(str(cidr), strict=strict)
+
+
+def _final(net, above):
+    """Whether net can no longer be merged, given the next network above it"""
+    if int(net.network_address) & (1 << (net.max_prefixlen - net.prefixlen)):
+        # a right half, its left half would have been merged already
+        return True
+    sibling_start = int(net.broadcast_address) + 1
+    sibling_end = sibling_start + net.num_addresses - 1
+    return not (sibling_start <= int(above.network_address) <= sibling_end)
+
+
+def aggregate_networks(networks):
+    """Merge networks into the fewest networks covering exactly the same addresses.
+
+    networks must be sorted by family, address and prefix length, the way
+    postgres orders cidr values.  Merged networks are yielded in the same
+    order as soon as nothing later can merge with them, so only a handful of
+    networks are held in memory.
+    """
+    stack = []
+    previous = None
+    for net in networks:
+        net = to_network(net)
+        if previous is not None and (previous.version, previous.network_address, previous.prefixlen) > \
+                (net.version, net.network_address, net.prefixlen):
+            raise ValueError("networks are not sorted: %s after %s" % (net, previous))
+        previous = net
+
+        if stack and stack[-1].version != net.version:
+            yield from stack
+            stack = []
+        if stack and stack[-1].network_address <= net.network_address <= stack[-1].broadcast_address:
+            continue  # already covered
+        stack.append(net)
+        while len(stack) > 1 and stack[-2].prefixlen == stack[-1].prefixlen and \
+                stack[-2].supernet() == stack[-1].supernet():
+            stack[-2:] = [stack[-2].supernet()]
+        if len(stack) > 1 and _final(stack[-2], stack[-1]):
+            yield from stack[:-1]
+            del stack[:-1]
+    yield from stack
+
+
+def _chunked(lines, chunk_size=CSV_CHUNK_SIZE):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
+
+
+def _by_family(networks):
+    """Yield (version, network) and (version, None) once a family is done, for both families"""
+    families = [4, 6]
+    for net in networks:
+        while families[0] != net.version:
+            yield families.pop(0), None
+        yield net.version, net
+    for version in families:
+        yield version, None
+
+
+def iter_cidrs(networks):
+    """Render networks one per line"""
+    return _chunked("%s\n" % net for net in networks)
+
+
+def iter_ipset_restore(networks, name, maxelem=65536):
+    """Render networks as input for ipset restore.
+
+    The sets name-v4 and name-v6 are replaced atomically by filling a
+    temporary set and swapping it in.
+    """
+    def lines():
+        started = set()
+        for version, net in _by_family(networks):
+            target = "%s-v%d" % (name, version)
+            tmp = target + "-tmp"
+            if version not in started:
+                started.add(version)
+                family = "inet" if version == 4 else "inet6"
+                yield "create %s hash:net family %s -exist\n" % (target, family)
+                yield "create %s hash:net family %s maxelem %d -exist\n" % (tmp, family, maxelem)
+                yield "flush %s\n" % tmp
+            if net is None:
+                yield "swap %s %s\n" % (tmp, target)
+                yield "destroy %s\n" % tmp
+            else:
+                yield "add %s %s\n" % (tmp, net)
+    return _chunked(lines())
+
+
+def iter_nft(networks, family, table, name, chunk_size=1000):
+    """Render networks as an nft -f script that replaces the elements of the sets name_v4 and name_v6.
+
+    The sets need to exist and have the interval flag, nft -f applies the
+    whole file as one transaction.
+    """
+    def lines():
+        started = set()
+        batch = []
+        for version, net in _by_family(networks):
+            target = "%s %s %s_v%d" % (family, table, name, version)
+            if version not in started:
+                started.add(version)
+                yield "flush set %s\n" % target
+            if net is not None:
+                batch.append(str(net))
+            if batch and (net is None or len(batch) == chunk_size):
+                yield "add element %s { %s }\n" % (target, ", ".join(batch))
+                batch = []
+    return _chunked(lines())
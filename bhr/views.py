@@ -1,26 +1,42 @@
 from rest_framework import viewsets
-from bhr.models import WhitelistEntry, Block, BlockEntry, BHRDB
+from bhr.models import (WhitelistEntry, Block, BlockEntry, BHRDB, BlockChangeListener, DupeCache,
+                        get_expected_block_index)
 from bhr.serializers import (WhitelistEntrySerializer,
                              BlockSerializer, BlockLimitedSerializer, BlockBriefSerializer, BlockQueueSerializer,
                              UnblockNowSerializer,
                              BlockEntrySerializer, UnBlockEntrySerializer,
-                             SetBlockedSerializer,
-                             BlockRequestSerializer)
-from bhr.util import respond_csv
+                             SetBlockedSerializer, AckSerializer, SyncSerializer, LookupSerializer,
+                             QueueParamsSerializer,
+                             BlockRequestSerializer, PreflightSerializer,
+                             FastBlockSerializer, FastBlockBriefSerializer, FastBlockQueueSerializer,
+                             FastUnBlockEntrySerializer)
+from bhr.exports import EXPORTS, get_export_file
+from bhr.pagination import OptInCursorPagination
+from bhr.renderers import NDJSONRenderer
+from bhr.util import (respond_csv, respond_jsonl, aggregate_networks, iter_cidrs, iter_ipset_restore, iter_nft,
+                      to_network, CSV_CHUNK_SIZE)
 from rest_framework import status
 from rest_framework import generics
 from rest_framework.decorators import api_view
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.settings import api_settings
-from rest_framework.permissions import DjangoModelPermissions, BasePermission
+from rest_framework.permissions import DjangoModelPermissions, BasePermission, IsAuthenticated
 from rest_framework_csv.renderers import CSVRenderer
 from rest_framework.response import Response
+from rest_framework.serializers import DateTimeField
 from rest_framework.views import APIView
 
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
+from functools import wraps
+import ipaddress
+import re
 import time
+import zlib
 
 
 def make_permission_class(perm):
@@ -30,10 +46,67 @@ def make_permission_class(perm):
     return CustomPermission
 
 
+def block_set_version(request):
+    if not hasattr(request, '_block_set_version'):
+        request._block_set_version = BHRDB().get_block_set_version()
+    return request._block_set_version
+
+
+def block_set_etag(request, *args, **kwargs):
+    # the same url can render as json, csv or html depending on Accept
+    accept = zlib.crc32(request.META.get('HTTP_ACCEPT', '').encode())
+    return "%s-%x" % (block_set_version(request)[0], accept)
+
+
+def block_set_last_modified(request, *args, **kwargs):
+    return block_set_version(request)[1]
+
+
+# Answer conditional requests for views of the expected blocks with a 304
+block_set_condition = condition(etag_func=block_set_etag, last_modified_func=block_set_last_modified)
+
+accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def export_view(name):
+    """Serve the pre-rendered export name if the exporter checked it recently, otherwise call the view.
+
+    Only requests without query parameters can be answered from the file.
+    A file can lag the blocks by little more than BHR['export_max_age']
+    seconds at worst.
+    """
+    def decorator(view):
+        conditional_view = block_set_condition(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            export = None if request.GET else get_export_file(name)
+            gzipped = bool(accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+            f = export and export.open(gzipped)
+            if f is None:
+                return conditional_view(request, *args, **kwargs)
+
+            def serve(request, *args, **kwargs):
+                response = FileResponse(f, content_type=export.export.content_type)
+                if gzipped:
+                    response['Content-Encoding'] = 'gzip'
+                patch_vary_headers(response, ('Accept-Encoding',))
+                return response
+
+            version = export.version + ('.gz' if gzipped else '')
+            request._block_set_version = (version, export.last_modified)
+            response = block_set_condition(serve)(request, *args, **kwargs)
+            if not isinstance(response, FileResponse):
+                f.close()
+            return response
+        return wrapper
+    return decorator
+
+
 class WhitelistViewSet(viewsets.ModelViewSet):
     serializer_class = WhitelistEntrySerializer
     permission_classes = [DjangoModelPermissions]
-    queryset = WhitelistEntry.objects.all()
+    queryset = WhitelistEntry.objects.select_related('who')
 
     def pre_save(self, obj):
         obj.who = self.request.user
@@ -46,20 +119,19 @@ class WhitelistViewSet(viewsets.ModelViewSet):
 class BlockEntryViewset(viewsets.ModelViewSet):
     serializer_class = BlockEntrySerializer
     permission_classes = [DjangoModelPermissions]
-    queryset = BlockEntry.objects.all()
+    queryset = BlockEntry.objects.select_related('block')
 
     @action(detail=True, methods=['post'])
     def set_unblocked(self, request, pk=None):
         entry = self.get_object()
-        entry.set_unblocked()
-        entry.save()
+        BHRDB().set_unblocked_by_blockentry_id(entry.id)
         return Response({'status': 'ok'})
 
 
 class BlockViewset(viewsets.ModelViewSet):
     serializer_class = BlockSerializer
     permission_classes = [DjangoModelPermissions]
-    queryset = Block.objects.all()
+    queryset = Block.objects.select_related('who')
 
     def pre_save(self, obj):
         """Force who to the current user on save"""
@@ -84,8 +156,68 @@ class BlockViewset(viewsets.ModelViewSet):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class CurrentBlockViewset(viewsets.ReadOnlyModelViewSet):
+class StreamingListMixin(object):
+    """List without building the whole response in memory.
+
+    JSON and NDJSON lists are serialized a chunk of rows at a time as they
+    are read from a server side cursor.  ?page_size= switches to keyset
+    pagination instead.  Rows are serialized with fast_serializer_class
+    when it is set.
+    """
+    fast_serializer_class = None
+    pagination_class = OptInCursorPagination
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+    chunk_size = CSV_CHUNK_SIZE
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.list_serializer()(page))
+        renderer = request.accepted_renderer
+        if isinstance(renderer, NDJSONRenderer):
+            content = self.stream_ndjson(queryset, renderer)
+        elif renderer.format == 'json':
+            content = self.stream_json(queryset, renderer)
+        else:
+            return Response(self.list_serializer()(queryset))
+        return StreamingHttpResponse(content, content_type=renderer.media_type)
+
+    def list_serializer(self):
+        """Get a function that serializes a list of rows"""
+        if self.fast_serializer_class:
+            return self.fast_serializer_class(self.get_serializer_context()).data
+        return lambda rows: self.get_serializer(rows, many=True).data
+
+    def serialized_chunks(self, queryset):
+        serialize = self.list_serializer()
+        if self.fast_serializer_class:
+            queryset = queryset.values(*self.fast_serializer_class.values)
+        chunk = []
+        for obj in queryset.iterator(chunk_size=self.chunk_size):
+            chunk.append(obj)
+            if len(chunk) == self.chunk_size:
+                yield serialize(chunk)
+                chunk = []
+        if chunk:
+            yield serialize(chunk)
+
+    def stream_ndjson(self, queryset, renderer):
+        for data in self.serialized_chunks(queryset):
+            yield renderer.render(data)
+
+    def stream_json(self, queryset, renderer):
+        # Same bytes as rendering the whole list at once
+        separator = b"["
+        for data in self.serialized_chunks(queryset):
+            yield separator + renderer.render(data, self.request.accepted_media_type)[1:-1]
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+
+class CurrentBlockViewset(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = BlockSerializer
+    fast_serializer_class = FastBlockSerializer
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
 
@@ -95,16 +227,22 @@ class CurrentBlockViewset(viewsets.ReadOnlyModelViewSet):
 
 class CurrentBlockBriefViewset(CurrentBlockViewset):
     serializer_class = BlockBriefSerializer
+    fast_serializer_class = FastBlockBriefSerializer
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
-    renderer_classes = [CSVRenderer] + api_settings.DEFAULT_RENDERER_CLASSES
+    renderer_classes = [CSVRenderer] + StreamingListMixin.renderer_classes
 
 
-class ExpectedBlockViewset(viewsets.ReadOnlyModelViewSet):
+class ExpectedBlockViewset(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = BlockBriefSerializer
+    fast_serializer_class = FastBlockBriefSerializer
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
 
+    @method_decorator(block_set_condition)
+    def list(self, request, *args, **kwargs):
+        return super(ExpectedBlockViewset, self).list(request, *args, **kwargs)
+
     def get_queryset(self):
         queryset = Block.expected.all().select_related('who')
         source = self.request.query_params.get('source', None)
@@ -113,8 +251,9 @@ class ExpectedBlockViewset(viewsets.ReadOnlyModelViewSet):
         return queryset
 
 
-class PendingBlockViewset(viewsets.ReadOnlyModelViewSet):
+class PendingBlockViewset(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = BlockSerializer
+    fast_serializer_class = FastBlockSerializer
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
 
@@ -122,8 +261,9 @@ class PendingBlockViewset(viewsets.ReadOnlyModelViewSet):
         return Block.pending.all().select_related('who')
 
 
-class PendingRemovalBlockViewset(viewsets.ReadOnlyModelViewSet):
+class PendingRemovalBlockViewset(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = BlockSerializer
+    fast_serializer_class = FastBlockSerializer
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
 
@@ -141,37 +281,122 @@ class BlockHistory(generics.ListAPIView):
         return Block.objects.filter(cidr__in_cidr=cidr).select_related('who')
 
 
+class CoveringBlocks(generics.ListAPIView):
+    """The expected blocks that cover cidr, most specific first"""
+    serializer_class = BlockSerializer
+    permission_classes = [DjangoModelPermissions]
+    queryset = Block.objects.none()  # Required for DjangoModelPermissions
+
+    def list(self, request, cidr):
+        try:
+            cidr = to_network(cidr, strict=False)
+        except ValueError:
+            return Response({'cidr': ['Invalid cidr']}, status=status.HTTP_400_BAD_REQUEST)
+        blocks = BHRDB().covering_blocks(cidr)
+        return Response(FastBlockSerializer(self.get_serializer_context()).data(blocks))
+
+
+class lookup(APIView):
+    """Which of the posted ips are covered by expected blocks, and by which blocks.
+
+    Takes {"ips": [...]} and answers {"results": {ip: [block, ...]}} for the
+    ips that are blocked, from an in-memory index of the expected blocks.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = LookupSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        index = get_expected_block_index()
+        datetime_field = DateTimeField()
+        results = {}
+        for ip in serializer.validated_data['ips']:
+            blocks = index.lookup(ipaddress.ip_address(ip))
+            if blocks:
+                for block in blocks:
+                    block['cidr'] = str(block['cidr'])
+                    block['unblock_at'] = datetime_field.to_representation(block['unblock_at'])
+                results[ip] = blocks
+        return Response({'results': results})
+
+
 class BlockHistoryLimited(BlockHistory):
     serializer_class = BlockLimitedSerializer
     permission_classes = []
 
 
+def long_poll(check, timeout, ready=bool):
+    """Call check until ready(result) or timeout seconds have passed, waking up on block changes"""
+    end = time.time() + timeout
+    with BlockChangeListener() as listener:
+        while True:
+            result = check()
+            remaining = end - time.time()
+            if ready(result) or remaining <= 0:
+                return result
+            listener.wait(remaining)
+
+
+def queue_params(request):
+    """The validated query parameters of a queue request, invalid ones are answered with a 400"""
+    serializer = QueueParamsSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
 class BlockQueue(generics.ListAPIView):
     serializer_class = BlockQueueSerializer
     permission_classes = [make_permission_class('bhr.add_blockentry')]
 
+    def list(self, request, *args, **kwargs):
+        return Response(FastBlockQueueSerializer(self.get_serializer_context()).data(self.get_queryset()))
+
     def get_queryset(self):
         ident = self.kwargs['ident']
-        timeout = int(self.request.query_params.get('timeout', 0))
+        params = queue_params(self.request)
+        timeout, lease = params['timeout'], params['lease']
         added_since = self.request.query_params.get('added_since', '2014-09-01')
-        if not timeout:
+
+        def check():
+            if lease:
+                return BHRDB().claim_block_queue(ident, lease, limit=200, added_since=added_since)
             return BHRDB().block_queue(ident, limit=200, added_since=added_since)
 
-        end = time.time() + timeout
-        while time.time() < end:
-            blocks = BHRDB().block_queue(ident, limit=200, added_since=added_since)
-            if list(blocks):
-                return blocks
-            time.sleep(1.0)
-        return blocks
+        if not timeout:
+            return check()
+        return long_poll(lambda: list(check()), timeout)
+
+
+class BlockCursorQueue(APIView):
+    """Block queue that only looks at blocks added since the cursor returned by the previous call"""
+    permission_classes = [make_permission_class('bhr.add_blockentry')]
+
+    def get(self, request, ident):
+        params = queue_params(request)
+        cursor, timeout = params['cursor'], params['timeout']
+        blocks, cursor = long_poll(lambda: BHRDB().block_queue_since(ident, cursor, limit=200), timeout,
+                                   ready=lambda result: result[0])
+        context = {"request": request}
+        return Response({
+            'cursor': cursor,
+            'blocks': FastBlockQueueSerializer(context).data(blocks),
+        })
 
 
 class UnBlockQueue(generics.ListAPIView):
     serializer_class = UnBlockEntrySerializer
     permission_classes = [make_permission_class('bhr.change_blockentry')]
 
+    def list(self, request, *args, **kwargs):
+        return Response(FastUnBlockEntrySerializer(self.get_serializer_context()).data(self.get_queryset()))
+
     def get_queryset(self):
         ident = self.kwargs['ident']
+        lease = queue_params(self.request)['lease']
+        if lease:
+            return BHRDB().claim_unblock_queue(ident, lease, limit=200)
         return BHRDB().unblock_queue(ident)[:200]
 
 
@@ -214,22 +439,68 @@ class mblock(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class preflight(APIView):
+    """What mblock would do with blocks of the posted cidrs, without blocking anything.
+
+    Takes {"source": ..., "cidrs": [...]} and optionally the duration,
+    unblock_at and extend of the blocks, answers with a verdict per cidr.
+    """
+    permission_classes = [make_permission_class('bhr.add_block')]
+
+    def post(self, request):
+        serializer = PreflightSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        verdicts = BHRDB().preflight_blocks(**serializer.validated_data)
+        datetime_field = DateTimeField()
+        for verdict in verdicts:
+            for item in verdict, verdict.get('covering', {}):
+                if 'unblock_at' in item:
+                    item['unblock_at'] = datetime_field.to_representation(item['unblock_at'])
+        return Response(verdicts)
+
+
+def ack_results(results):
+    return [{'id': id, 'status': result} for id, result in results.items()]
+
+
 class set_blocked_multi(APIView):
     permission_classes = [make_permission_class('bhr.add_blockentry')]
 
     def post(self, request, ident):
-        ids = request.data['ids']
-        BHRDB().set_blocked_multi(ident, ids)
-        return Response({'status': 'ok'})
+        serializer = AckSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        results = BHRDB().set_blocked_multi(ident, serializer.validated_data['ids'])
+        return Response({'status': 'ok', 'results': ack_results(results)})
 
 
 class set_unblocked_multi(APIView):
     permission_classes = [make_permission_class('bhr.change_blockentry')]
 
     def post(self, request):
-        ids = request.data['ids']
-        BHRDB().set_unblocked_multi(ids)
-        return Response({'status': 'ok'})
+        serializer = AckSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        results = BHRDB().set_unblocked_multi(serializer.validated_data['ids'])
+        return Response({'status': 'ok', 'results': ack_results(results)})
+
+
+class sync(APIView):
+    """Acknowledge blocks and unblocks and get the next block and unblock queues in one request"""
+    permission_classes = [make_permission_class('bhr.add_blockentry'), make_permission_class('bhr.change_blockentry')]
+
+    def post(self, request, ident):
+        serializer = SyncSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        d = serializer.validated_data
+        blocks, unblocks = BHRDB().sync(ident, d['blocked'], d['unblocked'], lease=d['lease'])
+        context = {"request": request}
+        return Response({
+            'block_queue': FastBlockQueueSerializer(context).data(blocks),
+            'unblock_queue': FastUnBlockEntrySerializer(context).data(unblocks),
+        })
 
 
 @api_view(["GET"])
@@ -279,6 +550,16 @@ def metrics(request):
     for source, count in source_stats.items():
         add('blocked_total_by_source{source="%s"}' % source, count)
 
+    dupe_cache = DupeCache()
+    if dupe_cache:
+        dupe_stats = dupe_cache.stats()
+        out.append('''
+# HELP bhr_dupe_cache_requests_total block requests answered from the dupe cache or not
+# TYPE bhr_dupe_cache_requests_total counter
+''')
+        add('dupe_cache_requests_total{result="hit"}', dupe_stats["hits"])
+        add('dupe_cache_requests_total{result="miss"}', dupe_stats["misses"])
+
     resp = "".join(out)
     return HttpResponse(resp, content_type="text/plain")
 
@@ -295,6 +576,7 @@ class bhlist(APIView):
     permission_classes = [DjangoModelPermissions]
     queryset = Block.objects.none()  # Required for DjangoModelPermissions
 
+    @method_decorator(export_view('list.csv'))
     def get(self, request):
         # TODO: http://www.django-rest-framework.org/api-guide/filtering/ ?
         source = self.request.query_params.get('source', None)
@@ -304,12 +586,60 @@ class bhlist(APIView):
             queryset = queryset.filter(source=source)
         if since:
             queryset = queryset.filter(added__gte=since).order_by('added')
-        blocks = queryset.values_list('cidr', 'who__username', 'source', 'why', 'added', 'unblock_at')
-        return respond_csv(blocks, ["cidr", "who", "source", "why", "added", "unblock_at"])
+        export = EXPORTS['list.csv']
+        return respond_csv(export.rows(queryset), export.headers)
+
+
+class bhexport(APIView):
+    """The expected blocks aggregated into the fewest networks, as a cidr list, ipset restore or nft -f input"""
+    permission_classes = [DjangoModelPermissions]
+    queryset = Block.objects.none()  # Required for DjangoModelPermissions
+    valid_name = re.compile(r'^[A-Za-z0-9_]{1,24}$')
+
+    @method_decorator(block_set_condition)
+    def get(self, request, fmt):
+        params = dict(name='bhr', family='inet', table='filter')
+        params.update((k, v) for k, v in request.query_params.items() if k in params)
+        invalid = {k: ['Invalid name'] for k, v in params.items() if not self.valid_name.match(v)}
+        if invalid:
+            return Response(invalid, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = BHRDB().expected()
+        source = request.query_params.get('source')
+        if source:
+            queryset = queryset.filter(source=source)
+        cidrs = queryset.order_by('cidr').values_list('cidr', flat=True).iterator(chunk_size=CSV_CHUNK_SIZE)
+        networks = aggregate_networks(cidrs)
+
+        if fmt == 'ipset':
+            maxelem = max(65536, BHRDB().stats()['expected'])
+            content = iter_ipset_restore(networks, params['name'], maxelem)
+        elif fmt == 'nft':
+            content = iter_nft(networks, params['family'], params['table'], params['name'])
+        else:
+            content = iter_cidrs(networks)
+        return StreamingHttpResponse(content, content_type="text/plain")
+
+
+class bhdelta(APIView):
+    """Changes to the expected blocks since ?cursor=, the next cursor is in the X-BHR-Cursor header"""
+    permission_classes = [DjangoModelPermissions]
+    queryset = Block.objects.none()  # Required for DjangoModelPermissions
+
+    def get(self, request, fmt):
+        try:
+            cursor, rows = BHRDB().get_block_delta(request.query_params.get('cursor'))
+        except ValueError:
+            return Response({'cursor': ['Invalid cursor']}, status=status.HTTP_400_BAD_REQUEST)
+        headers = ["action", "id", "cidr", "who", "source", "why", "added", "unblock_at"]
+        respond = respond_csv if fmt == 'csv' else respond_jsonl
+        response = respond(rows, headers)
+        response['X-BHR-Cursor'] = cursor
+        return response
 
 
 @api_view(["GET"])
+@export_view('publist.csv')
 def bhlistpub(request):
-    resp = []
-    blocks = BHRDB().expected().values_list('cidr', 'added', 'unblock_at')
-    return respond_csv(blocks, ["cidr", "added", "unblock_at"])
+    export = EXPORTS['publist.csv']
+    return respond_csv(export.rows(), export.headers)